@@ -1,8 +1,14 @@
 # A very simply assembler
 
 from constants import *
+import constants
 from typing import *
 from abc import abstractmethod
+import ast
+import hashlib
+import operator
+import os
+import pickle
 import re
 
 opa_reg_names = {
@@ -25,85 +31,308 @@ opb_immed_reg_names = {
 }
 
 class AsmError(Exception):
-    def __init__(self, message: str):
+    def __init__(self, message: str, line_no: Optional[int] = None, column: Optional[int] = None):
         self.message = message
+        self.line_no = line_no
+        self.column = column
     def __str__(self) -> str:
-        return str(self.message)
+        if self.line_no is None:
+            return str(self.message)
+        where = f"line {self.line_no}" if self.column is None else f"line {self.line_no}, column {self.column}"
+        return f"{where}: {self.message}"
 
 class SymbolTable(object):
     def __init__(self):
         self.table: Dict[str, Union[int, Expression]] = OrderedDict()
+        # Values of the symbols resolved so far. This is also the namespace expressions are evaluated in.
+        self.values: Dict[str, int] = {}
         self.resolved = True
-    def add(self, name: str, value: 'Expression'):
+    def add(self, name: str, value: Union[int, 'Expression']):
         if name in self.table:
             raise AsmError(f"Symbol {name} is already defined as {self.table[name]}")
         self.table[name] = value
         self.resolved = False
     def get(self, name):
         return self.table[name]
+    def dependencies(self, name: str) -> Sequence[str]:
+        value = self.table[name]
+        if _is_int(value):
+            return ()
+        try:
+            return tuple(dep for dep in value.names() if dep in self.table)
+        except AsmError as ex:
+            raise self._error(name, ex.message, ex.column)
     def resolve(self):
+        # Resolves every symbol that isn't yet
         if self.resolved: return
-        # Each table entry is a list of (tokenized) strings for the 'value' field. So each element is either:
-        #
-        # Our goal is to find symbols that can be evaluated down to a single integer, replace the value with that integer value
-        # and repeat the process until we either can't make further progress or we don't have anything to do.
-        # We are using pythons eval function to do the heavy-lifting for us.
-        table_changed = True
-        resolved_symbols: Dict[str, int] = {}
-        unresolved_symbols: Dict[str, Expression] = {}
-        for sym_name, sym_value in self.table.items():
-            if _is_int(sym_value):
-                resolved_symbols[sym_name] = int(sym_value)
-                continue
+        for name in self.table:
+            if name not in self.values:
+                self.resolve_symbol(name)
+        self.resolved = True
+    def resolve_symbol(self, name: str) -> int:
+        # Resolves a symbol, along with everything it depends on. The dependency graph is walked
+        # depth-first, so every symbol is evaluated once, after all of its dependencies. The walk
+        # uses an explicit stack, long chains of definitions would overflow the Python one.
+        values = self.values
+        if name in values:
+            return values[name]
+        stack = [(name, iter(self.dependencies(name)))]
+        on_stack = {name}
+        while len(stack) > 0:
+            sym_name, deps = stack[-1]
+            for dep in deps:
+                if dep in values:
+                    continue
+                if dep in on_stack:
+                    cycle = [entry[0] for entry in stack]
+                    cycle = cycle[cycle.index(dep):] + [dep]
+                    raise self._error(cycle[0], f"Circular symbol definition: {' -> '.join(cycle)}")
+                stack.append((dep, iter(self.dependencies(dep))))
+                on_stack.add(dep)
+                break
+            else:
+                stack.pop()
+                on_stack.remove(sym_name)
+                values[sym_name] = self._evaluate(sym_name)
+        return values[name]
+    def _evaluate(self, name: str) -> int:
+        # All dependencies of 'name' are resolved by now
+        sym_value = self.table[name]
+        if _is_int(sym_value):
+            return int(sym_value)
+        try:
+            return sym_value.evaluate(self.values)
+        except AsmError as ex:
+            raise self._error(name, f"Can't resolve symbol {name}: {ex.message}", ex.column)
+    def _error(self, name: str, message: str, column: Optional[int] = None) -> AsmError:
+        # An error in the definition of 'name', which is where it points to (if we know where that is)
+        value = self.table[name]
+        line = None if _is_int(value) else value.line
+        return AsmError(message, line.line_no if line is not None else None, column)
+
+########################################
+# Constant expressions
+########################################
+# Expressions are compiled once, into either a constant (if they don't refer to symbols)
+# or a closure that takes the symbol values. Operators and precedence are those of C:
+#    |   ^   &   << >>   + -   * /   unary - + ~
+# Division truncates towards 0.
+
+def _div(a: int, b: int) -> int:
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+_expr_binary_ops = ( # Lowest precedence first
+    {"|": operator.or_},
+    {"^": operator.xor},
+    {"&": operator.and_},
+    {"<<": operator.lshift, ">>": operator.rshift},
+    {"+": operator.add, "-": operator.sub},
+    {"*": operator.mul, "/": _div},
+)
+_expr_unary_ops = {"-": operator.neg, "+": operator.pos, "~": operator.invert}
+
+# Symbol names; the lexer (see _token_pattern) keeps these in one token
+_identifier_pattern = r"[A-Za-z_.][\w.]*"
+
+_expr_token_re = re.compile(r"\s*(?:(\d\w*)|(" + _identifier_pattern + r")|(<<|>>|[-+*/&|^~()])|(\S))")
+
+ExprNode = Union[int, Callable[[Dict[str, int]], int]]
+
+def _expr_const(node: ExprNode) -> Callable[[Dict[str, int]], int]:
+    if callable(node):
+        return node
+    return lambda values: node
+
+class _ExprCompiler(object):
+    def __init__(self, text: str, column: Callable[[int], Optional[int]]):
+        # 'column' gives the source column of an offset into 'text', for error messages
+        self.text = text
+        self.column = column
+        self.tokens: List[Tuple[str, str]] = [] # (kind, text), kind is one of 'num', 'name', 'op'
+        for number, name, op, junk in _expr_token_re.findall(text):
+            if junk != "":
+                self._error(f"unexpected '{junk}'", len(self.tokens))
+            if number != "":
+                self.tokens.append(("num", number))
+            elif name != "":
+                self.tokens.append(("name", name))
+            else:
+                self.tokens.append(("op", op))
+        self.cursor = 0
+        self.names: List[str] = []
+
+    def compile(self) -> ExprNode:
+        if len(self.tokens) == 0:
+            self._error("it's empty")
+        node = self._binary(0)
+        if self.cursor != len(self.tokens):
+            self._error(f"unexpected '{self.tokens[self.cursor][1]}'")
+        return node
+
+    def _error(self, what: str, token: Optional[int] = None) -> None:
+        # Points at token number 'token', or the one at the cursor
+        offsets = [match.start(match.lastindex) for match in _expr_token_re.finditer(self.text)]
+        token = self.cursor if token is None else token
+        offset = offsets[token] if token < len(offsets) else len(self.text)
+        hint = ". Did you use $r1 as the base register?" if "$" in self.text else ""
+        raise AsmError(f"Can't evaluate constant expression: '{self.text}': {what}{hint}", column=self.column(offset))
+
+    def _peek_op(self) -> Optional[str]:
+        if self.cursor < len(self.tokens) and self.tokens[self.cursor][0] == "op":
+            return self.tokens[self.cursor][1]
+        return None
+
+    def _binary(self, level: int) -> ExprNode:
+        if level == len(_expr_binary_ops):
+            return self._unary()
+        ops = _expr_binary_ops[level]
+        node = self._binary(level + 1)
+        while self._peek_op() in ops:
+            op = ops[self.tokens[self.cursor][1]]
+            op_token = self.cursor
+            self.cursor += 1
+            rhs = self._binary(level + 1)
+            if not callable(node) and not callable(rhs):
+                node = self._fold(op, node, rhs, op_token)
+            else:
+                lhs_func, rhs_func = _expr_const(node), _expr_const(rhs)
+                node = lambda values, op=op, lhs_func=lhs_func, rhs_func=rhs_func: op(lhs_func(values), rhs_func(values))
+        return node
+
+    def _unary(self) -> ExprNode:
+        op = self._peek_op()
+        if op in _expr_unary_ops:
+            self.cursor += 1
+            func = _expr_unary_ops[op]
+            node = self._unary()
+            if not callable(node):
+                return func(node)
+            return lambda values, func=func, node=node: func(node(values))
+        return self._primary()
+
+    def _primary(self) -> ExprNode:
+        if self.cursor == len(self.tokens):
+            self._error("it ends unexpectedly")
+        kind, text = self.tokens[self.cursor]
+        self.cursor += 1
+        if kind == "num":
             try:
-                resolved_symbols[sym_name] = int(" ".join(sym_value.token_list))
+                return int(text, 0)
             except ValueError:
-                unresolved_symbols[sym_name] = sym_value
-        while table_changed:
-            table_changed = False
-            for sym_name, sym_value in unresolved_symbols.items():
-                try:
-                    resolved_value = eval(" ".join(sym_value.token_list), resolved_symbols)
-                    try:
-                        int_value = int(resolved_value)
-                    except ValueError:
-                        raise AsmError(f"Symbol {sym_name} with resolved value {resolved_value} doesn't evaluate to an integer")
-                    resolved_symbols[sym_name] = int_value
-                    del unresolved_symbols[sym_name]
-                    table_changed = True
-                    break
-                except NameError:
-                    continue
-        if len(unresolved_symbols) > 0:
-            raise AsmError(f"Can't resolve symbol(s) {' ,'.join(unresolved_symbols.keys())}")
-        self.table = resolved_symbols
-        self.resolved = True
+                self._error(f"'{text}' is not a valid number", self.cursor - 1)
+        if kind == "name":
+            self.names.append(text)
+            return lambda values: values[text]
+        if text == "(":
+            node = self._binary(0)
+            if self._peek_op() != ")":
+                self._error("missing ')'")
+            self.cursor += 1
+            return node
+        self._error(f"unexpected '{text}'", self.cursor - 1)
+
+    def _fold(self, op: Callable[[int, int], int], lhs: int, rhs: int, op_token: int) -> int:
+        try:
+            return op(lhs, rhs)
+        except (ZeroDivisionError, ValueError) as ex:
+            self._error(str(ex), op_token)
 
 class Expression(object):
-    def __init__(self, token_list: Sequence[str]):
+    def __init__(self, token_list: Union[str, Sequence[str]], line: Optional['TokenLine'] = None, first: int = 0):
+        # 'token_list' can be tokens 'first' and on of 'line'; errors then point into the source
         self.token_list = token_list
+        self.line = line
+        self.first = first
+        self.compiled: Optional[ExprNode] = None
+        self.symbol_names: Sequence[str] = ()
+
+    def text(self) -> str:
+        if isinstance(self.token_list, str):
+            return self.token_list
+        return " ".join(self.token_list)
+
+    def column(self, offset: int = 0) -> Optional[int]:
+        # Source column of character 'offset' of 'text()', if we know the line. Past the end
+        # of the text, that's the column right after the last token.
+        tokens = self.token_list
+        if self.line is None or len(tokens) == 0:
+            return None
+        start = 0
+        for token, column in zip(tokens, self.line.columns[self.first:]):
+            if offset < start + len(token):
+                return column + max(offset - start, 0)
+            start += len(token) + 1
+        return self.line.column(self.first + len(tokens))
+
+    def compile(self) -> ExprNode:
+        if self.compiled is None:
+            compiler = _ExprCompiler(self.text(), self.column)
+            self.compiled = compiler.compile()
+            self.symbol_names = tuple(compiler.names)
+        return self.compiled
+
+    def names(self) -> Sequence[str]:
+        # Identifiers the expression refers to
+        self.compile()
+        return self.symbol_names
+
+    def evaluate(self, values: Dict[str, int]) -> int:
+        # Evaluates the expression with the symbols it refers to resolved to 'values'
+        compiled = self.compile()
+        if not callable(compiled):
+            return compiled
+        try:
+            return compiled(values)
+        except KeyError as ex:
+            raise AsmError(f"Can't evaluate constant expression: '{self.text()}': unknown symbol {ex.args[0]}", column=self.column())
+        except (ZeroDivisionError, ValueError) as ex:
+            raise AsmError(f"Can't evaluate constant expression: '{self.text()}': {ex}", column=self.column())
 
     def value(self, symbol_table: SymbolTable):
         try:
             return self.resolved_value
         except AttributeError:
-            symbol_table.resolve() # This will be fast if already resolved
-            try:
-                expr = " ".join(self.token_list)
-                self.resolved_value = eval(expr, symbol_table.table)
-            except SyntaxError:
-                raise AsmError(f"Can't evaluate constant expression: '{expr}'. Did you use $r1 as the base register?")
+            # Only the symbols we refer to need resolving; what's resolved once stays resolved.
+            for name in self.names():
+                if name in symbol_table.table:
+                    symbol_table.resolve_symbol(name)
+            self.resolved_value = self.evaluate(symbol_table.values)
             return self.resolved_value
 
+    def __str__(self) -> str:
+        return self.text()
 
 
+
+def immed_field(immed: int) -> int:
+    # The bits of the immediate field holding 'immed'
+    if (immed > (IMMED_MASK >> 1)) or (immed < (-IMMED_MASK >> 1)):
+        raise AsmError(f"Immediate value {immed} is out of range")
+    return (immed & IMMED_MASK) << IMMED_OFS
+
+def check_word(val: int) -> int:
+    if (val.bit_length() > 16):
+        raise AsmError(f"Value {val} doesn't fit in 16 bits")
+    return val
+
+# Relocation kinds (see ObjectFile)
+RELOC_WORD = "word"   # The value is the whole word
+RELOC_IMMED = "immed" # The value goes into the immediate field of an instruction
+
+Relocation = Tuple[int, str, Expression] # Offset, kind, value
+
 class InstructionBase(object):
+    line_no: Optional[int] = None # Where it's defined in the source, if known
     @abstractmethod
     def machine_code(self, symbol_table: SymbolTable) -> Sequence[int]:
         pass
     @abstractmethod
     def get_size(self) -> int:
         pass
+    def object_code(self, symbol_table: SymbolTable, is_relocated: Callable[[Expression], bool]) -> Tuple[Sequence[int], Sequence[Relocation]]:
+        # Machine code with the values 'is_relocated' says are only known at link time left 0, and the relocations filling them in
+        return self.machine_code(symbol_table), ()
 
 class Instruction(InstructionBase):
     def __init__(self, opcode, d, opa, opb, immed: Expression):
@@ -114,10 +343,18 @@ class Instruction(InstructionBase):
         self.immed = immed
     def machine_code(self, symbol_table: SymbolTable) -> Sequence[int]:
         immed = self.immed.value(symbol_table)
-        if (immed > (IMMED_MASK >> 1)) or (immed < (-IMMED_MASK >> 1)):
-            raise AsmError(f"Immediate value {immed} is out of range")
-        inst_code = (self.opcode << OPCODE_OFS) | (self.d << D_OFS) | (self.opb << OPB_OFS) | (self.opa << OPA_OFS) | ((immed & IMMED_MASK) << IMMED_OFS)
+        try:
+            inst_code = self._inst_code() | immed_field(immed)
+        except AsmError as ex:
+            ex.column = self.immed.column()
+            raise
         return (inst_code & 0xffff, )
+    def object_code(self, symbol_table: SymbolTable, is_relocated: Callable[[Expression], bool]) -> Tuple[Sequence[int], Sequence[Relocation]]:
+        if not is_relocated(self.immed):
+            return self.machine_code(symbol_table), ()
+        return (self._inst_code() & 0xffff, ), ((0, RELOC_IMMED, self.immed), )
+    def _inst_code(self) -> int:
+        return (self.opcode << OPCODE_OFS) | (self.d << D_OFS) | (self.opb << OPB_OFS) | (self.opa << OPA_OFS)
     def get_size(self) -> int:
         return 1;
 
@@ -125,11 +362,25 @@ class PseudoOpWord(InstructionBase):
     def __init__(self, values: Sequence[Expression]):
         self.values = values
     def machine_code(self, symbol_table: SymbolTable) -> Sequence[int]:
-        int_vals = tuple(val.value(symbol_table) for val in self.values)
-        for val in int_vals:
-            if (val.bit_length() > 16):
-                raise AsmError(f"Value {val} doesn't fit in 16 bits")
-        return list(int_vals)
+        words = []
+        for val in self.values:
+            try:
+                words.append(check_word(val.value(symbol_table)))
+            except AsmError as ex:
+                if ex.column is None:
+                    ex.column = val.column()
+                raise
+        return words
+    def object_code(self, symbol_table: SymbolTable, is_relocated: Callable[[Expression], bool]) -> Tuple[Sequence[int], Sequence[Relocation]]:
+        words = []
+        relocations = []
+        for ofs, val in enumerate(self.values):
+            if is_relocated(val):
+                words.append(0)
+                relocations.append((ofs, RELOC_WORD, val))
+            else:
+                words.append(check_word(val.value(symbol_table)))
+        return words, relocations
     def get_size(self) -> int:
         return len(self.values)
 class PseudoOpString(InstructionBase):
@@ -137,25 +388,103 @@ class PseudoOpString(InstructionBase):
         bytes = list(value.encode())
         bytes.append(0) # zero terminate string
         if len(bytes) & 1 != 0: bytes.append(0)
-        words = list(bytes[i:i+2] for i in range(0, len(bytes), 2))
-        self.value = words
+        # Two characters per word, the first one in the low byte
+        self.values = list(bytes[i] | (bytes[i+1] << 8) for i in range(0, len(bytes), 2))
     def machine_code(self, symbol_table: SymbolTable) -> Sequence[int]:
         return self.values
     def get_size(self) -> int:
         return len(self.values)
 
 
-_tokenizer_re = re.compile(r'(?=[\, \[\]\+\-\*\/\(\)\&\|\~\;])|(?<=[\, \[\]\+\-\*\/\(\)\&\|\~\;])')
+########################################
+# Lexer
+########################################
+# A single regular expression splits the whole source into tokens in one go; comments are
+# tokens too, and get dropped. Tokens are plain strings, so parsers can compare them
+# directly. Their kinds and columns are worked out from the line they're on when needed
+# (see TokenLine): parsers report errors at the column of the token they stopped at, and
+# expressions keep the line they're on, so errors found when they're evaluated point into
+# the source too.
 
-def tokenize(line: str) -> Sequence[str]:
-    raw_tokens = re.split(_tokenizer_re, line)
-    tokens = list(tok for tok in raw_tokens if tok.strip() != "")
-    # Remove any comments
-    try:
-        tokens = tokens[:tokens.index(';')]
-    except ValueError:
-        pass
-    return tokens
+TOKEN_REGISTER    = "register"
+TOKEN_NUMBER      = "number"
+TOKEN_IDENTIFIER  = "identifier"
+TOKEN_STRING      = "string"
+TOKEN_PUNCTUATION = "punctuation"
+
+_token_pattern = r'"(?:[^"\\\n]|\\.)*"|\$\w+|[\w.]+|<<|>>|;[^\n]*|\S'
+_token_re = re.compile(_token_pattern)
+_token_or_newline_re = re.compile(_token_pattern + r"|\n")
+
+def token_kind(token: str) -> str:
+    first = token[0]
+    if first == '"' and len(token) > 1 and token[-1] == '"':
+        return TOKEN_STRING
+    if first == "$":
+        return TOKEN_REGISTER
+    if first.isdigit():
+        return TOKEN_NUMBER
+    if first.isalpha() or first in "_.":
+        return TOKEN_IDENTIFIER
+    return TOKEN_PUNCTUATION
+
+class TokenLine(list):
+    # The tokens of one source line, or a part of them (see 'part')
+    def __init__(self, tokens: Iterable[str], line_no: int, text: str, first: int = 0):
+        super().__init__(tokens)
+        self.line_no = line_no
+        self.text = text
+        self.first = first # Index of our first token among those of the line
+
+    def part(self, start: int, end: Optional[int] = None) -> 'TokenLine':
+        # Tokens 'start' to 'end', keeping track of where they are on the line
+        return TokenLine(self[start:end], self.line_no, self.text, self.first + start)
+
+    @property
+    def kinds(self) -> List[str]:
+        return [token_kind(token) for token in self]
+
+    @property
+    def columns(self) -> List[int]:
+        # 1-based column of every token
+        columns = [match.start() + 1 for match in _token_re.finditer(self.text) if match.group()[0] != ";"]
+        return columns[self.first:self.first+len(self)]
+
+    def column(self, idx: int) -> Optional[int]:
+        # Column of token 'idx'; past the last token, that of the end of the line
+        columns = self.columns
+        if idx < len(columns):
+            return columns[idx]
+        if len(columns) == 0:
+            return None
+        return columns[-1] + len(self[-1])
+
+def _expression(line: Sequence[str], start: int, end: Optional[int] = None) -> Expression:
+    # Expression of tokens 'start' to 'end' of 'line'
+    return Expression(line[start:end], line if isinstance(line, TokenLine) else None, start)
+
+def _column(line: Sequence[str], idx: int) -> Optional[int]:
+    # Where token 'idx' of 'line' is, for error messages; parsers are also called with plain lists of tokens
+    return line.column(idx) if isinstance(line, TokenLine) else None
+
+def lex(source: str) -> Iterator[TokenLine]:
+    # Yields the tokens of every non-empty line of 'source'
+    lines = source.split("\n")
+    line_no = 1
+    tokens = []
+    for token in _token_or_newline_re.findall(source):
+        if token == "\n":
+            if len(tokens) > 0:
+                yield TokenLine(tokens, line_no, lines[line_no-1])
+                tokens = []
+            line_no += 1
+        elif token[0] != ";":
+            tokens.append(token)
+    if len(tokens) > 0:
+        yield TokenLine(tokens, line_no, lines[line_no-1])
+
+def tokenize(line: str) -> TokenLine:
+    return TokenLine((token for token in _token_re.findall(line) if token[0] != ";"), 1, line)
 
 def _is_int(s):
     try:
@@ -168,7 +497,7 @@ def _is_int(s):
 
 def parse_constant_expression(line: Sequence[str], cursor: int, *, force_plus: bool):
     if force_plus and line[cursor] not in "+-":
-        raise AsmError(f"constant offset must start with + or -")
+        raise AsmError(f"constant offset must start with + or -", column=_column(line, cursor))
     # We simply find the end of the expression and stuff it into an Expression object
     start = cursor
     for token in line[start:]:
@@ -176,7 +505,7 @@ def parse_constant_expression(line: Sequence[str], cursor: int, *, force_plus: b
         if token in "],":
             cursor -= 1
             break
-    exp = Expression(line[start:cursor])
+    exp = _expression(line, start, cursor)
     return exp, cursor
     '''
     sign = -1 if line[cursor] == '-' else 1
@@ -198,7 +527,7 @@ def parse_opb(line: Sequence[str], cursor: int, *, allow_immed: bool):
             immed, cursor = parse_constant_expression(line, cursor, force_plus=False)
             opb = OPB_MEM_IMMED
             if line[cursor] != "]":
-                raise AsmError(f"memory reference is not terminated properly")
+                raise AsmError(f"memory reference is not terminated properly", column=_column(line, cursor))
             cursor += 1
         else:
             immed = Expression("0")
@@ -209,7 +538,7 @@ def parse_opb(line: Sequence[str], cursor: int, *, allow_immed: bool):
             else:
                 immed, cursor = parse_constant_expression(line, cursor, force_plus=True)
                 if line[cursor] != "]":
-                    raise AsmError(f"memory reference is not terminated properly")
+                    raise AsmError(f"memory reference is not terminated properly", column=_column(line, cursor))
                 cursor += 1
     elif allow_immed:
         if line[cursor] in opb_immed_reg_names:
@@ -223,7 +552,7 @@ def parse_opb(line: Sequence[str], cursor: int, *, allow_immed: bool):
             opb = OPB_IMMED
             immed, cursor = parse_constant_expression(line, cursor, force_plus=False)
     else:
-        raise AsmError(f"{line[cursor]} is invalid as a operand B")
+        raise AsmError(f"{line[cursor]} is invalid as a operand B", column=_column(line, cursor))
 
     return opb, immed, cursor
 
@@ -250,7 +579,7 @@ def parse_dual_arg(inst_code: int, line: Sequence[str], *, is_swapi = False) ->
             d = 1
             opb, immed, cursor = parse_opb(line, cursor, allow_immed=False)
             if line[cursor] != ",":
-                raise AsmError(f"there must be a comma after first operand")
+                raise AsmError(f"there must be a comma after first operand", column=_column(line, cursor))
             cursor += 1
             opa = opa_reg_names[line[cursor]]
             cursor += 1
@@ -259,15 +588,15 @@ def parse_dual_arg(inst_code: int, line: Sequence[str], *, is_swapi = False) ->
                 opa = opa_reg_names[line[cursor]]
                 cursor += 1
                 if line[cursor] != ",":
-                    raise AsmError(f"there must be a comma after first operand")
+                    raise AsmError(f"there must be a comma after first operand", column=_column(line, cursor))
                 cursor += 1
                 opb, immed, cursor = parse_opb(line, cursor, allow_immed=True)
         else:
-            raise AsmError(f"I don't understand the first argument")
+            raise AsmError(f"I don't understand the first argument", column=_column(line, cursor))
     except IndexError:
-        raise AsmError(f"Line is too short, can't understand it")
+        raise AsmError(f"Line is too short, can't understand it", column=_column(line, len(line)))
     if cursor != len(line):
-        raise AsmError(f"Line is too long, can't understand it")
+        raise AsmError(f"Line is too long, can't understand it", column=_column(line, cursor))
     return Instruction(inst_code, d, opa, opb, immed)
 
 def parse_single_arg(inst_code: int, line: Sequence[str]) -> Instruction:
@@ -291,10 +620,12 @@ def parse_single_arg(inst_code: int, line: Sequence[str]) -> Instruction:
             cursor += 1
             opb = OPB_IMMED
             immed = Expression("0")
+        else:
+            raise AsmError(f"I don't understand the argument", column=_column(line, cursor))
     except IndexError:
-        raise AsmError(f"Line is too short, can't understand it")
+        raise AsmError(f"Line is too short, can't understand it", column=_column(line, len(line)))
     if cursor != len(line):
-        raise AsmError(f"Line is too long, can't understand it")
+        raise AsmError(f"Line is too long, can't understand it", column=_column(line, cursor))
     return Instruction(inst_code, d, opa, opb, immed)
 
 def parse_swapi(inst_code: int, line: Sequence[str]) -> Instruction:
@@ -363,53 +694,75 @@ class WordParser(object):
         pass
     def parse(self, line: Sequence[str], context: 'AsmContext'):
         # items are separated by commas
-        value = []
         values = []
-        for token in line[1:]:
-            if token == ',':
-                if len(value) > 0:
-                    values.append(Expression(value))
-                else:
+        start = 1
+        for idx in range(1, len(line) + 1):
+            if idx == len(line) or line[idx] == ',':
+                if idx > start:
+                    values.append(_expression(line, start, idx))
+                elif idx < len(line):
                     values.append(Expression("0"))
-                value.clear()
-            else:
-                value.append(token)
-        if len(value) > 0:
-            values.append(Expression(value))
+                start = idx + 1
         context.add_inst(PseudoOpWord(values))
 
 class StrParser(object):
     def __init__(self):
         pass
     def parse(self, line: Sequence[str], context: 'AsmContext'):
-        raise AsmError("TODO: I don't know how to implement this: the tokenizer stripped all white-spaces inside strings...")
+        # The syntax here is: .string "text", with Python escapes
+        if len(line) != 2 or token_kind(line[1]) != TOKEN_STRING:
+            raise AsmError(".string needs a single quoted string", column=_column(line, min(len(line), 2) - 1))
+        try:
+            value = ast.literal_eval(line[1])
+        except (SyntaxError, ValueError):
+            raise AsmError(f"invalid string {line[1]}", column=_column(line, 1))
+        context.add_inst(PseudoOpString(value))
 
 class DefParser(object):
     def __init__(self):
         pass
     def parse(self, line: Sequence[str], context: 'AsmContext'):
         # The syntax here is: .def SYMBOL=3+23
-        cursor = 1
-        symbol_name = line[cursor]
-        cursor += 1
-        if line[cursor] != '=':
-            raise AsmError(".def needs an equal sign after symbol name")
-        symbol_expression = Expression(line[cursor+1:])
+        if len(line) < 2 or token_kind(line[1]) != TOKEN_IDENTIFIER:
+            raise AsmError(".def needs a symbol name", column=_column(line, min(len(line) - 1, 1)))
+        if len(line) < 3 or line[2] != "=":
+            raise AsmError(".def needs an equal sign after symbol name", column=_column(line, min(len(line) - 1, 2)))
+        if len(line) < 4:
+            raise AsmError(".def needs a value after the equal sign", column=_column(line, 2))
+        symbol_name = line[1]
+        symbol_expression = _expression(line, 3)
         context.symbol_table.add(symbol_name, symbol_expression)
 
 
+class ExportParser(object):
+    def __init__(self):
+        pass
+    def parse(self, line: Sequence[str], context: 'AsmContext'):
+        # The syntax here is: .export SYMBOL[, SYMBOL...]
+        # Only matters for separately assembled modules (see compile_object)
+        names = line[1::2]
+        if len(names) == 0 or any(sep != "," for sep in line[2::2]) or any(token_kind(name) != TOKEN_IDENTIFIER for name in names):
+            raise AsmError(".export needs a comma-separated list of symbols")
+        context.exports.extend(names)
+
 class LabelParser(object):
     def __init__(self):
         pass
     def parse(self, line: Sequence[str], context: 'AsmContext'):
-        # The syntax here is: LABEL:
+        # The syntax here is: LABEL: [instruction]
         cursor = 0
         symbol_name = line[cursor]
+        if token_kind(symbol_name) != TOKEN_IDENTIFIER:
+            raise AsmError(f"{symbol_name} is not a valid label name", column=_column(line, cursor))
         cursor += 1
         if line[cursor] != ':':
-            raise AsmError("labels must be terminated by a colon")
-        symbol_expression = Expression(str(context.org))
-        context.symbol_table.add(symbol_name, symbol_expression)
+            raise AsmError("labels must be terminated by a colon", column=_column(line, cursor))
+        if not hasattr(context, "active_section"):
+            raise AsmError("Labels need an active section. User the '.section' directive to define one")
+        context.symbol_table.add(symbol_name, context.active_section.org)
+        context.active_section.labels.append(symbol_name)
+        if len(line) > 2:
+            context.parse_tokens(line.part(2) if isinstance(line, TokenLine) else line[2:])
 
 class SectionParser(object):
     def __init__(self):
@@ -419,20 +772,21 @@ class SectionParser(object):
         # If number is omitted, we continue with the existing section. Or create a new one with 0-base
         section_name = line[1]
         if (len(line) > 2):
-            org = Expression(line[2:])
+            org = _expression(line, 2)
         else:
-            if context.has_section(section_name):
-                context.set_active_section(section_name)
-            else:
-                org = "0"
-        context.symbol_table.resolve()
+            # A new section without an address starts at 0, or wherever the linker puts it
+            context.set_active_section(section_name)
+            return
         context.set_active_section(section_name, org.value(context.symbol_table))
 
 class Section(object):
-    def __init__(self, base_addr: int):
+    def __init__(self, base_addr: int, relocatable: bool = False):
         self.base_addr = base_addr
         self.org = base_addr
+        self.relocatable = relocatable # Declared without an address; the linker places it (see compile_object)
         self.objects: Dict[int, InstructionBase] = OrderedDict()
+        self.labels: List[str] = []
+        self.lines: List[str] = [] # Source lines, for the cache key (see AsmCache)
 
     def add_inst(self, inst:InstructionBase):
         self.objects[self.org] = inst
@@ -442,10 +796,31 @@ class Section(object):
         self.org = org
 
     def machine_code(self, name: str, symbol_table: SymbolTable) -> Sequence[int]:
+        return self.object_code(name, symbol_table)[0]
+
+    def object_code(
+        self,
+        name: str,
+        symbol_table: SymbolTable,
+        is_relocated: Optional[Callable[[Expression], bool]] = None
+    ) -> Tuple[Sequence[int], Sequence[Tuple[int, str, str, Optional[int]]]]:
+        # Returns the text of the section and the relocations in it, as in ObjectSection.
+        # Without 'is_relocated', every value is resolved and there are no relocations.
         ret_val = []
+        relocations = []
         for addr in sorted(self.objects):
             inst = self.objects[addr]
-            inst_words = inst.machine_code(symbol_table)
+            try:
+                if is_relocated is None:
+                    inst_words = inst.machine_code(symbol_table)
+                else:
+                    inst_words, inst_relocations = inst.object_code(symbol_table, is_relocated)
+                    for ofs, kind, value in inst_relocations:
+                        relocations.append((addr + ofs - self.base_addr, kind, value.text(), inst.line_no))
+            except AsmError as ex:
+                if ex.line_no is None:
+                    ex.line_no = inst.line_no
+                raise
             for ofs, word in enumerate(inst_words):
                 inst_addr = addr + ofs - self.base_addr # This is the index into ret_val
                 if inst_addr >= len(ret_val):
@@ -453,7 +828,24 @@ class Section(object):
                 if ret_val[inst_addr] is not None:
                     raise AsmError(f"Multiple values are defined for address 0x{inst_addr+self.base_addr:04x} in section {name}")
                 ret_val[inst_addr] = word
-        return ret_val
+        return ret_val, relocations
+
+def merge_sections(section_texts: Iterable[Tuple[int, Sequence[Optional[int]]]]) -> Tuple[int, Sequence[int]]:
+    # Merges (base address, text) pairs into a single binary, holes filled with 0-s
+    section_texts = tuple(section_texts)
+    start_addr = min(base for base, text in section_texts)
+    max_addr = max(base + len(text) for base, text in section_texts)
+    ret_val = []
+    ret_val += (None,)*(max_addr-start_addr)
+    for base, text in section_texts:
+        for ofs, word in enumerate(text):
+            addr = base + ofs - start_addr
+            if ret_val[addr] is not None:
+                raise AsmError(f"Overlapping sections at address 0x{addr+start_addr:04x}")
+            ret_val[addr] = word
+    # Finally replace all remaining None-s with 0-s in the binary
+    ret_val = list(0 if val is None else val for val in ret_val)
+    return start_addr, ret_val
 
 
 class AsmContext(object):
@@ -481,20 +873,24 @@ class AsmContext(object):
         "rol":       InstParser(INST_ROL,   parse_single_arg),
         "ror":       InstParser(INST_ROR,   parse_single_arg),
         ".word":     WordParser(),
+        ".string":   StrParser(),
         ".section":  SectionParser(),
         ".def":      DefParser(),
+        ".export":   ExportParser(),
     }
 
     def __init__(self):
         self.symbol_table = SymbolTable()
         self.sections: Dict[Section] = OrderedDict()
+        self.exports: List[str] = []
+        self.line_no: Optional[int] = None # Source line being parsed
 
     def has_section(self, name: str):
         return name in self.sections
 
     def set_active_section(self, name: str, org: Optional[int] = None):
         if name not in self.sections:
-            self.sections[name] = Section(org if org is not None else 0)
+            self.sections[name] = Section(org if org is not None else 0, relocatable=org is None)
         self.active_section: Section = self.sections[name]
         if org is not None:
             self.active_section.set_org(org)
@@ -502,6 +898,7 @@ class AsmContext(object):
     def add_inst(self, inst:InstructionBase):
         if not hasattr(self, "active_section"):
             raise AsmError("Can't start assembling without an active section. User the '.section' directive to define one")
+        inst.line_no = self.line_no
         self.active_section.add_inst(inst)
 
     def parse_line(self, line: str) -> None:
@@ -510,44 +907,267 @@ class AsmContext(object):
         tokens = tokenize(line)
         if len(tokens) == 0:
             return
+        self.parse_tokens(tokens)
+
+    def parse_tokens(self, tokens: Sequence[str]) -> None:
         if tokens[0].lower() in self.instructions:
             parser = self.instructions[tokens[0].lower()]
         else:
             # Check for labels:
-            if tokens[1] == ':':
+            if len(tokens) > 1 and tokens[1] == ':':
                 parser = self.label_parser
             else:
                 raise AsmError(f"Instruction {tokens[0]} is invalid")
         parser.parse(tokens, self)
 
-    def compile(self, asm_source: str) -> Tuple[int, Sequence[int]]:
+    def parse(self, asm_source: str) -> None:
+        for tokens in lex(asm_source):
+            self.line_no = tokens.line_no
+            try:
+                self.parse_tokens(tokens)
+            except AsmError as ex:
+                if ex.line_no is None:
+                    ex.line_no = tokens.line_no
+                    if ex.column is None:
+                        ex.column = tokens.column(0)
+                raise
+            if hasattr(self, "active_section"):
+                self.active_section.lines.append(tokens.text)
+
+    def compile(self, asm_source: str, cache: Optional['AsmCache'] = None) -> Tuple[int, Sequence[int]]:
         # Assemble into 'object' file
-        for line in asm_source.splitlines():
-            self.parse_line(line)
-        # Generate text for all sections
+        self.parse(asm_source)
+        self.symbol_table.resolve()
+        # Generate text for all sections, unless the cache has it
         section_texts = OrderedDict()
         for section_name, section in self.sections.items():
-            text = section.machine_code(section_name, self.symbol_table)
+            key = None if cache is None else self._section_key(section_name, section)
+            text = None if key is None else cache.get(key)
+            if text is None:
+                text = section.machine_code(section_name, self.symbol_table)
+                if key is not None:
+                    cache.put(key, tuple(text))
             section_texts[section.base_addr] = text
+        return merge_sections(section_texts.items())
 
-        # Merge all sections into a single binary
-        start_addr = min(section_texts)
-        max_addr = max(base + len(text) for base, text in section_texts.items())
-        ret_val = []
-        ret_val += (None,)*(max_addr-start_addr)
-        for base, text in section_texts.items():
-            for ofs, word in enumerate(text):
-                addr = base + ofs - start_addr
-                if ret_val[addr] is not None:
-                    raise AsmError(f"Overlapping sections at address 0x{addr+start_addr:04x}")
-                ret_val[addr] = word
-        # Finally replace all remaining None-s with 0-s in the binary
-        ret_val = list(0 if val is None else val for val in ret_val)
-        return start_addr, ret_val
-
-def assemble(source: str) -> Tuple[int, Sequence[int]]:
-    context = AsmContext()
-    return context.compile(source)
+    def compile_object(self, asm_source: str, name: str = "") -> 'ObjectFile':
+        # Assembles a module for linking (see link.py). Sections declared without an address are
+        # relocatable, their labels are offsets from the start of the section. Symbols that are
+        # used but not defined are imports. Values that depend on either are left to the linker.
+        self.parse(asm_source)
+        table = self.symbol_table.table
+        label_sections = OrderedDict()
+        for section_name, section in self.sections.items():
+            if section.relocatable:
+                for label in section.labels:
+                    label_sections[label] = section_name
+        deferred = self._link_time_symbols(set(label_sections))
+        def is_relocated(value: Expression) -> bool:
+            return any(name in deferred or name not in table for name in value.names())
+        sections = OrderedDict()
+        for section_name, section in self.sections.items():
+            text, relocations = section.object_code(section_name, self.symbol_table, is_relocated)
+            sections[section_name] = ObjectSection(None if section.relocatable else section.base_addr, text, relocations)
+        symbols = OrderedDict()
+        imports = set()
+        for sym_name, value in table.items():
+            if sym_name in label_sections:
+                symbols[sym_name] = (label_sections[sym_name], value)
+            elif sym_name in deferred:
+                symbols[sym_name] = (None, value.text())
+                imports.update(dep for dep in value.names() if dep not in table)
+            else:
+                symbols[sym_name] = (None, self.symbol_table.resolve_symbol(sym_name))
+        for section in sections.values():
+            for _, _, value, _ in section.relocations:
+                imports.update(dep for dep in Expression(value).names() if dep not in table)
+        for sym_name in self.exports:
+            if sym_name not in table:
+                raise AsmError(f"Exported symbol {sym_name} is not defined")
+        return ObjectFile(name, sections, symbols, self.exports, sorted(imports))
+
+    def _link_time_symbols(self, relocatable: Set[str]) -> Set[str]:
+        # Symbols whose value depends on 'relocatable' ones or on imports, directly or through
+        # other symbols. Walks the dependencies depth-first, like SymbolTable.resolve_symbol.
+        table = self.symbol_table.table
+        def names(name: str) -> Sequence[str]:
+            value = table[name]
+            return () if _is_int(value) else value.names()
+        deferred = set(relocatable)
+        visited = set(relocatable)
+        for name in table:
+            if name in visited:
+                continue
+            visited.add(name)
+            stack = [(name, iter(names(name)))]
+            while len(stack) > 0:
+                sym_name, deps = stack[-1]
+                for dep in deps:
+                    if dep in table and dep not in visited:
+                        visited.add(dep)
+                        stack.append((dep, iter(names(dep))))
+                        break
+                else:
+                    stack.pop()
+                    if any(dep in deferred or dep not in table for dep in names(sym_name)):
+                        deferred.add(sym_name)
+        return deferred
+
+    def _section_key(self, name: str, section: Section) -> str:
+        # The code of a section depends on its lines, where it starts and the symbols it refers to
+        text = "\n".join(section.lines)
+        table = self.symbol_table.table
+        names = sorted(set(name for name in _symbol_name_re.findall(text) if name in table))
+        symbols = ",".join(f"{name}={self.symbol_table.resolve_symbol(name)}" for name in names)
+        return AsmCache.key("section", name, str(section.base_addr), symbols, text)
+
+########################################
+# Object files
+########################################
+OBJECT_VERSION = 1
+
+class ObjectSection(object):
+    def __init__(self, base_addr: Optional[int], text: Sequence[Optional[int]], relocations: Sequence[Tuple[int, str, str, Optional[int]]]):
+        # 'base_addr' is None for relocatable sections. 'text' has None for holes and 0 where a
+        # relocation goes; relocations are (offset, kind, expression, source line).
+        self.base_addr = base_addr
+        self.text = tuple(text)
+        self.relocations = tuple(relocations)
+
+class ObjectFile(object):
+    # A separately assembled module. Everything in here is plain data, so objects can be
+    # pickled: saved to disk, cached, or passed between processes.
+    def __init__(
+        self,
+        name: str,
+        sections: Dict[str, ObjectSection],
+        symbols: Dict[str, Tuple[Optional[str], Union[int, str]]],
+        exports: Sequence[str],
+        imports: Sequence[str],
+    ):
+        # 'symbols' are (section, offset) for labels in relocatable sections, (None, value) for
+        # everything else, where the value is an int, or the text of an expression the linker evaluates.
+        self.name = name
+        self.sections = sections
+        self.symbols = symbols
+        self.exports = tuple(exports)
+        self.imports = tuple(imports)
+
+    def save(self, file_name: str) -> None:
+        with open(file_name, "wb") as f:
+            pickle.dump((OBJECT_VERSION, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(file_name: str) -> 'ObjectFile':
+        with open(file_name, "rb") as f:
+            version, obj = pickle.load(f)
+        if version != OBJECT_VERSION:
+            raise AsmError(f"{file_name} is an object file of version {version}, expected {OBJECT_VERSION}")
+        return obj
+
+########################################
+# Object code cache
+########################################
+_symbol_name_re = re.compile(_identifier_pattern)
+
+def _source_hash(*file_names: str) -> str:
+    digest = hashlib.sha256()
+    for file_name in file_names:
+        with open(file_name, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+# Part of every cache key: any change to the assembler (or the encodings in constants.py) invalidates all entries
+ASM_CACHE_VERSION = _source_hash(__file__, constants.__file__)
+ASM_CACHE_ENTRIES = 4096
+
+class AsmCache(object):
+    # Caches the object code of whole programs, keyed by a hash of their source, and of sections,
+    # keyed by a hash of their lines and the values of the symbols they refer to. So unchanged
+    # programs aren't assembled at all, and when a section is edited, only that section is
+    # re-encoded (all of them are still parsed, for their labels). Entries are kept in memory
+    # and, with 'cache_dir' set, on disk, where they are shared between processes.
+    def __init__(self, cache_dir: Optional[str] = None, max_entries: int = ASM_CACHE_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.entries: Dict[str, Any] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.sha256("\0".join((ASM_CACHE_VERSION,) + parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".obj")
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif self.cache_dir is not None:
+            try:
+                with open(self._path(key), "rb") as f:
+                    entry = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                entry = None
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: Any) -> None:
+        self._remember(key, entry)
+        if self.cache_dir is not None:
+            # Write under a temporary name first, so other processes never see a partial entry
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key: str, entry: Any) -> None:
+        self.entries[key] = entry
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        # Forgets the in-memory entries; the ones on disk stay
+        self.entries.clear()
+
+# Used by 'assemble' by default. Set ASM_CACHE_DIR in the environment to keep it on disk.
+default_cache = AsmCache(os.environ.get("ASM_CACHE_DIR"))
+
+def assemble(source: str, *, cache: Optional[AsmCache] = default_cache) -> Tuple[int, Sequence[int]]:
+    # Pass cache=None to always assemble from scratch
+    if cache is None:
+        return AsmContext().compile(source)
+    key = AsmCache.key("program", source)
+    entry = cache.get(key)
+    if entry is None:
+        base_addr, words = AsmContext().compile(source, cache)
+        entry = (base_addr, tuple(words))
+        cache.put(key, entry)
+    base_addr, words = entry
+    return base_addr, list(words)
+
+def object_cache_key(source: str, name: str = "") -> str:
+    return AsmCache.key("object", str(OBJECT_VERSION), name, source)
+
+def assemble_object(source: str, name: str = "", *, cache: Optional[AsmCache] = default_cache) -> ObjectFile:
+    # Assembles a module for linking (see AsmContext.compile_object and link.py)
+    if cache is None:
+        return AsmContext().compile_object(source, name)
+    key = object_cache_key(source, name)
+    obj = cache.get(key)
+    if obj is None:
+        obj = AsmContext().compile_object(source, name)
+        cache.put(key, obj)
+    return obj
 
 
 
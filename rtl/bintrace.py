@@ -0,0 +1,261 @@
+# A compact binary trace format
+#
+# Every fetch, bus read, bus write, register update and termination is stored as a
+# fixed-width record. Records are collected in memory and written out in NumPy
+# structured-array chunks, so the trace file is nothing but a header followed by
+# an array that can be memory-mapped as a whole.
+#
+# Next to the trace, an index file holds the record numbers sorted by $pc and by
+# memory address. Together with the records being in cycle order, that's enough to
+# answer most questions without ever scanning the trace:
+#
+#    python bintrace.py run.trace --addr 0x0006 --kind write
+#    python bintrace.py run.trace --pc 0x1080 --last
+#    python bintrace.py run.trace --cycles 100:200
+
+from constants import *
+from typing import *
+import argparse
+import struct
+import os
+
+import numpy as np
+
+from trace import TraceLevel, TraceKind, TraceSinkBase
+
+TRACE_MAGIC = b"TCTRACE\0"
+INDEX_MAGIC = b"TCTRIDX\0"
+TRACE_VERSION = 1
+
+RECORD_DTYPE = np.dtype([
+    ("cycle", "<u8"),
+    ("kind",  "u1"),   # TraceKind
+    ("flags", "u1"),   # FLAG_xxx
+    ("pc",    "<u2"),  # address of the instruction being executed
+    ("addr",  "<u2"),  # memory address, or OPA_xxx for register updates
+    ("data",  "<u2"),  # data read or written, new register value or exit code
+    ("old",   "<u2"),  # previous register value
+])
+
+FLAG_DATA_VALID = 1 # Cleared for reads of cleared memory
+FLAG_PC_VALID = 2   # Cleared for records before the first instruction fetch
+
+# Header: magic, version, record size, (reserved)
+_trace_header = struct.Struct("<8sHHI")
+# Header: magic, version, number of records indexed
+_index_header = struct.Struct("<8sHxxxxxxQ")
+
+CHUNK_SIZE = 65536
+
+_reg_indices = {
+    "$pc": OPA_PC,
+    "$sp": OPA_SP,
+    "$r0": OPA_R0,
+    "$r1": OPA_R1,
+}
+_reg_names = {idx: name for name, idx in _reg_indices.items()}
+
+_mem_kinds = (TraceKind.fetch, TraceKind.read, TraceKind.write)
+
+def index_path(trace_path: str) -> str:
+    return trace_path + ".idx"
+
+class BinaryTraceSink(TraceSinkBase):
+    def __init__(self, path: str, level: TraceLevel = TraceLevel.bus, *, chunk_size: int = CHUNK_SIZE):
+        super().__init__(level)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.records: List[Tuple[int, int, int, int, int, int, int]] = []
+        self.pc = 0
+        self.pc_flag = 0
+        self.file = open(path, "wb")
+        self.file.write(_trace_header.pack(TRACE_MAGIC, TRACE_VERSION, RECORD_DTYPE.itemsize, 0))
+
+    def emit(self, cycle: int, event: 'SimEventBase') -> None:
+        kind = event.kind
+        if kind == TraceKind.fetch:
+            self.pc = event.addr & 0xffff
+            self.pc_flag = FLAG_PC_VALID
+            # The bus read of the instruction word is reported before the fetch itself; it belongs to the new instruction.
+            if len(self.records) > 0:
+                prev = self.records[-1]
+                if prev[0] == cycle and prev[1] == TraceKind.read and prev[4] == self.pc:
+                    self.records[-1] = (prev[0], prev[1], prev[2] | FLAG_PC_VALID, self.pc) + prev[4:]
+            record = (cycle, kind, self.pc_flag | (event.data is not None), self.pc, self.pc, (event.data or 0) & 0xffff, 0)
+        elif kind == TraceKind.read or kind == TraceKind.write:
+            record = (cycle, kind, self.pc_flag | (event.data is not None), self.pc, event.addr & 0xffff, (event.data or 0) & 0xffff, 0)
+        elif kind == TraceKind.register:
+            record = (cycle, kind, self.pc_flag | FLAG_DATA_VALID, self.pc, _reg_indices[event.reg_name], event.data & 0xffff, event.old_data & 0xffff)
+        elif kind == TraceKind.terminate:
+            record = (cycle, kind, self.pc_flag | FLAG_DATA_VALID, self.pc, 0, event.exit_code & 0xffff, 0)
+        else:
+            return
+        self.records.append(record)
+        if len(self.records) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.records) == 0:
+            return
+        np.array(self.records, dtype=RECORD_DTYPE).tofile(self.file)
+        self.records = []
+
+    def close(self) -> None:
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+        write_index(self.path)
+
+def open_records(path: str) -> np.ndarray:
+    with open(path, "rb") as f:
+        magic, version, record_size, _ = _trace_header.unpack(f.read(_trace_header.size))
+    if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} is not a version {TRACE_VERSION} trace file")
+    if os.path.getsize(path) == _trace_header.size:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=_trace_header.size)
+
+def _sorted_by(keys: np.ndarray, selection: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Returns the selected record numbers, sorted by key, and the offset of each key value in that list
+    selected_keys = keys[selection]
+    order = selection[np.argsort(selected_keys, kind="stable")].astype(np.uint64)
+    offsets = np.zeros(0x10001, dtype=np.uint64)
+    np.cumsum(np.bincount(selected_keys, minlength=0x10000), out=offsets[1:])
+    return offsets, order
+
+def write_index(path: str) -> None:
+    records = open_records(path)
+    pc_offsets, pc_order = _sorted_by(records["pc"], np.flatnonzero(records["flags"] & FLAG_PC_VALID))
+    addr_offsets, addr_order = _sorted_by(records["addr"], np.flatnonzero(np.isin(records["kind"], _mem_kinds)))
+    with open(index_path(path), "wb") as f:
+        f.write(_index_header.pack(INDEX_MAGIC, TRACE_VERSION, len(records)))
+        for section in (pc_offsets, addr_offsets, pc_order, addr_order):
+            section.tofile(f)
+
+class TraceFile(object):
+    def __init__(self, path: str):
+        self.path = path
+        self.records = open_records(path)
+        if not self._load_index():
+            write_index(path)
+            assert self._load_index()
+
+    def _load_index(self) -> bool:
+        idx_path = index_path(self.path)
+        if not os.path.exists(idx_path):
+            return False
+        with open(idx_path, "rb") as f:
+            header = f.read(_index_header.size)
+        if len(header) != _index_header.size:
+            return False
+        magic, version, record_count = _index_header.unpack(header)
+        if magic != INDEX_MAGIC or version != TRACE_VERSION or record_count != len(self.records):
+            return False
+        index = np.memmap(idx_path, dtype=np.uint64, mode="r", offset=_index_header.size)
+        self.pc_offsets = index[:0x10001]
+        self.addr_offsets = index[0x10001:0x20002]
+        pc_count = int(self.pc_offsets[-1])
+        self.pc_order = index[0x20002:0x20002+pc_count]
+        self.addr_order = index[0x20002+pc_count:]
+        return True
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def at_pc(self, pc: int, kind: Optional[TraceKind] = None) -> np.ndarray:
+        # All records (optionally of a given kind) generated while executing the instruction at 'pc'
+        pc &= 0xffff
+        selection = self.pc_order[int(self.pc_offsets[pc]):int(self.pc_offsets[pc+1])]
+        return self._select(selection, kind)
+
+    def at_addr(self, addr: int, kind: Optional[TraceKind] = None) -> np.ndarray:
+        # All fetches, reads and writes (or just the ones of 'kind') of memory location 'addr'
+        addr &= 0xffff
+        selection = self.addr_order[int(self.addr_offsets[addr]):int(self.addr_offsets[addr+1])]
+        return self._select(selection, kind)
+
+    def between(self, start_cycle: int, end_cycle: int, kind: Optional[TraceKind] = None) -> np.ndarray:
+        # All records in the [start_cycle, end_cycle) range. Records are in cycle order, so this is a binary search.
+        cycles = self.records["cycle"]
+        start, end = np.searchsorted(cycles, (start_cycle, end_cycle))
+        records = self.records[start:end]
+        if kind is not None:
+            records = records[records["kind"] == kind]
+        return records
+
+    def last_cycle_at_pc(self, pc: int) -> Optional[int]:
+        records = self.at_pc(pc, TraceKind.fetch)
+        return int(records["cycle"][-1]) if len(records) > 0 else None
+
+    def _select(self, selection: np.ndarray, kind: Optional[TraceKind]) -> np.ndarray:
+        records = self.records[selection.astype(np.intp)]
+        if kind is not None:
+            records = records[records["kind"] == kind]
+        return records
+
+def format_record(record: np.void) -> str:
+    kind = TraceKind(int(record["kind"]))
+    flags = int(record["flags"])
+    pc = f"0x{int(record['pc']):04x}" if flags & FLAG_PC_VALID else "------"
+    data = f"0x{int(record['data']):04x}" if flags & FLAG_DATA_VALID else "*NONE*"
+    addr = int(record["addr"])
+    if kind == TraceKind.fetch:
+        detail = f"inst fetch from 0x{addr:04x}: {data}"
+    elif kind == TraceKind.read:
+        detail = f"read MEM[0x{addr:04x}] returned {data}"
+    elif kind == TraceKind.write:
+        detail = f"write MEM[0x{addr:04x}] to {data}"
+    elif kind == TraceKind.register:
+        detail = f"reg {_reg_names[addr]} updated from 0x{int(record['old']):04x} to {data}"
+    elif kind == TraceKind.terminate:
+        detail = f"TERMINATED WITH CODE: {data}"
+    else:
+        detail = kind.name
+    return f"{int(record['cycle']):10d}  {pc}  {detail}"
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Query a binary simulator trace")
+    parser.add_argument("trace", help="trace file, as written by BinaryTraceSink")
+    parser.add_argument("--pc", type=lambda x: int(x, 0), help="only records of the instruction at this address")
+    parser.add_argument("--addr", type=lambda x: int(x, 0), help="only accesses to this memory address")
+    parser.add_argument("--kind", choices=[kind.name for kind in TraceKind], help="only records of this kind")
+    parser.add_argument("--cycles", help="only records in the START:END cycle range")
+    parser.add_argument("--first", action="store_true", help="only print the first matching record")
+    parser.add_argument("--last", action="store_true", help="only print the last matching record")
+    parser.add_argument("--count", action="store_true", help="only print the number of matching records")
+    args = parser.parse_args(argv)
+
+    trace = TraceFile(args.trace)
+    start, end = 0, (1 << 64) - 1
+    if args.cycles is not None:
+        start_str, _, end_str = args.cycles.partition(":")
+        start = int(start_str, 0) if start_str != "" else start
+        end = int(end_str, 0) if end_str != "" else end
+    # Pick the candidates through the most selective index, then filter the rest
+    if args.pc is not None:
+        records = trace.at_pc(args.pc)
+        if args.addr is not None:
+            records = records[(records["addr"] == args.addr & 0xffff) & np.isin(records["kind"], _mem_kinds)]
+    elif args.addr is not None:
+        records = trace.at_addr(args.addr)
+    else:
+        records = trace.between(start, end)
+    if args.kind is not None:
+        records = records[records["kind"] == TraceKind[args.kind]]
+    if args.cycles is not None and (args.pc is not None or args.addr is not None):
+        records = records[(records["cycle"] >= start) & (records["cycle"] < end)]
+
+    if args.count:
+        print(len(records))
+        return
+    if args.first:
+        records = records[:1]
+    elif args.last:
+        records = records[-1:]
+    for record in records:
+        print(format_record(record))
+
+if __name__ == "__main__":
+    main()
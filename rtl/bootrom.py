@@ -0,0 +1,65 @@
+# Boot ROM overlay (see isa/micro_architecture.md)
+#
+# After reset, the boot ROM answers instruction fetches (the cycles where the CPU drives
+# 'inst_load') in its address range, while data reads and writes still go to core memory.
+# Setting bit0 of the boot-memory swap register (0xffff) switches it out until the next reset.
+#
+# Fetches are taken straight from the ROM by the Processor (see Processor._fetch and
+# Processor.step), without going through the bus: the CPU holds a reference to the ROM
+# while it's enabled, and None otherwise. The write-back that follows every fetch goes to
+# the ROM too, and is ignored, so core memory underneath is left alone.
+#
+# The ROM also answers the reset vector read (and ignores its write-back), with its own
+# address, so a reset while it's enabled starts executing the ROM, whatever core memory
+# holds. This allows simulating a cold boot, with core memory left empty.
+#
+# 0xffff is also where the simulator's Terminator lives. While the ROM is enabled, the
+# address belongs to the swap register; once it's swapped out, writes terminate again.
+
+from typing import *
+
+from iomap import BOOT_SWAP_ADDR
+
+class BootRom(object):
+    def __init__(self, system: 'System', base_addr: int, words: Sequence[int]):
+        assert 0 <= base_addr and base_addr + len(words) <= BOOT_SWAP_ADDR
+        self.system = system
+        self.base_addr = base_addr
+        self.end_addr = base_addr + len(words)
+        self.words = tuple(word & 0xffff for word in words)
+        self.enabled = False
+        self.swap_handlers: Optional[Tuple[Callable, Callable]] = None # Handlers of 0xffff while we're out
+        self.reset()
+        system.add_device("boot_rom", self)
+
+    def reset(self) -> None:
+        self._enable(True)
+
+    def get_state(self) -> bool:
+        return self.enabled
+
+    def set_state(self, state: bool) -> None:
+        self._enable(state)
+
+    def fork(self, system: 'System') -> 'BootRom':
+        rom = BootRom(system, self.base_addr, self.words)
+        rom.set_state(self.get_state())
+        return rom
+
+    def _enable(self, enabled: bool) -> None:
+        bus = self.system.bus
+        if enabled and not self.enabled:
+            self.swap_handlers = (bus.readers[BOOT_SWAP_ADDR], bus.writers[BOOT_SWAP_ADDR])
+            bus.readers[BOOT_SWAP_ADDR] = self._read_swap
+            bus.writers[BOOT_SWAP_ADDR] = self._write_swap
+        elif not enabled and self.enabled:
+            bus.readers[BOOT_SWAP_ADDR], bus.writers[BOOT_SWAP_ADDR] = self.swap_handlers
+            self.swap_handlers = None
+        self.enabled = enabled
+        self.system.cpu.boot_rom = self if enabled else None
+
+    def _read_swap(self, addr: int) -> int:
+        return 0
+    def _write_swap(self, addr: int, data: Optional[int]) -> None:
+        if data is not None and data & 1:
+            self._enable(False)
@@ -0,0 +1,238 @@
+# Pre-decoded instruction table
+#
+# Every one of the 65536 possible instruction words is decoded once, at import time.
+# Both the simulator and the disassembler use this table instead of slicing up
+# instruction words on every use.
+
+from constants import *
+from typing import *
+
+def _make_signed(data: int, bit_size: int) -> int:
+    mask = (1 << bit_size) - 1
+    sign_mask = 1 << (bit_size -1)
+    data &= mask
+    if data & sign_mask != 0:
+        # negative, we calculate the absolute value,
+        # then negate that to restore the proper signage
+        return -((~data + 1) & mask)
+    else:
+        return data
+
+def _rol(data: int) -> int:
+    return ((data << 1) & 0xfffe) | ((data >> 15) & 1)
+
+def _ror(data: int) -> int:
+    return ((data >> 1) & 0x7fff) | ((data & 1) << 15)
+
+def _signed16(data: int) -> int:
+    return _make_signed(data, 16)
+
+
+########################################################
+# Disassembly
+########################################################
+
+opa_names = {
+    OPA_PC: "$pc",
+    OPA_SP: "$sp",
+    OPA_R0: "$r0",
+    OPA_R1: "$r1"
+}
+
+def _format_opa(opa: int) -> str:
+    return opa_names[opa]
+
+opb_formats = {
+    OPB_MEM_IMMED_PC: "[$pc{s}{}]",
+    OPB_MEM_IMMED_SP: "[$sp{s}{}]",
+    OPB_MEM_IMMED_R0: "[$r0{s}{}]",
+    OPB_MEM_IMMED: "[{}]",
+    OPB_IMMED_PC: "$pc{s}{}",
+    OPB_IMMED_SP: "$sp{s}{}",
+    OPB_IMMED_R0: "$r0{s}{}",
+    OPB_IMMED: "{}",
+}
+
+def _format_opb(opb: int, immed: int) -> str:
+    sign = "+" if immed >= 0 else ""
+    return opb_formats[opb].replace("{s}",sign).replace("{}", str(immed))
+
+inst_formats = {
+    INST_SWAP  : ("SWAPI {opa}, {opb}", "SWAP {opa}, {opb}"),
+    INST_OR    : ("OR {opa}, {opb}", "OR {opb}, {opa}"),
+    INST_AND   : ("AND {opa}, {opb}", "AND {opb}, {opa}"),
+    INST_XOR   : ("XOR {opa}, {opb}", "XOR {opb}, {opa}"),
+    INST_UNK   : ("**** UNK **** {opa}, {opb}", "**** UNK **** {opb}, {opa}"),
+    INST_ADD   : ("ADD {opa}, {opb}", "ADD {opb}, {opa}"),
+    INST_SUB   : ("SUB {opa}, {opb}", "ISUB {opb}, {opa}"),
+    INST_ISUB  : ("ISUB {opa}, {opb}", "SUB {opb}, {opa}"),
+    INST_MOV   : ("MOV {opa}, {opb}", "MOV {opb}, {opa}"),
+    INST_ISTAT : ("ISTAT {opa}", "ISTAT {opb}"),
+    INST_ROR   : ("ROR {opa}", "ROR {opb}"),
+    INST_ROL   : ("ROL {opa}", "ROL {opb}"),
+    INST_EQ    : ("IF_EQ {opa}, {opb}", "IF_NEQ {opa}, {opb}"),
+    INST_LTU   : ("IF_LTU {opa}, {opb}", "IF_GEU {opa}, {opb}"),
+    INST_LTS   : ("IF_LTS {opa}, {opb}", "IF_GES {opa}, {opb}"),
+    INST_LES   : ("IF_LES {opa}, {opb}", "IF_GTS {opa}, {opb}"),
+}
+
+def format_inst(opcode: int, d: int, opb: int, opa: int, immed: int) -> str:
+    opa_str = _format_opa(opa)
+    opb_str = _format_opb(opb, immed)
+    return inst_formats[opcode][d].replace("{opa}", opa_str).replace("{opb}", opb_str)
+
+
+########################################################
+# ALU handlers
+#
+# Each handler takes the A and B operands and the interrupt
+# enable state and returns the ALU result (None for predicates)
+# and whether the next instruction should be executed
+# (False if it's to be skipped by a predicate).
+########################################################
+
+AluHandler = Callable[[int, int, bool], Tuple[Optional[int], bool]]
+
+def _alu_swap(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return alu_opa, True
+def _alu_swap_pc(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return alu_opa + 1, True
+def _alu_or(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return alu_opa | alu_opb, True
+def _alu_and(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return alu_opa & alu_opb, True
+def _alu_xor(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return alu_opa ^ alu_opb, True
+def _alu_add(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return (alu_opa + alu_opb) & 0xffff, True
+def _alu_sub(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return (alu_opa - alu_opb) & 0xffff, True
+def _alu_isub(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return (alu_opb - alu_opa) & 0xffff, True
+def _alu_pass_a(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return alu_opa, True
+def _alu_pass_b(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return alu_opb, True
+def _alu_istat(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return 2 if inten else 0, True
+def _alu_ror_a(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return _ror(alu_opa), True
+def _alu_ror_b(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return _ror(alu_opb), True
+def _alu_rol_a(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return _rol(alu_opa), True
+def _alu_rol_b(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return _rol(alu_opb), True
+def _alu_eq(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return None, alu_opa == alu_opb
+def _alu_neq(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return None, alu_opa != alu_opb
+def _alu_ltu(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return None, alu_opa < alu_opb
+def _alu_geu(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return None, alu_opa >= alu_opb
+def _alu_lts(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return None, _signed16(alu_opa) < _signed16(alu_opb)
+def _alu_ges(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return None, _signed16(alu_opa) >= _signed16(alu_opb)
+def _alu_les(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return None, _signed16(alu_opa) <= _signed16(alu_opb)
+def _alu_gts(alu_opa: int, alu_opb: int, inten: bool) -> Tuple[Optional[int], bool]:
+    return None, _signed16(alu_opa) > _signed16(alu_opb)
+
+# Handlers, indexed by opcode and the 'D' bit. SWAP is special-cased, since it depends on OPA
+alu_handlers = {
+    INST_OR    : (_alu_or,     _alu_or),
+    INST_AND   : (_alu_and,    _alu_and),
+    INST_XOR   : (_alu_xor,    _alu_xor),
+    INST_UNK   : (_alu_pass_a, _alu_pass_a), # this is an unused instruction code, but I don't want the simulator to blow up if it encounters it
+    INST_ADD   : (_alu_add,    _alu_add),
+    INST_SUB   : (_alu_sub,    _alu_sub),
+    INST_ISUB  : (_alu_isub,   _alu_isub),
+    INST_MOV   : (_alu_pass_b, _alu_pass_a),
+    INST_ISTAT : (_alu_istat,  _alu_istat),
+    INST_ROR   : (_alu_ror_a,  _alu_ror_b),
+    INST_ROL   : (_alu_rol_a,  _alu_rol_b),
+    INST_EQ    : (_alu_eq,     _alu_neq),
+    INST_LTU   : (_alu_ltu,    _alu_geu),
+    INST_LTS   : (_alu_lts,    _alu_ges),
+    INST_LES   : (_alu_les,    _alu_gts),
+}
+
+
+########################################################
+# The decode table
+########################################################
+
+# Number of clock cycles an instruction takes in Processor.clock
+INST_CYCLES = 6
+SWAP_INST_CYCLES = 7
+
+# The clock cycles of an instruction (and the reset sequence) in Processor.clock.
+# PHASE_SWAP is only used by SWAP/SWAPI.
+PHASE_FETCH             = 0
+PHASE_WRITE_BACK_INST   = 1
+PHASE_DECODE            = 2
+PHASE_SWAP              = 3
+PHASE_WRITE_BACK_OPB    = 4
+PHASE_EXECUTE           = 5
+PHASE_UPDATE_PC         = 6
+PHASE_RESET_READ        = 7
+PHASE_RESET_WRITE_BACK  = 8
+PHASE_RESET_SET_PC      = 9
+
+_predicates = (INST_EQ, INST_LTU, INST_LTS, INST_LES)
+_mem_refs = (OPB_MEM_IMMED_PC, OPB_MEM_IMMED_SP, OPB_MEM_IMMED_R0, OPB_MEM_IMMED)
+
+class DecodedInst(NamedTuple):
+    opcode: int
+    d: int
+    opb: int
+    opa: int
+    immed: int        # sign-extended
+    mem_ref: bool     # operand B is read from memory
+    mem_result: bool  # the result is written to memory
+    reg_result: bool  # the result is written to the register selected by OPA
+    is_swap: bool
+    is_predicate: bool
+    alu: AluHandler
+    cycles: int
+    disasm: str
+
+def _build_decode_table() -> List[DecodedInst]:
+    # The immediate field is the lowest bits of the instruction, so we decode everything
+    # above it once and only iterate through the immediates in the inner loop.
+    assert IMMED_OFS == 0
+    table = []
+    immeds = tuple(_make_signed(raw_immed, IMMED_MASK.bit_length()) for raw_immed in range(IMMED_MASK+1))
+    opb_strs = {opb: tuple(_format_opb(opb, immed) for immed in immeds) for opb in opb_formats}
+    for upper in range(1 << (16 - IMMED_SIZE)):
+        inst = upper << IMMED_SIZE
+        opcode = (inst >> OPCODE_OFS) & OPCODE_MASK
+        d = (inst >> D_OFS) & D_MASK
+        opb = (inst >> OPB_OFS) & OPB_MASK
+        opa = (inst >> OPA_OFS) & OPA_MASK
+        is_swap = opcode == INST_SWAP
+        is_predicate = opcode in _predicates
+        mem_ref = opb in _mem_refs
+        mem_result = (d == 1 or is_swap) and not is_predicate
+        reg_result = (d == 0 or is_swap) and not is_predicate
+        if is_swap:
+            alu_handler = _alu_swap_pc if opa == OPA_PC else _alu_swap
+        else:
+            alu_handler = alu_handlers[opcode][d]
+        cycles = SWAP_INST_CYCLES if is_swap else INST_CYCLES
+        inst_format = inst_formats[opcode][d].replace("{opa}", _format_opa(opa))
+        for immed, opb_str in zip(immeds, opb_strs[opb]):
+            table.append(DecodedInst(
+                opcode, d, opb, opa, immed,
+                mem_ref, mem_result, reg_result, is_swap, is_predicate,
+                alu_handler, cycles,
+                inst_format.replace("{opb}", opb_str)
+            ))
+    return table
+
+decode_table: List[DecodedInst] = _build_decode_table()
+
+def decode(inst: int) -> DecodedInst:
+    return decode_table[inst & 0xffff]
@@ -0,0 +1,161 @@
+# A regression farm: runs many programs on the simulator in parallel
+#
+# Programs are distributed over a pool of worker processes. Each worker creates a
+# single System at start-up (which also means the decode tables are built only once
+# per worker) and resets it between programs. Programs are run in fast mode with no
+# tracing and idle loops skipped (see idle.py); the results are collected in order into
+# a FarmReport.
+#
+#    python farm.py test1.asm test2.asm ...
+
+from typing import *
+from concurrent.futures import ProcessPoolExecutor
+import traceback
+import time
+import sys
+import os
+
+from asm import assemble
+from trace import NullTraceSink
+from sim import System, MemoryDifference
+
+class FarmProgram(object):
+    def __init__(
+        self,
+        name: str,
+        asm: Optional[str] = None,
+        *,
+        image: Optional[Tuple[int, Sequence[int]]] = None,
+        preload: Optional[Dict[int, Sequence[int]]] = None,
+        expected: Optional[Dict[int, Sequence[int]]] = None,
+        clock_count: int = 1000000,
+        translate: bool = True,
+    ):
+        # 'image' is an already assembled program: (base address, words), as returned by asm.assemble.
+        # 'preload' is loaded into memory before 'asm' or 'image' (typically to set the reset vector).
+        # If 'expected' is given, the final memory content is compared against it.
+        assert asm is None or image is None
+        self.name = name
+        self.asm = asm
+        self.image = image
+        self.preload = preload if preload is not None else {}
+        self.expected = expected
+        self.clock_count = clock_count
+        self.translate = translate
+
+class FarmResult(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.terminated = False
+        self.exit_code: Optional[int] = None
+        self.clk_count = 0
+        self.differences: Optional[List[MemoryDifference]] = None # None if there was nothing to compare to
+        self.error: Optional[str] = None
+        self.elapsed = 0.0
+        self.worker = os.getpid()
+
+    @property
+    def passed(self) -> bool:
+        return (
+            self.error is None and
+            self.terminated and
+            self.exit_code == 0 and
+            not self.differences
+        )
+
+    def __str__(self) -> str:
+        if self.error is not None:
+            status = "ERROR"
+        elif not self.terminated:
+            status = "TIMEOUT"
+        elif self.passed:
+            status = "PASS"
+        else:
+            status = "FAIL"
+        ret_val = f"{status:8}{self.name} ({self.clk_count} cycles, {self.elapsed:.3f}s)"
+        if self.terminated and self.exit_code != 0:
+            ret_val += f"\n        exit code: {self.exit_code}"
+        for difference in self.differences or ():
+            ret_val += f"\n        {difference}"
+        if self.error is not None:
+            ret_val += "\n        " + self.error.rstrip().replace("\n", "\n        ")
+        return ret_val
+
+class FarmReport(object):
+    def __init__(self, results: Sequence[FarmResult], elapsed: float):
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def passed(self) -> List[FarmResult]:
+        return [result for result in self.results if result.passed]
+
+    @property
+    def failed(self) -> List[FarmResult]:
+        return [result for result in self.results if not result.passed]
+
+    def __str__(self) -> str:
+        lines = [str(result) for result in self.results]
+        total_clks = sum(result.clk_count for result in self.results)
+        lines.append("********************************")
+        lines.append(f"{len(self.passed)} passed, {len(self.failed)} failed, {total_clks} cycles in {self.elapsed:.2f}s")
+        return "\n".join(lines)
+
+########################################
+# Worker side
+########################################
+_system: Optional[System] = None
+
+def _init_worker() -> None:
+    global _system
+    _system = System(NullTraceSink(), skip_idle=True)
+
+def run_program(program: FarmProgram, system: Optional[System] = None) -> FarmResult:
+    # Runs a single program. Without a 'system', the worker's (or a new) System instance is used.
+    if system is None:
+        if _system is None:
+            _init_worker()
+        system = _system
+    result = FarmResult(program.name)
+    start = time.perf_counter()
+    try:
+        system.reset()
+        for base_addr, words in program.preload.items():
+            system.load(base_addr, words)
+        if program.asm is not None:
+            system.load_asm(program.asm)
+        if program.image is not None:
+            system.load(*program.image)
+        system.simulate_fast(program.clock_count, translate=program.translate)
+        result.terminated = system.terminated
+        result.exit_code = system.term.exit_code
+        result.clk_count = system.clk_count
+        if program.expected is not None:
+            result.differences = system.mem.diff(program.expected)
+    except Exception:
+        result.error = traceback.format_exc()
+    result.elapsed = time.perf_counter() - start
+    return result
+
+########################################
+# Farm side
+########################################
+def run_programs(programs: Sequence[FarmProgram], max_workers: Optional[int] = None, chunksize: int = 1) -> FarmReport:
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+        results = list(executor.map(run_program, programs, chunksize=chunksize))
+    return FarmReport(results, time.perf_counter() - start)
+
+def program_from_file(file_name: str) -> FarmProgram:
+    # The reset vector is pointed to the start of the program. Without an expected memory
+    # image, only the exit code is checked.
+    with open(file_name, "rt") as f:
+        asm = f.read()
+    base_addr, words = assemble(asm)
+    return FarmProgram(file_name, image=(base_addr, words), preload={0: (base_addr,)})
+
+if __name__ == "__main__":
+    programs = [program_from_file(file_name) for file_name in sys.argv[1:]]
+    report = run_programs(programs)
+    print(report)
+    sys.exit(0 if len(report.failed) == 0 else 1)
@@ -0,0 +1,228 @@
+# High-level emulation (HLE) of well-known loops
+#
+# Bit-banged I/O spends most of its time in loops that burn dozens of instructions per
+# symbol: delays between samples, waiting for edges, shifting in bits. An HleRoutine
+# recognizes such a loop by its address and code and performs the effect of (some number
+# of) trips around it in one go, returning the clock cycles that took.
+#
+# Routines are only tried on instruction boundaries, with interrupts not pending, and
+# are given a clock budget: they must not run past the next scheduled device event (or the
+# end of the simulation), so the inputs they see can't change under them. A routine is free
+# to do less than the whole loop, or to decline by returning None; execution then continues
+# instruction-by-instruction.
+#
+# With 'verify' set, every HLE step is checked against full simulation of the same
+# number of clock cycles in a fork of the system (see System.fork).
+
+from typing import *
+
+from asm import assemble
+from decode import decode_table, PHASE_FETCH
+from iomap import SERIAL_RXT_ADDR, TAPE_PLAYBACK_ADDR
+
+class HleMismatch(Exception):
+    def __init__(self, message: str):
+        self.message = message
+    def __str__(self) -> str:
+        return self.message
+
+class HleRoutine(object):
+    def __init__(self, name: str, addr: int, code: Sequence[int], handler: Callable[['System', int], Optional[int]]):
+        # 'handler' is called with the system and the clock budget when $pc is at 'addr' and memory
+        # holds 'code' there. It updates the state of the system the same way executing the code
+        # would, and returns the number of clock cycles that took (or None if it did nothing).
+        self.name = name
+        self.addr = addr
+        self.code = tuple(code)
+        self.handler = handler
+        self.hits = 0
+        self.cycles = 0
+
+    def __str__(self) -> str:
+        return f"{self.name} at 0x{self.addr:04x}: {self.hits} hits, {self.cycles} cycles"
+
+class HleTable(object):
+    def __init__(self, system: 'System', *, verify: bool = False):
+        self.system = system
+        self.routines: Dict[int, HleRoutine] = {}
+        self.pc_map = bytearray(0x10000)
+        self.verify = verify
+
+    def register(self, routine: HleRoutine) -> None:
+        mem = self.system.mem
+        assert mem.base_addr <= routine.addr and routine.addr + len(routine.code) <= mem.base_addr + mem.size
+        assert routine.addr not in self.routines, f"there's already an HLE routine at 0x{routine.addr:04x}"
+        self.routines[routine.addr] = routine
+        self.pc_map[routine.addr] = 1
+
+    def unregister(self, routine: HleRoutine) -> None:
+        del self.routines[routine.addr]
+        self.pc_map[routine.addr] = 0
+
+    def step(self, clock_budget: int) -> Optional[int]:
+        # Runs the routine at $pc, if there's one and it's applicable. Returns the number of clock cycles
+        # elapsed, or None if the current instruction is to be executed normally.
+        system = self.system
+        cpu = system.cpu
+        routine = self.routines[cpu.pc]
+        if cpu.in_reset or cpu.phase != PHASE_FETCH or (cpu.interrupt_pending and cpu.inten) or cpu.boot_rom is not None:
+            return None
+        if tuple(system.mem.read_slice(routine.addr, routine.addr + len(routine.code))) != routine.code:
+            return None
+        if not self.verify:
+            return self._run(routine, clock_budget)
+        reference = system.fork()
+        try:
+            cycles = self._run(routine, clock_budget)
+            if cycles is not None:
+                self._verify(routine, reference, cycles)
+        finally:
+            reference.close()
+        return cycles
+
+    def _run(self, routine: HleRoutine, clock_budget: int) -> Optional[int]:
+        cycles = routine.handler(self.system, clock_budget)
+        if not cycles:
+            return None
+        routine.hits += 1
+        routine.cycles += cycles
+        return cycles
+
+    def wrap(self, step: Callable[[int], int]) -> Callable[[int], int]:
+        # Returns a step function (see System.simulate_fast) that tries HLE routines before 'step'
+        pc_map = self.pc_map
+        cpu = self.system.cpu
+        def hle_step(clock_budget: int) -> int:
+            if pc_map[cpu.pc]:
+                cycles = self.step(clock_budget)
+                if cycles is not None:
+                    return cycles
+            return step(clock_budget)
+        return hle_step
+
+    def _verify(self, routine: HleRoutine, reference: 'System', cycles: int) -> None:
+        system = self.system
+        clk_count = 0
+        while clk_count < cycles and not reference.stop_requested:
+            clk_count += reference.cpu.step()
+        def mismatch(what: str) -> HleMismatch:
+            return HleMismatch(f"HLE routine {routine.name} at 0x{routine.addr:04x} (cycle {system.clk_count}): {what}")
+        if clk_count != cycles:
+            raise mismatch(f"took {cycles} cycles, full simulation {clk_count}")
+        for name in ("pc", "sp", "r0", "r1", "inten"):
+            if getattr(system.cpu, name) != getattr(reference.cpu, name):
+                raise mismatch(f"${name} is {getattr(system.cpu, name)}, full simulation gives {getattr(reference.cpu, name)}")
+        if system.stop_requested != reference.stop_requested:
+            raise mismatch("stop request differs")
+        if system.mem.get_state() != reference.mem.get_state():
+            raise mismatch("memory differs from full simulation")
+        for name, port in system.io_ports.items():
+            if port.get_state() != reference.io_ports[name].get_state():
+                raise mismatch(f"port {name} is {port.get_state()}, full simulation gives {reference.io_ports[name].get_state()}")
+
+########################################
+# Common loops
+########################################
+def delay_loop(addr: int, reg: str = "$r1") -> HleRoutine:
+    # The usual count-down delay:
+    #     sub  <reg>, 1
+    #     if_neq <reg>, 0
+    #     mov  $pc, $pc-2
+    # Runs all but the last trip (which exits the loop) as long as they fit the clock budget.
+    attr = {"$sp": "sp", "$r0": "r0", "$r1": "r1"}[reg]
+    base_addr, code = assemble(f".section TEXT {addr}\nsub {reg}, 1\nif_neq {reg}, 0\nmov $pc, $pc-2\n")
+    assert base_addr == addr
+    loop_cycles = sum(decode_table[word].cycles for word in code)
+    def handler(system: 'System', clock_budget: int) -> Optional[int]:
+        cpu = system.cpu
+        count = getattr(cpu, attr) or 0x10000
+        trips = min(count - 1, clock_budget // loop_cycles)
+        if trips <= 0:
+            return None
+        setattr(cpu, attr, count - trips)
+        return trips * loop_cycles
+    return HleRoutine(f"delay_loop({reg})", addr, code, handler)
+
+def serial_receive_loop(addr: int) -> HleRoutine:
+    # The bit loop of a bit-banged serial receiver, entered in the middle of the first data bit:
+    #     mov  $r1, [SERIAL_RXT_ADDR]
+    #     and  $r1, 1
+    #     or   [$sp], $r1
+    #     ror  [$sp]
+    #     mov  $r1, [$sp+1]    ; bit-time delay
+    #     sub  $r1, 1
+    #     if_neq $r1, 0
+    #     mov  $pc, $pc-2
+    #     sub  $r0, 1
+    #     if_neq $r0, 0
+    #     mov  $pc, $pc-10
+    # $r0 counts the bits, [$sp] collects them (LSB first, ending up in the top of the word) and
+    # [$sp+1] holds the delay count. RXT is an input port that only changes on device events,
+    # so it can't change within the clock budget: all but the last trip are done in one go, as
+    # long as they fit. A line model that wakes up every bit-time leaves less than a trip of
+    # budget, so what's left is spent on the next sample and as much of the delay after it as
+    # fits, stopping in the delay loop; register a delay_loop at 'addr'+5 for the rest.
+    base_addr, code = assemble(
+        f".section TEXT {addr}\n"
+        f"mov $r1, [{SERIAL_RXT_ADDR - 0x10000}]\nand $r1, 1\nor [$sp], $r1\nror [$sp]\nmov $r1, [$sp+1]\n"
+        f"sub $r1, 1\nif_neq $r1, 0\nmov $pc, $pc-2\n"
+        f"sub $r0, 1\nif_neq $r0, 0\nmov $pc, $pc-10\n"
+    )
+    assert base_addr == addr
+    cycles = [decode_table[word].cycles for word in code]
+    sample_cycles = sum(cycles[0:5])
+    delay_cycles = sum(cycles[5:8])
+    # The last delay trip skips the jump back
+    count_cycles = sum(cycles[8:11]) - cycles[7]
+    def handler(system: 'System', clock_budget: int) -> Optional[int]:
+        cpu = system.cpu
+        mem = system.mem
+        sp = cpu.sp
+        if not (mem.base_addr <= sp and sp + 1 < mem.base_addr + mem.size):
+            return None
+        acc = mem.peek(sp)
+        delay = mem.peek(sp + 1)
+        if acc is None or delay is None:
+            return None
+        delay = delay or 0x10000
+        loop_cycles = sample_cycles + delay * delay_cycles + count_cycles
+        count = cpu.r0 or 0x10000
+        trips = min(count - 1, clock_budget // loop_cycles)
+        # Delay trips of the unfinished one
+        partial = min(delay - 1, (clock_budget - trips * loop_cycles - sample_cycles) // delay_cycles)
+        if trips <= 0 and partial <= 0:
+            return None
+        bit = system.io_ports["serial_rxt"].value & 1
+        for _ in range(trips + (partial > 0)):
+            acc |= bit
+            acc = (acc >> 1) | ((acc & 1) << 15)
+        mem.read(sp)
+        mem.write(sp, acc)
+        cpu.r0 = (count - trips) & 0xffff
+        if partial <= 0:
+            cpu.r1 = 0
+            return trips * loop_cycles
+        cpu.r1 = delay - partial
+        cpu.pc = addr + 5
+        return trips * loop_cycles + sample_cycles + partial * delay_cycles
+    return HleRoutine("serial_receive_loop", addr, code, handler)
+
+def tape_edge_wait(addr: int, reg: str = "$r1") -> HleRoutine:
+    # Waits for the tape playback port to change from the value in <reg>:
+    #     if_eq <reg>, [TAPE_PLAYBACK_ADDR]
+    #     mov  $pc, $pc-1
+    # The port changes only in the edge wake-ups the tape drive posts on the event queue (see
+    # TapeDrive._post_edge), and the clock budget ends at the next event, so the loop is run
+    # up to the last trip before the edge (or whatever else is due first).
+    attr = {"$sp": "sp", "$r0": "r0", "$r1": "r1"}[reg]
+    base_addr, code = assemble(f".section TEXT {addr}\nif_eq {reg}, [{TAPE_PLAYBACK_ADDR - 0x10000}]\nmov $pc, $pc-1\n")
+    assert base_addr == addr
+    loop_cycles = sum(decode_table[word].cycles for word in code)
+    def handler(system: 'System', clock_budget: int) -> Optional[int]:
+        if getattr(system.cpu, attr) != system.io_ports["tape_playback"].value:
+            return None
+        trips = clock_budget // loop_cycles
+        if trips <= 0:
+            return None
+        return trips * loop_cycles
+    return HleRoutine(f"tape_edge_wait({reg})", addr, code, handler)
@@ -0,0 +1,119 @@
+# Idle-loop detection for the simulator
+#
+# Programs end in 'mov $pc, $pc' and I/O code polls ports in tight loops. Such a loop is idle
+# if one trip around it leaves the machine in exactly the state it started in: the same
+# registers, and memory that was only read and written back unchanged. Nothing but an
+# interrupt, a changed input port or a device event can then get it out of the loop, so
+# we can jump ahead in time until the next scheduled event (or the end of the run), in
+# whole trips around the loop, to keep cycle counts exact.
+#
+# Detection is done by observation: the System reports every backward jump (see 'jumped').
+# Observation starts at the target of the jump, and all bus accesses are watched until the
+# next backward jump. If that jumps back to the same place and the state is unchanged, the
+# loop is idle. If loops keep turning out not to be, we observe less and less often.
+
+from typing import *
+
+from iomap import IoPort
+
+MAX_LOOP_CYCLES = 256
+MAX_BACKOFF = 1024
+
+class IdleDetector(object):
+    def __init__(self, system: 'System'):
+        self.system = system
+        self.cpu = system.cpu
+        self.bus = None # The bus (and memory) being watched; looked up when observation starts
+        self.mem = None
+        self.head: Optional[int] = None # Start of the loop being observed
+        self.start_clk = 0
+        self.regs: Optional[Tuple[int, int, int, int, bool]] = None
+        self.reads: Dict[int, Optional[int]] = {} # Core memory locations read and not yet written back
+        self.inputs: Dict[IoPort, int] = {} # Input ports read and the values returned
+        self.changed = False
+        # Number of backward jumps to ignore, doubled every time a loop turns out to be busy
+        self.backoff = 0
+        self.misses = 0
+
+    def jumped(self, clk_count: int, end: int) -> int:
+        # Called on an instruction boundary, right after a jump backwards. Returns the number of clock
+        # cycles that can be skipped: a whole number of trips around an idle loop that ends at or
+        # before both 'end' and the next scheduled event. Returns 0 if nothing can be skipped.
+        if self.backoff:
+            self.backoff -= 1
+            return 0
+        cpu = self.cpu
+        if cpu.in_reset or (cpu.interrupt_pending and cpu.inten):
+            self.stop()
+            return 0
+        if self.head is not None:
+            head = self.head
+            period = clk_count - self.start_clk
+            idle = (
+                cpu.pc == head and
+                not self.changed and
+                len(self.reads) == 0 and
+                (cpu.pc, cpu.sp, cpu.r0, cpu.r1, cpu.inten) == self.regs and
+                all(port.value == value for port, value in self.inputs.items())
+            )
+            self.stop()
+            if idle:
+                self.misses = 0
+                queue = self.system.event_queue
+                limit = min(end, queue[0][0]) if queue else end
+                return max(limit - clk_count, 0) // period * period
+            self.misses += 1
+            self.backoff = min(1 << self.misses, MAX_BACKOFF)
+            if cpu.pc == head:
+                return 0
+        self._start(cpu.pc, clk_count)
+        return 0
+
+    def _start(self, head: int, clk_count: int) -> None:
+        cpu = self.cpu
+        self.head = head
+        self.start_clk = clk_count
+        self.regs = (cpu.pc, cpu.sp, cpu.r0, cpu.r1, cpu.inten)
+        self.reads = {}
+        self.inputs = {}
+        self.changed = False
+        # Shadow the bus methods for the duration of the observation; both Processor.clock and
+        # Processor.step go through these.
+        self.bus = self.system.bus
+        self.mem = self.system.mem
+        self.bus.read = self._read
+        self.bus.write = self._write
+
+    def stop(self) -> None:
+        if self.head is None:
+            return
+        self.head = None
+        del self.bus.read
+        del self.bus.write
+
+    def _read(self, addr: int) -> Optional[int]:
+        addr &= 0xffff
+        data = self.bus.readers[addr](addr)
+        owner = self.bus.owners[addr]
+        if owner is self.mem and data is not None:
+            self.reads[addr] = data
+        elif isinstance(owner, IoPort) and not owner.is_output:
+            self.inputs[owner] = data
+        else:
+            self.changed = True
+        if self.system.clk_count - self.start_clk > MAX_LOOP_CYCLES:
+            self.changed = True
+        return data
+
+    def _write(self, addr: int, data: Optional[int]) -> None:
+        addr &= 0xffff
+        self.bus.writers[addr](addr, data)
+        owner = self.bus.owners[addr]
+        if owner is self.mem:
+            if data is not None:
+                data &= 0xffff
+            if addr not in self.reads or self.reads.pop(addr) != data:
+                self.changed = True
+        elif not (isinstance(owner, IoPort) and not owner.is_output):
+            # Writes to input ports are ignored, anything else has side-effects
+            self.changed = True
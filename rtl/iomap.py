@@ -0,0 +1,79 @@
+# The I/O map (see isa/micro_architecture.md)
+#
+# Peripherals live at the top of the address space, so they can be reached using
+# the immediate field alone. For now, all of them are simple one-word ports: output
+# ports latch whatever is written to them, input ports return a value set from the
+# outside (a test-bench or a device model) and ignore writes, including the
+# write-back that follows every read.
+
+from typing import *
+
+TAPE_RECORD_ADDR   = 0xfff0
+TAPE_PLAYBACK_ADDR = 0xfff1
+TAPE_CONTROL_ADDR  = 0xfff2
+SERIAL_RXT_ADDR    = 0xfff8
+SERIAL_TXD_ADDR    = 0xfff9
+SERIAL_RTS_ADDR    = 0xfffa
+SERIAL_CTS_ADDR    = 0xfffb
+SWITCHES_ADDR      = 0xfffc
+BUTTONS_ADDR       = 0xfffd
+LIGHTS_ADDR        = 0xfffe
+BOOT_SWAP_ADDR     = 0xffff
+
+class IoPort(object):
+    def __init__(self, name: str, is_output: bool, value: int = 0):
+        self.name = name
+        self.is_output = is_output
+        self.value = value
+        self.reset_value = value
+        self.base_addr = None
+        # Called with the new value on every (effective) write
+        self.listeners: List[Callable[[int], None]] = []
+    def reset(self) -> None:
+        self.value = self.reset_value
+    def get_state(self) -> int:
+        return self.value
+    def set_state(self, state: int) -> None:
+        self.value = state
+    def set_base_addr(self, base_addr: int) -> None:
+        self.base_addr = base_addr
+    def get_size(self) -> int:
+        return 1
+    def read(self, addr: int) -> int:
+        return self.value
+    def write(self, addr: int, data: Optional[int]) -> None:
+        if not self.is_output or data is None:
+            return
+        self.value = data & 0xffff
+        for listener in self.listeners:
+            listener(self.value)
+    def set_input(self, value: int) -> None:
+        # Sets the value seen by the CPU for an input port
+        assert not self.is_output
+        self.value = value & 0xffff
+    def terminate(self) -> Sequence['SimEventBase']:
+        return ()
+
+# Address, name and direction of all ports. 0xffff (the boot-memory swap bit) is missing,
+# that address is used by the Terminator in the simulator, and shared with the boot ROM
+# model (see bootrom.py).
+io_ports = (
+    (TAPE_RECORD_ADDR,   "tape_record",   True),
+    (TAPE_PLAYBACK_ADDR, "tape_playback", False),
+    (TAPE_CONTROL_ADDR,  "tape_control",  True),
+    (SERIAL_RXT_ADDR,    "serial_rxt",    False),
+    (SERIAL_TXD_ADDR,    "serial_txd",    True),
+    (SERIAL_RTS_ADDR,    "serial_rts",    False),
+    (SERIAL_CTS_ADDR,    "serial_cts",    True),
+    (SWITCHES_ADDR,      "switches",      False),
+    (BUTTONS_ADDR,       "buttons",       False),
+    (LIGHTS_ADDR,        "lights",        True),
+)
+
+def register_io_ports(bus: 'Bus') -> Dict[str, IoPort]:
+    ports = {}
+    for addr, name, is_output in io_ports:
+        port = IoPort(name, is_output)
+        bus.register(addr, port)
+        ports[name] = port
+    return ports
@@ -0,0 +1,231 @@
+# Linker for separately assembled modules
+#
+# Every module is assembled on its own into an ObjectFile (see asm.assemble_object). Sections
+# declared with an address stay where they are. Sections without one are relocatable: the
+# linker concatenates the sections of the same name from all modules, in the order the modules
+# are given, and places each of these at the address 'placement' has for it, or else right
+# after everything placed before it.
+#
+# Each module sees its own symbols, and the ones exported (with .export) by the others. Once
+# the sections are placed, symbols are resolved and relocations filled in: .word values are
+# checked to fit 16 bits, immediates to fit IMMED_MASK.
+#
+# Modules don't depend on each other until they're linked, so they are assembled in parallel,
+# in a pool of worker processes (assemble_modules). Object code is cached (see asm.AsmCache),
+# so only modules that changed get assembled again.
+#
+#    python link.py monitor.asm tape_loader.asm serial.asm --place TEXT=0x1000
+
+from typing import *
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+import re
+
+from asm import AsmCache, AsmError, Expression, ObjectFile, SymbolTable, RELOC_IMMED, RELOC_WORD
+from asm import assemble_object, check_word, default_cache, immed_field, merge_sections, object_cache_key
+
+# Most relocations are a label, or a label and an offset. These don't need an expression compiled.
+_simple_reloc_re = re.compile(r"([A-Za-z_.][\w.]*)(?: ([-+]) (0x[0-9a-fA-F]+|[1-9][0-9]*|0))?")
+
+class _ModuleScope(dict):
+    # Symbol values of a module. Names the module doesn't define are looked up in the exports of the others.
+    def __init__(self, linker: 'Linker', module: ObjectFile):
+        super().__init__()
+        self.linker = linker
+        self.module = module
+    def __missing__(self, name: str) -> int:
+        value = self.linker.resolve_import(self.module, name)
+        self[name] = value
+        return value
+
+class Linker(object):
+    def __init__(self, modules: Sequence[ObjectFile], placement: Optional[Dict[str, int]] = None):
+        self.modules = tuple(modules)
+        self.placement = placement if placement is not None else {}
+        self.exporters: Dict[str, int] = {} # Symbol name -> index of the module exporting it
+        for idx, module in enumerate(self.modules):
+            for name in module.exports:
+                if name in self.exporters:
+                    raise AsmError(f"Symbol {name} is exported by both {self.modules[self.exporters[name]].name} and {module.name}")
+                self.exporters[name] = idx
+        self.section_addrs: Dict[Tuple[int, str], int] = {} # (module index, section name) -> address
+        self.symbol_tables: Dict[int, SymbolTable] = {}
+        self.expressions: Dict[str, Expression] = {} # Compiled once, used by every module that has them
+        self.importing: Set[str] = set()
+
+    ########################################
+    # Placement
+    ########################################
+    def place(self) -> None:
+        end_addr = 0
+        groups: Dict[str, List[Tuple[int, int]]] = OrderedDict() # Relocatable sections by name: (module index, size)
+        for idx, module in enumerate(self.modules):
+            for name, section in module.sections.items():
+                if section.base_addr is None:
+                    groups.setdefault(name, []).append((idx, len(section.text)))
+                else:
+                    self.section_addrs[(idx, name)] = section.base_addr
+                    end_addr = max(end_addr, section.base_addr + len(section.text))
+        for name, parts in groups.items():
+            addr = self.placement.get(name, end_addr)
+            for idx, size in parts:
+                self.section_addrs[(idx, name)] = addr
+                addr += size
+            end_addr = max(end_addr, addr)
+            if end_addr > 0x10000:
+                raise AsmError(f"Section {name} doesn't fit the address space")
+
+    ########################################
+    # Symbols
+    ########################################
+    def symbol_table(self, idx: int) -> SymbolTable:
+        # The symbols of module 'idx', with labels at their final addresses
+        if idx in self.symbol_tables:
+            return self.symbol_tables[idx]
+        module = self.modules[idx]
+        table = SymbolTable()
+        table.values = _ModuleScope(self, module)
+        for name, (section, value) in module.symbols.items():
+            if section is not None:
+                table.add(name, self.section_addrs[(idx, section)] + value)
+            elif isinstance(value, int):
+                table.add(name, value)
+            else:
+                table.add(name, self._expression(value))
+        self.symbol_tables[idx] = table
+        return table
+
+    def resolve_import(self, module: ObjectFile, name: str) -> int:
+        idx = self.exporters.get(name)
+        if idx is None:
+            raise AsmError(f"Undefined symbol {name} in {module.name}")
+        if name in self.importing:
+            raise AsmError(f"Circular symbol definition through {name}, exported by {self.modules[idx].name}")
+        self.importing.add(name)
+        try:
+            return self.symbol_table(idx).resolve_symbol(name)
+        finally:
+            self.importing.remove(name)
+
+    def _expression(self, text: str) -> Expression:
+        expr = self.expressions.get(text)
+        if expr is None:
+            expr = Expression(text)
+            self.expressions[text] = expr
+        return expr
+
+    def evaluate(self, idx: int, text: str) -> int:
+        # Value of the expression 'text' in module 'idx'
+        table = self.symbol_table(idx)
+        match = _simple_reloc_re.fullmatch(text)
+        if match is not None:
+            name, sign, offset = match.groups()
+            value = table.resolve_symbol(name) if name in table.table else table.values[name]
+            if sign is None:
+                return value
+            return value + int(offset, 0) if sign == "+" else value - int(offset, 0)
+        expr = self._expression(text)
+        for name in expr.names():
+            if name in table.table:
+                table.resolve_symbol(name)
+        return expr.evaluate(table.values)
+
+    ########################################
+    # Linking
+    ########################################
+    def link(self) -> Tuple[int, Sequence[int]]:
+        self.place()
+        section_texts = []
+        for idx, module in enumerate(self.modules):
+            for name, section in module.sections.items():
+                text = list(section.text)
+                for ofs, kind, value, line_no in section.relocations:
+                    try:
+                        if kind == RELOC_WORD:
+                            text[ofs] = check_word(self.evaluate(idx, value))
+                        else:
+                            assert kind == RELOC_IMMED
+                            text[ofs] = (text[ofs] | immed_field(self.evaluate(idx, value))) & 0xffff
+                    except AsmError as ex:
+                        raise AsmError(f"{ex.message} (section {name} of {module.name})", line_no)
+                section_texts.append((self.section_addrs[(idx, name)], text))
+        return merge_sections(section_texts)
+
+    def map(self) -> str:
+        # Where everything ended up; call after 'link'
+        lines = []
+        for (idx, name), addr in sorted(self.section_addrs.items(), key=lambda item: (item[1], item[0])):
+            size = len(self.modules[idx].sections[name].text)
+            lines.append(f"0x{addr:04x}-0x{addr+size:04x} {name} ({self.modules[idx].name})")
+        for name, idx in sorted(self.exporters.items()):
+            value = self.symbol_table(idx).resolve_symbol(name)
+            lines.append(f"0x{value & 0xffff:04x} {name} ({self.modules[idx].name})")
+        return "\n".join(lines)
+
+def link(modules: Sequence[ObjectFile], placement: Optional[Dict[str, int]] = None) -> Tuple[int, Sequence[int]]:
+    return Linker(modules, placement).link()
+
+########################################
+# Parallel assembly
+########################################
+def _assemble_module(source: Tuple[str, str]) -> ObjectFile:
+    name, text = source
+    return assemble_object(text, name, cache=None)
+
+def assemble_modules(
+    sources: Sequence[Tuple[str, str]],
+    *,
+    max_workers: Optional[int] = None,
+    cache: Optional[AsmCache] = default_cache,
+) -> List[ObjectFile]:
+    # Assembles (name, source) pairs into objects. The ones not found in 'cache' are assembled
+    # in a pool of worker processes (unless there's only one to assemble, or one CPU); the workers don't
+    # touch the cache, we fill it in with what they return.
+    keys = [object_cache_key(text, name) for name, text in sources]
+    objects = [None if cache is None else cache.get(key) for key in keys]
+    missing = [idx for idx, obj in enumerate(objects) if obj is None]
+    workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+    if len(missing) > 1 and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            assembled = list(executor.map(_assemble_module, (sources[idx] for idx in missing)))
+    else:
+        assembled = [_assemble_module(sources[idx]) for idx in missing]
+    for idx, obj in zip(missing, assembled):
+        objects[idx] = obj
+        if cache is not None:
+            cache.put(keys[idx], obj)
+    return objects
+
+def build(
+    sources: Sequence[Tuple[str, str]],
+    placement: Optional[Dict[str, int]] = None,
+    *,
+    max_workers: Optional[int] = None,
+) -> Tuple[int, Sequence[int]]:
+    # Assembles and links (name, source) pairs; returns the image like asm.assemble
+    return link(assemble_modules(sources, max_workers=max_workers), placement)
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Assemble modules in parallel and link them")
+    parser.add_argument("sources", nargs="+", help="assembly files, in link order")
+    parser.add_argument("--place", action="append", default=[], metavar="SECTION=ADDR", help="address of a relocatable section")
+    parser.add_argument("--jobs", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    placement = {}
+    for item in args.place:
+        name, _, addr = item.partition("=")
+        placement[name] = int(addr, 0)
+    sources = []
+    for file_name in args.sources:
+        with open(file_name, "rt") as f:
+            sources.append((file_name, f.read()))
+    linker = Linker(assemble_modules(sources, max_workers=args.jobs), placement)
+    base_addr, words = linker.link()
+    print(linker.map())
+    print(f"{len(words)} words at 0x{base_addr:04x}")
+
+if __name__ == "__main__":
+    main()
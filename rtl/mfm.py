@@ -0,0 +1,226 @@
+# MFM tape codec (see isa/micro_architecture.md)
+#
+# The tape has 4 or 8 tracks, recorded in parallel: every symbol carries one bit per track,
+# so a 16-bit word is 4 (or 2) symbols, least significant bits first. Each track is MFM
+# coded: a bit-time is two cells, a 1 inverts the line-state in the middle of the bit-time,
+# and a 0 that follows another 0 inverts it at the start of the bit-time.
+#
+# A block on tape is:
+#    gap:      'gap_cells' cells without edges, for tape mechanism slop
+#    sync:     'sync_bits' zeros and a one, on all tracks
+#    header:   load address and number of valid words
+#    data:     BLOCK_WORDS words, zero-padded
+#    checksum: 16-bit sum of header and data
+#
+# Waveforms are byte arrays in the format of tape images (see tape.py): one sample per byte,
+# bit n being the state of track n, 'samples_per_cell' samples for each cell.
+#
+# Both directions work on whole arrays: the encoder codes BATCH_BLOCKS blocks at a time, the
+# decoder finds sync sequences and decodes all blocks in a window of CHUNK_SAMPLES samples at
+# once. Tape images are streamed to and from disk, so memory use doesn't depend on their size.
+#
+#    python mfm.py write tape.img program.asm
+#    python mfm.py read tape.img
+
+from typing import *
+import argparse
+
+import numpy as np
+
+BLOCK_WORDS = 256
+HEADER_WORDS = 2
+FRAME_WORDS = HEADER_WORDS + BLOCK_WORDS + 1 # ... and the checksum
+LANES = 4
+GAP_CELLS = 2400
+SYNC_BITS = 32
+BATCH_BLOCKS = 256
+CHUNK_SAMPLES = 1 << 22
+
+class MfmError(Exception):
+    def __init__(self, message: str):
+        self.message = message
+    def __str__(self) -> str:
+        return self.message
+
+def split_blocks(base_addr: int, words: Sequence[int]) -> Iterator[Tuple[int, Sequence[int]]]:
+    # Cuts a memory image (as returned by asm.assemble) into (address, words) blocks
+    for ofs in range(0, len(words), BLOCK_WORDS):
+        yield base_addr + ofs, words[ofs:ofs+BLOCK_WORDS]
+
+class MfmCodec(object):
+    def __init__(self, lanes: int = LANES, samples_per_cell: int = 1, gap_cells: int = GAP_CELLS, sync_bits: int = SYNC_BITS):
+        assert lanes in (4, 8)
+        assert sync_bits >= 4
+        self.lanes = lanes
+        self.mask = (1 << lanes) - 1
+        self.symbols_per_word = 16 // lanes
+        self.samples_per_cell = samples_per_cell
+        self.gap_cells = gap_cells
+        self.sync_bits = sync_bits
+        # Symbols and samples of the data part of a block (header, data and checksum)
+        self.frame_symbols = FRAME_WORDS * self.symbols_per_word
+        self.frame_samples = self.frame_symbols * 2 * samples_per_cell
+        self.level = 0 # Line-state at the end of what's been encoded so far
+
+    ########################################
+    # Encoding
+    ########################################
+    def _frames(self, blocks: Sequence[Tuple[int, Sequence[int]]]) -> np.ndarray:
+        # Header, data and checksum words of 'blocks', one row each
+        frames = np.zeros((len(blocks), FRAME_WORDS), dtype=np.uint16)
+        for row, (addr, words) in enumerate(blocks):
+            if len(words) > BLOCK_WORDS:
+                raise MfmError(f"block at 0x{addr:04x} has {len(words)} words, at most {BLOCK_WORDS} fit")
+            if addr < 0 or addr + len(words) > 0x10000:
+                raise MfmError(f"block at 0x{addr:04x} doesn't fit the address space")
+            frames[row, 0] = addr
+            frames[row, 1] = len(words)
+            frames[row, HEADER_WORDS:HEADER_WORDS+len(words)] = words
+        frames[:, -1] = frames[:, :-1].sum(axis=1, dtype=np.uint64) & 0xffff
+        return frames
+
+    def _encode_batch(self, blocks: Sequence[Tuple[int, Sequence[int]]]) -> np.ndarray:
+        frames = self._frames(blocks)
+        shifts = np.arange(self.symbols_per_word, dtype=np.uint16) * self.lanes
+        data = ((frames[:, :, None] >> shifts) & self.mask).astype(np.uint8).reshape(len(blocks), -1)
+        sync = np.zeros((len(blocks), self.sync_bits + 1), dtype=np.uint8)
+        sync[:, -1] = self.mask
+        symbols = np.concatenate((sync, data), axis=1)
+        prev = np.zeros_like(symbols)
+        prev[:, 1:] = symbols[:, :-1]
+        # Edges, per cell; a gap in front of every block
+        edges = np.zeros((len(blocks), self.gap_cells + 2 * symbols.shape[1]), dtype=np.uint8)
+        coded = edges[:, self.gap_cells:]
+        coded[:, 0::2] = ~(prev | symbols) & self.mask
+        coded[:, 1::2] = symbols
+        edges[0, 0] ^= self.level
+        cells = np.bitwise_xor.accumulate(edges.reshape(-1))
+        self.level = int(cells[-1])
+        if self.samples_per_cell == 1:
+            return cells
+        return np.repeat(cells, self.samples_per_cell)
+
+    def encode(self, blocks: Iterable[Tuple[int, Sequence[int]]]) -> Iterator[np.ndarray]:
+        # Yields the waveform of 'blocks' in chunks of BATCH_BLOCKS blocks
+        batch = []
+        for block in blocks:
+            batch.append(block)
+            if len(batch) == BATCH_BLOCKS:
+                yield self._encode_batch(batch)
+                batch = []
+        if len(batch) > 0:
+            yield self._encode_batch(batch)
+
+    def gap(self, cells: int) -> np.ndarray:
+        return np.full(cells * self.samples_per_cell, self.level, dtype=np.uint8)
+
+    def write_tape(self, file_name: str, images: Iterable[Tuple[int, Sequence[int]]], min_cells: int = 0) -> int:
+        # Writes memory images to a tape image, followed by a trailing gap, and blank tape up to
+        # 'min_cells'. Returns the number of samples written.
+        samples = 0
+        with open(file_name, "wb") as f:
+            for image in images:
+                for chunk in self.encode(split_blocks(*image)):
+                    chunk.tofile(f)
+                    samples += len(chunk)
+            trailer = self.gap(max(self.gap_cells, min_cells - samples // self.samples_per_cell))
+            trailer.tofile(f)
+            samples += len(trailer)
+        return samples
+
+    ########################################
+    # Decoding
+    ########################################
+    def _find_syncs(self, window: np.ndarray, ofs: int) -> np.ndarray:
+        # Sample positions of the first data bit after every sync sequence in 'window' (which starts at 'ofs')
+        edges = np.flatnonzero(window[1:] != window[:-1]) + 1
+        if len(edges) < 2:
+            return edges[:0]
+        spacing = np.rint(np.diff(edges) / self.samples_per_cell).astype(np.int64)
+        # A run of zeros has edges every two cells, the one closing the sync is three cells later.
+        # Some of the first zeros may have been missed, so half the run is enough.
+        run = self.sync_bits // 2
+        twos = np.concatenate(([0], np.cumsum(spacing == 2)))
+        idx = np.arange(run, len(spacing))
+        found = idx[(spacing[idx] == 3) & (twos[idx] - twos[idx-run] == run)]
+        return edges[found + 1] + self.samples_per_cell + ofs
+
+    def _decode_frames(self, samples: np.ndarray, starts: np.ndarray) -> np.ndarray:
+        # The frame words of the blocks whose data starts at 'starts'
+        spc = self.samples_per_cell
+        centers = np.arange(self.frame_symbols * 2) * spc + spc // 2
+        cells = samples[starts[:, None] + centers[None, :]] & self.mask
+        symbols = (cells[:, 0::2] ^ cells[:, 1::2]).astype(np.uint16)
+        symbols = symbols.reshape(len(starts), FRAME_WORDS, self.symbols_per_word)
+        shifts = np.arange(self.symbols_per_word, dtype=np.uint16) * self.lanes
+        return np.bitwise_or.reduce(symbols << shifts, axis=2)
+
+    def decode(self, samples: np.ndarray) -> Iterator[Tuple[int, np.ndarray]]:
+        # Yields the (address, words) blocks found in a waveform, which can be a memory-mapped tape image
+        overlap = (self.sync_bits + 2) * 2 * self.samples_per_cell
+        pos = 0
+        next_start = 0 # Blocks can't start before the previous one ended
+        while pos < len(samples):
+            end = min(pos + CHUNK_SAMPLES, len(samples))
+            starts = self._find_syncs(samples[pos:end] & self.mask, pos)
+            # Starts within a block that was just found are data that happen to look like a sync.
+            # A block running past the end of the window is left for the next one.
+            resume = end - overlap
+            keep = []
+            for start in starts.tolist():
+                if start < next_start:
+                    continue
+                if start + self.frame_samples > len(samples):
+                    raise MfmError(f"truncated block at sample {start}")
+                if start + self.frame_samples > end:
+                    resume = start - overlap
+                    break
+                keep.append(start)
+                next_start = start + self.frame_samples
+            if len(keep) > 0:
+                frames = self._decode_frames(samples, np.array(keep, dtype=np.int64))
+                checksums = frames[:, :-1].sum(axis=1, dtype=np.uint64) & 0xffff
+                for start, frame, checksum in zip(keep, frames, checksums):
+                    addr, count = int(frame[0]), int(frame[1])
+                    if checksum != frame[-1] or count > BLOCK_WORDS:
+                        raise MfmError(f"bad block at sample {start}")
+                    yield addr, frame[HEADER_WORDS:HEADER_WORDS+count]
+            if end == len(samples):
+                break
+            pos = max(resume, pos + 1)
+
+    def read_tape(self, file_name: str) -> List[Tuple[int, List[int]]]:
+        # Decodes a tape image back into memory images, merging blocks that follow each other
+        images = []
+        for addr, words in self.decode(np.memmap(file_name, dtype=np.uint8, mode="r")):
+            if len(images) > 0 and images[-1][0] + len(images[-1][1]) == addr:
+                images[-1][1].extend(words.tolist())
+            else:
+                images.append((addr, words.tolist()))
+        return images
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    from asm import assemble
+    parser = argparse.ArgumentParser(description="Write programs to, or read them from MFM tape images")
+    parser.add_argument("command", choices=("write", "read"))
+    parser.add_argument("tape", help="tape image")
+    parser.add_argument("sources", nargs="*", help="assembly files to write to the tape")
+    parser.add_argument("--lanes", type=int, choices=(4, 8), default=LANES, help="number of tracks")
+    parser.add_argument("--samples-per-cell", type=int, default=1, help="samples per half bit-time")
+    parser.add_argument("--min-cells", type=int, default=0, help="pad the tape with blank cells to this length")
+    args = parser.parse_args(argv)
+
+    codec = MfmCodec(args.lanes, args.samples_per_cell)
+    if args.command == "write":
+        images = []
+        for source in args.sources:
+            with open(source, "rt") as f:
+                images.append(assemble(f.read()))
+        samples = codec.write_tape(args.tape, images, args.min_cells)
+        print(f"{samples} samples written")
+    else:
+        for addr, words in codec.read_tape(args.tape):
+            print(f"0x{addr:04x}: {len(words)} words")
+
+if __name__ == "__main__":
+    main()
@@ -4,35 +4,38 @@ from constants import *
 from typing import *
 from abc import abstractmethod
 import re
+import sys
+import pickle
+from heapq import heappush, heappop
 
 from asm import assemble
-from disasm import disasm_inst
+from decode import decode_table, PHASE_FETCH, PHASE_WRITE_BACK_INST, PHASE_DECODE, PHASE_SWAP, PHASE_WRITE_BACK_OPB, PHASE_EXECUTE, PHASE_UPDATE_PC
+from decode import PHASE_RESET_READ, PHASE_RESET_WRITE_BACK, PHASE_RESET_SET_PC
+from translate import BlockCache
+from idle import IdleDetector
+from hle import HleTable, HleRoutine
+from iomap import register_io_ports
+from trace import TraceLevel, TraceKind, TraceSinkBase, TextTraceSink, NullTraceSink
 from copy import copy
+from array import array
 
-def _rol(data: int) -> int:
-    return ((data << 1) & 0xfffe) | ((data >> 15) & 1)
+# Number of clock cycles the reset sequence of Processor.clock takes
+RESET_CYCLES = 3
 
-def _ror(data: int) -> int:
-    return ((data >> 1) & 0x7fff) | ((data & 1) << 15)
-
-def _make_signed(data: int, bit_count: int) -> int:
-    mask = (1 << bit_count) - 1
-    is_negative = (data & (1 << (bit_count - 1))) != 0
-    mask2 = mask >> 1
-
-    data &= mask
-    if is_negative:
-        return (data & mask2) - mask2 - 1
-    else:
-        return data
+# The instruction that gets executed instead of the fetched one when an interrupt is taken
+INTERRUPT_INST = (INST_SWAP << OPCODE_OFS) | (0 << D_OFS) | (OPB_MEM_IMMED << OPB_OFS) | (OPA_PC << OPA_OFS) | (1 << IMMED_OFS)
 
 class SimEventBase(object):
+    level = TraceLevel.full
+    kind = TraceKind.other
     def __init__(self):
         pass
     def act(self, simulator) -> None:
         pass
 
 class SimEventTerminate(SimEventBase):
+    level = TraceLevel.instruction
+    kind = TraceKind.terminate
     def __init__(self, exit_code: int):
         self.exit_code = exit_code
     def act(self, simulator) -> None:
@@ -40,6 +43,8 @@ class SimEventTerminate(SimEventBase):
     def __str__(self) -> str:
         return f"TERMINATED WITH CODE: {self.exit_code}"
 class SimEventMemDump(object):
+    level = TraceLevel.full
+    kind = TraceKind.other
     def __init__(self, memory: Dict[int, int]):
         self.memory = copy(memory)
     def __str__(self):
@@ -71,70 +76,312 @@ class SimEventMemDump(object):
         return dump
 
 
+# The state of each core memory location
+MEM_CLEARED = 0   # Never written, or destroyed by a read
+MEM_PRESENT = 1   # Holds a value
+MEM_UNKNOWN = 2   # Was written with an unknown (xxxx) value
+
+# bytes.translate() tables to turn a state map into 0/1 flags
+_present_flags = bytes(1 if state in (MEM_PRESENT, MEM_UNKNOWN) else 0 for state in range(256))
+_unknown_flags = bytes(1 if state == MEM_UNKNOWN else 0 for state in range(256))
+_not_present_flags = bytes(0 if state == MEM_PRESENT else 1 for state in range(256))
+_nonzero_flags = bytes(0 if value == 0 else 1 for value in range(256))
+
+def _flags_and(a: bytes, b: bytes) -> bytes:
+    # Element-wise AND of two 0/1 flag strings of the same length. Done on big integers, so no Python-level loops
+    return (int.from_bytes(a, "little") & int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+def _flags_or(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, "little") | int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+def _flags_and_not(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, "little") & ~int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+def _set_flags(flags: bytes) -> Iterator[int]:
+    # Returns the indices of all set flags. bytes.find() skips over the clear ones in C.
+    idx = flags.find(1)
+    while idx >= 0:
+        yield idx
+        idx = flags.find(1, idx+1)
+
+class MemoryDifference(object):
+    DELETED = "deleted"
+    DIFFERENT = "different"
+    EXTRANEOUS = "extraneous"
+
+    def __init__(self, kind: str, addr: int, expected: Optional[int], actual: Optional[int]):
+        self.kind = kind
+        self.addr = addr
+        self.expected = expected
+        self.actual = actual
+    def __str__(self) -> str:
+        if self.kind == MemoryDifference.DELETED:
+            return f"Expected content at address 0x{self.addr:04x} with value 0x{self.expected:04x} is deleted from memory"
+        elif self.kind == MemoryDifference.DIFFERENT:
+            return f"Expected content at address 0x{self.addr:04x} with expected value 0x{self.expected:04x} is different in memory with value: {_safe_format(self.actual)}"
+        else:
+            return f"Memory contains extraneous data at address 0x{self.addr:04x} with value: {_safe_format(self.actual)}"
+
 class Memory(object):
+    # Core memory is stored in a flat array of words. A separate state map (one byte per word) tracks
+    # if a location holds a value, was cleared by a (destructive) read, or holds an unknown value.
     def __init__(self, size: int, system: 'System'):
-        self.mem = {}
+        self.data = array("H", bytes(2*size))
+        self.state = bytearray(size)
         self.size = size
+        self.base_addr = 0
+        # If set, gets notified of all changes to memory content (see translate.BlockCache)
+        self.code_cache = None
     def set_base_addr(self, base_addr):
         self.base_addr = base_addr
     def get_size(self) -> int:
         return self.size
-    def load(self, start_addr: int, content: Sequence[int]) -> None:
+    def load(self, start_addr: int, content: Sequence[Optional[int]]) -> None:
         assert start_addr >= self.base_addr
         assert start_addr < self.base_addr + self.size
-        for ofs, data in enumerate(content):
-            assert ofs + start_addr < self.base_addr + self.size
-            self.mem[ofs+start_addr] = data
-    def read(self, addr: int) -> int:
-        assert addr >= self.base_addr
-        assert addr < self.base_addr + self.size
-        ret_val = self.mem.get(addr, None)
-        # Read is destructive: once a location is read, it's cleared to 0,
-        # But to be even more forceful, we remove the entry and the subsequent
-        # write-back will ensure that we don't write a location that already exists
-        try:
-            del self.mem[addr]
-        except KeyError:
-            pass
+        count = len(content)
+        assert start_addr + count <= self.base_addr + self.size
+        ofs = start_addr - self.base_addr
         try:
-            return ret_val & 0xffff
-        except TypeError:
-            assert ret_val is None
-        return ret_val
-    def write(self, addr: int, data: int) -> None:
-        assert addr >= self.base_addr
-        assert addr < self.base_addr + self.size
-        assert addr not in self.mem
-        self.mem[addr] = data & 0xffff if data is not None else None
+            words = array("H", content)
+            states = bytes((MEM_PRESENT,)) * count
+        except (TypeError, OverflowError):
+            # We have unknown values or values that need to be truncated
+            words = array("H", (0 if data is None else data & 0xffff for data in content))
+            states = bytes(MEM_UNKNOWN if data is None else MEM_PRESENT for data in content)
+        self._store(ofs, words, states)
+        if self.code_cache is not None:
+            self.code_cache.notify_load(start_addr, count)
+    def clear(self, start_addr: int, count: int) -> None:
+        assert start_addr >= self.base_addr
+        assert start_addr + count <= self.base_addr + self.size
+        ofs = start_addr - self.base_addr
+        self._store(ofs, array("H", bytes(2*count)), bytes(count))
+        if self.code_cache is not None:
+            self.code_cache.notify_load(start_addr, count)
+    def _store(self, ofs: int, words: array, states: bytes) -> None:
+        count = len(words)
+        self.data[ofs:ofs+count] = words
+        self.state[ofs:ofs+count] = states
+    def peek(self, addr: int) -> Optional[int]:
+        # Non-destructive read, for the simulator's internal use
+        ofs = addr - self.base_addr
+        return self.data[ofs] if self.state[ofs] == MEM_PRESENT else None
+    def read_slice(self, start_addr: int, end_addr: int) -> List[Optional[int]]:
+        # Non-destructive read of a range of addresses. Cleared and unknown locations are returned as None
+        start = start_addr - self.base_addr
+        end = end_addr - self.base_addr
+        assert 0 <= start <= end <= self.size
+        words = self.data[start:end].tolist()
+        for idx in _set_flags(bytes(self.state[start:end]).translate(_not_present_flags)):
+            words[idx] = None
+        return words
+    def snapshot_dict(self) -> Dict[int, Optional[int]]:
+        # Returns all locations that hold a (known or unknown) value
+        data = self.data
+        state = self.state
+        present = bytes(state).translate(_present_flags)
+        return {
+            idx + self.base_addr: (data[idx] if state[idx] == MEM_PRESENT else None)
+            for idx in _set_flags(present)
+        }
+    def read(self, addr: int) -> Optional[int]:
+        ofs = addr - self.base_addr
+        assert 0 <= ofs < self.size
+        state = self.state[ofs]
+        # Read is destructive: once a location is read, it's cleared to 0,
+        # But to be even more forceful, we mark the location as cleared and the subsequent
+        # write-back will ensure that we don't write a location that already has a value
+        self.state[ofs] = MEM_CLEARED
+        if state == MEM_PRESENT:
+            return self.data[ofs]
+        return None
+    def write(self, addr: int, data: Optional[int]) -> None:
+        ofs = addr - self.base_addr
+        assert 0 <= ofs < self.size
+        assert self.state[ofs] == MEM_CLEARED
+        if data is not None:
+            data &= 0xffff
+            self.data[ofs] = data
+            self.state[ofs] = MEM_PRESENT
+        else:
+            self.state[ofs] = MEM_UNKNOWN
+        if self.code_cache is not None:
+            self.code_cache.notify_write(addr, data)
+
+    def get_state(self) -> Dict[str, Any]:
+        return {"data": self.data.tobytes(), "state": bytes(self.state)}
+    def set_state(self, state: Dict[str, Any]) -> None:
+        assert len(state["state"]) == self.size
+        self.data = array("H")
+        self.data.frombytes(state["data"])
+        self.state[:] = state["state"]
+        if self.code_cache is not None:
+            self.code_cache.notify_load(self.base_addr, self.size)
+    def copy_from(self, other: 'Memory') -> None:
+        # Makes the content of this memory the same as that of 'other'
+        self.set_state(other.get_state())
 
     def terminate(self) -> Sequence[SimEventBase]:
-        return (SimEventMemDump(self.mem), )
+        return (SimEventMemDump(self.snapshot_dict()), )
 
-    def compare(self, expected_content: Dict[int, Sequence[int]]) -> bool:
-        checked_addresses: Set[int] = set()
-        ret_val = True
+    def diff(self, expected_content: Dict[int, Sequence[int]]) -> List[MemoryDifference]:
+        # Compares memory content against the expected one. Locations not mentioned in
+        # 'expected_content' are expected to be cleared. All the scanning is done on whole
+        # arrays, only the differences found are processed one-by-one.
+        expected_flags = bytearray(self.size)
+        expected_data = array("H", bytes(2*self.size))
         for start, values in expected_content.items():
-            for ofs, value in enumerate(values):
-                addr = start+ofs
-                if addr not in self.mem:
-                    print(f"Expected content at address 0x{addr:04x} with value 0x{value:04x} is deleted from memory")
-                    ret_val = False
-                elif self.mem[addr] != value:
-                    print(f"Expected content at address 0x{addr:04x} with expected value 0x{value:04x} is different in memory with value: 0x{self.mem[addr]:04x}")
-                    ret_val = False
-                checked_addresses.add(addr)
-        for addr in self.mem.keys():
-            if addr not in checked_addresses:
-                print(f"Memory contains extraneous data at address 0x{addr:04x} with value: 0x{self.mem[addr]:04x}")
-                ret_val = False
-        return ret_val
+            ofs = start - self.base_addr
+            count = len(values)
+            assert 0 <= ofs and ofs + count <= self.size
+            expected_flags[ofs:ofs+count] = b"\x01" * count
+            expected_data[ofs:ofs+count] = array("H", values)
+        expected_flags = bytes(expected_flags)
+        state = bytes(self.state)
+        present_flags = state.translate(_present_flags)
+        unknown_flags = state.translate(_unknown_flags)
+        # Per-word inequality: XOR the two arrays and collapse each pair of bytes into a single flag
+        xor = (int.from_bytes(self.data.tobytes(), "little") ^ int.from_bytes(expected_data.tobytes(), "little")).to_bytes(2*self.size, "little")
+        xor_flags = xor.translate(_nonzero_flags)
+        value_flags = _flags_or(_flags_or(xor_flags[0::2], xor_flags[1::2]), unknown_flags)
 
+        differences = []
+        for idx in _set_flags(_flags_and_not(expected_flags, present_flags)):
+            differences.append(MemoryDifference(MemoryDifference.DELETED, idx + self.base_addr, expected_data[idx], None))
+        for idx in _set_flags(_flags_and(_flags_and(expected_flags, present_flags), value_flags)):
+            differences.append(MemoryDifference(MemoryDifference.DIFFERENT, idx + self.base_addr, expected_data[idx], self.peek(idx + self.base_addr)))
+        for idx in _set_flags(_flags_and_not(present_flags, expected_flags)):
+            differences.append(MemoryDifference(MemoryDifference.EXTRANEOUS, idx + self.base_addr, None, self.peek(idx + self.base_addr)))
+        return differences
+
+    def compare(self, expected_content: Dict[int, Sequence[int]]) -> bool:
+        differences = self.diff(expected_content)
+        for difference in differences:
+            print(difference)
+        return len(differences) == 0
+
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+class PagedMemory(Memory):
+    # Core memory split into pages of PAGE_SIZE words. Pages can be shared between instances (see copy_from);
+    # a shared page is copied the first time it's accessed through 'read' or 'write' (reads are destructive,
+    # so that's every access by the CPU). Non-destructive accesses work on shared pages directly.
+    # 'data' and 'state' are read-only, flat copies of the whole memory.
+    def __init__(self, size: int, system: 'System'):
+        assert size % PAGE_SIZE == 0
+        page_count = size >> PAGE_BITS
+        self.page_data = [array("H", bytes(2*PAGE_SIZE)) for _ in range(page_count)]
+        self.page_state = [bytearray(PAGE_SIZE) for _ in range(page_count)]
+        # Set for pages that are not shared with anybody else
+        self.owned = bytearray(b"\x01") * page_count
+        self.size = size
+        self.base_addr = 0
+        self.code_cache = None
+    @property
+    def data(self) -> array:
+        data = array("H")
+        for page in self.page_data:
+            data.extend(page)
+        return data
+    @property
+    def state(self) -> bytearray:
+        return bytearray(b"".join(self.page_state))
+    def _own(self, page: int) -> None:
+        self.page_data[page] = array("H", self.page_data[page])
+        self.page_state[page] = bytearray(self.page_state[page])
+        self.owned[page] = 1
+    def _store(self, ofs: int, words: array, states: bytes) -> None:
+        pos = 0
+        end = len(words)
+        while pos < end:
+            page = (ofs + pos) >> PAGE_BITS
+            idx = (ofs + pos) & PAGE_MASK
+            count = min(PAGE_SIZE - idx, end - pos)
+            if not self.owned[page]:
+                self._own(page)
+            self.page_data[page][idx:idx+count] = words[pos:pos+count]
+            self.page_state[page][idx:idx+count] = states[pos:pos+count]
+            pos += count
+    def peek(self, addr: int) -> Optional[int]:
+        ofs = addr - self.base_addr
+        page = ofs >> PAGE_BITS
+        ofs &= PAGE_MASK
+        return self.page_data[page][ofs] if self.page_state[page][ofs] == MEM_PRESENT else None
+    def read(self, addr: int) -> Optional[int]:
+        ofs = addr - self.base_addr
+        assert 0 <= ofs < self.size
+        page = ofs >> PAGE_BITS
+        if not self.owned[page]:
+            self._own(page)
+        page_state = self.page_state[page]
+        ofs &= PAGE_MASK
+        state = page_state[ofs]
+        page_state[ofs] = MEM_CLEARED
+        if state == MEM_PRESENT:
+            return self.page_data[page][ofs]
+        return None
+    def write(self, addr: int, data: Optional[int]) -> None:
+        ofs = addr - self.base_addr
+        assert 0 <= ofs < self.size
+        page = ofs >> PAGE_BITS
+        if not self.owned[page]:
+            self._own(page)
+        page_state = self.page_state[page]
+        ofs &= PAGE_MASK
+        assert page_state[ofs] == MEM_CLEARED
+        if data is not None:
+            data &= 0xffff
+            self.page_data[page][ofs] = data
+            page_state[ofs] = MEM_PRESENT
+        else:
+            page_state[ofs] = MEM_UNKNOWN
+        if self.code_cache is not None:
+            self.code_cache.notify_write(addr, data)
+
+    def get_state(self) -> Dict[str, Any]:
+        return {"data": b"".join(page.tobytes() for page in self.page_data), "state": b"".join(self.page_state)}
+    def set_state(self, state: Dict[str, Any]) -> None:
+        assert len(state["state"]) == self.size
+        data = array("H")
+        data.frombytes(state["data"])
+        self.page_data = [data[ofs:ofs+PAGE_SIZE] for ofs in range(0, self.size, PAGE_SIZE)]
+        self.page_state = [bytearray(state["state"][ofs:ofs+PAGE_SIZE]) for ofs in range(0, self.size, PAGE_SIZE)]
+        self.owned[:] = b"\x01" * len(self.owned)
+        if self.code_cache is not None:
+            self.code_cache.notify_load(self.base_addr, self.size)
+    def copy_from(self, other: Memory) -> None:
+        # Shares all pages with 'other'. From here on, neither side owns any of them.
+        if not isinstance(other, PagedMemory):
+            super().copy_from(other)
+            return
+        assert other.size == self.size
+        self.page_data = list(other.page_data)
+        self.page_state = list(other.page_state)
+        self.owned[:] = bytes(len(self.owned))
+        other.owned[:] = bytes(len(other.owned))
+        if self.code_cache is not None:
+            self.code_cache.notify_load(self.base_addr, self.size)
 
 
 class Terminator(object):
     def __init__(self, system: 'System'):
-        system.register_for_clock(self)
+        self.system = system
+        self.reset()
+    def reset(self) -> None:
         self.terminating = False
+        self.exit_code = None
+    def get_state(self) -> Dict[str, Any]:
+        return {"terminating": self.terminating, "exit_code": self.exit_code}
+    def set_state(self, state: Dict[str, Any]) -> None:
+        self.terminating = state["terminating"]
+        self.exit_code = state["exit_code"]
+        # Saved in the cycle after the write: the wake-up is due at the end of this one
+        system = self.system
+        if self.terminating and system.stop_requested and not system.terminated:
+            system.schedule(0, self.wake_up)
     def set_base_addr(self, base_addr):
         pass
     def get_size(self) -> int:
@@ -145,32 +392,62 @@ class Terminator(object):
     def write(self, addr: int, data: int) -> None:
         self.terminating = True
         self.exit_code = data
-    def simulate(self):
-        while True:
-            if self.terminating: yield (SimEventTerminate(self.exit_code), )
-            yield []
+        self.system.stop_requested = True
+        # The simulation stops at the end of the cycle after the write (the CPU still gets to
+        # finish that cycle). The instruction-level modes simulate that cycle themselves.
+        self.system.schedule(1, self.wake_up)
+    def wake_up(self) -> Sequence[SimEventBase]:
+        # The instruction-level modes handle the stop themselves and clear the request when continuing
+        if not self.system.stop_requested:
+            return ()
+        return (SimEventTerminate(self.exit_code), )
     def terminate(self) -> Sequence[SimEventBase]:
         return []
 
 class Bus(object):
+    # Address decoding is done through two 64k-entry tables, holding the bound read and write
+    # methods of the device that owns each address. A bus access is thus a single table lookup
+    # followed by a direct call into the device, no matter how many devices there are.
     def __init__(self, system: 'System'):
-        self.client_map = {}
-        self.clients = set()
-    def register(self, base_addr: int, client: Any):
-        client.set_base_addr(base_addr)
-        # We allow a client to be registered in multiple address regions (for aliasing)
-        if client not in self.clients:
-            self.clients.add(client)
-        size = client.get_size()
-        for addr in range(base_addr, base_addr+size):
-            assert addr not in self.client_map
-            self.client_map[addr] = client
+        self.readers: List[Callable[[int], Optional[int]]] = [self._unmapped_read] * 0x10000
+        self.writers: List[Callable[[int, Optional[int]], None]] = [self._unmapped_write] * 0x10000
+        self.owners: List[Any] = [None] * 0x10000
+        self.clients = []
+    def register(self, base_addr: int, client: Any, size: Optional[int] = None, *, alias_of: Optional[int] = None):
+        # Maps 'size' (by default all) addresses of 'client' starting at 'base_addr'.
+        # With 'alias_of' set, the range is an alias: accesses are forwarded to the client
+        # as if they were made to the range starting at 'alias_of', which must already be mapped.
+        if alias_of is None:
+            assert client not in self.clients, "use 'alias_of' to map a client at multiple addresses"
+            client.set_base_addr(base_addr)
+            self.clients.append(client)
+            if size is None:
+                size = client.get_size()
+            read = client.read
+            write = client.write
+        else:
+            assert client in self.clients
+            if size is None:
+                size = client.get_size()
+            assert self.owners[alias_of:alias_of+size].count(client) == size
+            delta = base_addr - alias_of
+            read = lambda addr: client.read(addr - delta)
+            write = lambda addr, data: client.write(addr - delta, data)
+        assert 0 <= base_addr and base_addr + size <= 0x10000
+        assert self.owners[base_addr:base_addr+size].count(None) == size, f"addresses 0x{base_addr:04x}-0x{base_addr+size-1:04x} are already mapped"
+        self.readers[base_addr:base_addr+size] = [read] * size
+        self.writers[base_addr:base_addr+size] = [write] * size
+        self.owners[base_addr:base_addr+size] = [client] * size
+    def _unmapped_read(self, addr: int) -> Optional[int]:
+        assert False, f"read from unmapped address 0x{addr:04x}"
+    def _unmapped_write(self, addr: int, data: Optional[int]) -> None:
+        assert False, f"write to unmapped address 0x{addr:04x}"
     def read(self, addr: int) -> int:
         addr &= 0xffff
-        return self.client_map[addr].read(addr)
+        return self.readers[addr](addr)
     def write(self, addr: int, data: int) -> None:
         addr &= 0xffff
-        self.client_map[addr].write(addr, data)
+        self.writers[addr](addr, data)
     def terminate(self) -> Sequence[SimEventBase]:
         ret_val = []
         for client in self.clients:
@@ -180,6 +457,8 @@ class Bus(object):
 def _safe_format(data: Optional[int]) -> str:
     return f"0x{data&0xffff:04x}" if data is not None else "*NONE*"
 class SimEventRead(SimEventBase):
+    level = TraceLevel.bus
+    kind = TraceKind.read
     def __init__(self, addr: int, data: int):
         self.addr = addr
         self.data = data
@@ -187,6 +466,8 @@ class SimEventRead(SimEventBase):
         return f"read MEM[{_safe_format(self.addr)}] returned {_safe_format(self.data)}"
 
 class SimEventWrite(SimEventBase):
+    level = TraceLevel.bus
+    kind = TraceKind.write
     def __init__(self, addr: int, data: int):
         self.addr = addr
         self.data = data
@@ -194,6 +475,8 @@ class SimEventWrite(SimEventBase):
         return f"write MEM[{_safe_format(self.addr)}] to {_safe_format(self.data)}"
 
 class SimEventRegUpdate(SimEventBase):
+    level = TraceLevel.register
+    kind = TraceKind.register
     def __init__(self, reg_name: str, old_data: int, data: int):
         self.reg_name = reg_name
         self.old_data = old_data
@@ -202,13 +485,17 @@ class SimEventRegUpdate(SimEventBase):
         return f"reg {self.reg_name} updated from {_safe_format(self.old_data)} to {_safe_format(self.data)}"
 
 class SimEventInstFetch(SimEventBase):
+    level = TraceLevel.instruction
+    kind = TraceKind.fetch
     def __init__(self, addr:int, data: int):
         self.addr = addr
         self.data = data
     def __str__(self):
-        return f"========\ninst fetch from {_safe_format(self.addr)}: {_safe_format(self.data)} ({disasm_inst(self.data) if self.data is not None else ""})"
+        return f"========\ninst fetch from {_safe_format(self.addr)}: {_safe_format(self.data)} ({decode_table[self.data].disasm if self.data is not None else ""})"
 
 class SimEventCpuStatus(SimEventBase):
+    level = TraceLevel.register
+    kind = TraceKind.status
     def __init__(self, pc:int, sp:int, r0:int, r1:int, inten:bool):
         self.pc = pc
         self.sp = sp
@@ -222,13 +509,67 @@ class SimEventCpuStatus(SimEventBase):
             {_safe_format(self.pc)}  {_safe_format(self.sp)}  {_safe_format(self.r0)}  {_safe_format(self.r1)}  {self.inten}
         """
 
+class SimEventBreakpoint(SimEventBase):
+    level = TraceLevel.instruction
+    def __init__(self, addr: int):
+        self.addr = addr
+    def __str__(self):
+        return f"BREAKPOINT AT {_safe_format(self.addr)}"
+
+class SimEventWatchpoint(SimEventBase):
+    level = TraceLevel.instruction
+    def __init__(self, is_write: bool, addr: int, data: Optional[int]):
+        self.is_write = is_write
+        self.addr = addr
+        self.data = data
+    def __str__(self):
+        if self.is_write:
+            return f"WATCHPOINT: write MEM[{_safe_format(self.addr)}] to {_safe_format(self.data)}"
+        return f"WATCHPOINT: read MEM[{_safe_format(self.addr)}] returned {_safe_format(self.data)}"
+
+class SimEventRegTrigger(SimEventBase):
+    level = TraceLevel.instruction
+    def __init__(self, reg_name: str, old_data: int, data: int):
+        self.reg_name = reg_name
+        self.old_data = old_data
+        self.data = data
+    def __str__(self):
+        return f"TRIGGER: reg {self.reg_name} changed from {_safe_format(self.old_data)} to {_safe_format(self.data)}"
+
+class SimEventIdle(SimEventBase):
+    level = TraceLevel.instruction
+    def __init__(self, cycles: int):
+        self.cycles = cycles
+    def act(self, simulator) -> None:
+        simulator.clk_count += self.cycles
+    def __str__(self) -> str:
+        return f"IDLE FOR {self.cycles} CYCLES"
+
 
 class Processor(object):
     def __init__(self, bus: Bus, system: 'System'):
         self.bus = bus
+        self.system = system
+        self.set_trace_level(TraceLevel.full)
         self.reset()
         system.register_for_clock(self)
         self.interrupt_pending = False
+        # If set, gets scheduled (see System.schedule) after every jump backwards
+        self.idle_hook: Optional[Callable[[], Sequence[SimEventBase]]] = None
+        # The boot ROM (see bootrom.py) while it answers instruction fetches
+        self.boot_rom: Optional['BootRom'] = None
+
+    def set_trace_level(self, level: TraceLevel) -> None:
+        # Events of disabled levels are not even created
+        self.trace_fetch = level >= SimEventInstFetch.level
+        self.trace_regs = level >= SimEventRegUpdate.level
+        self.trace_bus = level >= SimEventRead.level
+
+    # Everything that's needed to resume execution; see get_state/set_state
+    state_attrs = (
+        "pc", "sp", "r0", "r1", "inten", "in_reset", "interrupt_pending",
+        "phase", "inst", "alu_opa", "alu_opb", "mem_op_addr", "noskip", "skip_pc_update",
+    )
 
     def reset(self):
         self.pc = 0
@@ -238,6 +579,15 @@ class Processor(object):
         self.inten = False
         self.in_reset = True
         self.events = []
+        # State of the instruction in flight (see 'clock')
+        self.phase = PHASE_RESET_READ
+        self.inst = None
+        self.dec = None # decode_table[inst], once it's decoded
+        self.alu_opa = None
+        self.alu_opb = None
+        self.mem_op_addr = None
+        self.noskip = True
+        self.skip_pc_update = False
 
     def set_interrupt(self, is_interrupt: bool):
         # This is intentionally asynchronous.
@@ -245,29 +595,42 @@ class Processor(object):
 
     def _read_mem(self, addr: int) -> int:
         data = self.bus.read(addr)
-        self.events.append(SimEventRead(addr, data))
+        if self.trace_bus: self.events.append(SimEventRead(addr, data))
         return data
 
     def _write_mem(self, addr: int, data: int) -> None:
         self.bus.write(addr, data)
-        self.events.append(SimEventWrite(addr, data))
+        if self.trace_bus: self.events.append(SimEventWrite(addr, data))
 
     def _set_pc(self, data: int) -> None:
-        self.events.append(SimEventRegUpdate("$pc", self.pc, data))
+        if self.trace_regs: self.events.append(SimEventRegUpdate("$pc", self.pc, data))
         self.pc = data & 0xffff
 
     def _set_sp(self, data: int) -> None:
-        self.events.append(SimEventRegUpdate("$sp", self.sp, data))
+        if self.trace_regs: self.events.append(SimEventRegUpdate("$sp", self.sp, data))
         self.sp = data & 0xffff
 
     def _set_r0(self, data: int) -> None:
-        self.events.append(SimEventRegUpdate("$r0", self.r0, data))
+        if self.trace_regs: self.events.append(SimEventRegUpdate("$r0", self.r0, data))
         self.r0 = data & 0xffff
 
     def _set_r1(self, data: int) -> None:
-        self.events.append(SimEventRegUpdate("$r1", self.r1, data))
+        if self.trace_regs: self.events.append(SimEventRegUpdate("$r1", self.r1, data))
         self.r1 = data & 0xffff
 
+    def _load_reg(self, inst_field_opa: int, data: int) -> None:
+        # Same as _set_reg, but without generating an event
+        if inst_field_opa == OPA_PC:
+            self.pc = data & 0xffff
+        elif inst_field_opa == OPA_SP:
+            self.sp = data & 0xffff
+        elif inst_field_opa == OPA_R0:
+            self.r0 = data & 0xffff
+        elif inst_field_opa == OPA_R1:
+            self.r1 = data & 0xffff
+        else:
+            assert False
+
     def _set_reg(self, inst_field_opa: int, data: int) -> None:
         if inst_field_opa == OPA_PC:
             self._set_pc(data)
@@ -312,163 +675,548 @@ class Processor(object):
         else:
             assert False
 
-    def wait_clk(self):
+    def clock(self) -> Sequence[SimEventBase]:
+        # Simulates a single clock cycle and returns the events generated in it.
+        # The instruction in flight is tracked by 'phase' and the temporaries in 'inst', 'alu_opa', etc.,
+        # so simulation can be stopped and resumed (or the state saved and restored) at any clock.
+        self._phases[self.phase](self)
         events = self.events
+        if events:
+            self.events = []
+            return events
+        return ()
+
+    def _reset_read_vector(self) -> None:
+        # An enabled boot ROM answers the vector read with its own address (see bootrom.py)
+        rom = self.boot_rom
+        if rom is not None:
+            self.inst = rom.base_addr
+            if self.trace_bus: self.events.append(SimEventRead(0, self.inst))
+        else:
+            self.inst = self._read_mem(0)
+        self.phase = PHASE_RESET_WRITE_BACK
+    def _reset_write_back_vector(self) -> None:
+        if self.boot_rom is not None:
+            if self.trace_bus: self.events.append(SimEventWrite(0, self.inst))
+        else:
+            self._write_mem(0, self.inst)
+        self.phase = PHASE_RESET_SET_PC
+    def _reset_set_pc(self) -> None:
+        self._set_pc(self.inst)
+        self.in_reset = False
+        self.phase = PHASE_FETCH
+
+    def _fetch(self) -> None:
+        rom = self.boot_rom
+        if rom is not None and rom.base_addr <= self.pc < rom.end_addr:
+            self.inst = rom.words[self.pc - rom.base_addr]
+            if self.trace_bus: self.events.append(SimEventRead(self.pc, self.inst))
+        else:
+            self.inst = self._read_mem(self.pc)
+        if self.trace_fetch: self.events.append(SimEventInstFetch(self.pc, self.inst))
+        self.phase = PHASE_WRITE_BACK_INST
+    def _write_back_inst(self) -> None:
+        rom = self.boot_rom
+        if rom is not None and rom.base_addr <= self.pc < rom.end_addr:
+            if self.trace_bus: self.events.append(SimEventWrite(self.pc, self.inst))
+        else:
+            self._write_mem(self.pc, self.inst)
+        self.phase = PHASE_DECODE
+    def _decode(self) -> None:
+        # Handle interrupts by overriding the just fetched instruction
+        if self.interrupt_pending and self.inten:
+            self.inst = INTERRUPT_INST
+        self.dec = dec = decode_table[self.inst]
+        self.mem_op_addr = self._get_reg_b(dec.opb) + dec.immed
+        if dec.mem_ref:
+            self.alu_opb = self._read_mem(self.mem_op_addr)
+        else:
+            self.alu_opb = self.mem_op_addr
+        self.alu_opa = self._get_reg_a(dec.opa)
+        self.phase = PHASE_SWAP if dec.is_swap else PHASE_WRITE_BACK_OPB
+    def _swap(self) -> None:
+        dec = self.dec
+        self._set_reg(dec.opa, self.alu_opb + (dec.opb == OPB_IMMED_PC))
+        self.phase = PHASE_WRITE_BACK_OPB
+    def _write_back_opb(self) -> None:
+        dec = self.dec
+        if dec.mem_ref and not dec.mem_result:
+            self._write_mem(self.mem_op_addr, self.alu_opb)
+        self.phase = PHASE_EXECUTE
+    def _execute(self) -> None:
+        # Execute (most) instructions here
+        dec = self.dec
+        alu_result, self.noskip = dec.alu(self.alu_opa, self.alu_opb, self.inten)
+        self.skip_pc_update = False
+        if dec.mem_result:
+            if dec.is_swap:
+                if dec.opb in (OPB_IMMED_PC, OPB_IMMED_R0, OPB_IMMED_SP, OPB_IMMED):
+                    assert False, "SWAP between two registers is not supported"
+                self.skip_pc_update = dec.opa == OPA_PC
+            self._write_mem(self.mem_op_addr, alu_result)
+        elif dec.reg_result:
+            # The only case we have both of these set is SWAP/SWAPI and in
+            # those cases we've already done the register update in a previous
+            # clock cycle
+            self._set_reg(dec.opa, alu_result)
+            # If we update $pc here, we should not update pc in the next step.
+            # NOTE: none of the predicates that can clear 'noskip' update $pc,
+            #       so we're fine completely skipping that step
+            self.skip_pc_update = dec.opa == OPA_PC
+        self.phase = PHASE_UPDATE_PC
+    def _update_pc(self) -> None:
+        dec = self.dec
+        # Update PC
+        if not self.skip_pc_update:
+            self._set_pc(self.pc + (1 if self.noskip else 2))
+        elif self.idle_hook is not None and self.pc <= self.alu_opa:
+            self.system.schedule(0, self.idle_hook)
+        # Update inten
+        if dec.is_swap and dec.d == 0:
+            self.inten = not self.inten
+        if self.trace_regs: self.events.append(SimEventCpuStatus(self.pc, self.sp, self.r0, self.r1, self.inten))
+        self.phase = PHASE_FETCH
+
+    # Phase handlers, indexed by 'phase'
+    _phases = (
+        _fetch, _write_back_inst, _decode, _swap, _write_back_opb, _execute, _update_pc,
+        _reset_read_vector, _reset_write_back_vector, _reset_set_pc,
+    )
+
+    def step(self) -> int:
+        # Functional equivalent of a sequence of calls to 'clock': executes the reset
+        # sequence or a whole instruction in one go, without generating any events.
+        # Returns the number of clock cycles 'clock' would have been called to do the same.
+        #
+        # If the system requests a stop (i.e. the terminator port is written), we bail out
+        # after the offending write and the one clock cycle System.run still simulates after it
+        # (see '_stop'), and only return the cycles spent up to that point.
+        bus = self.bus
+        system = self.system
+        if self.phase != PHASE_FETCH and self.phase != PHASE_RESET_READ:
+            return self._finish_instruction()
+        if self.in_reset:
+            if self.boot_rom is not None:
+                new_pc = self.boot_rom.base_addr
+            else:
+                new_pc = bus.read(0)
+                bus.write(0, new_pc)
+            if system.stop_requested: return RESET_CYCLES - 1 + self._stop(PHASE_RESET_SET_PC, new_pc)
+            self.pc = new_pc & 0xffff
+            self.in_reset = False
+            self.phase = PHASE_FETCH
+            return RESET_CYCLES
+
+        rom = self.boot_rom
+        if rom is not None and rom.base_addr <= self.pc < rom.end_addr:
+            inst = rom.words[self.pc - rom.base_addr]
+        else:
+            inst = bus.read(self.pc)
+            bus.write(self.pc, inst)
+            if system.stop_requested: return 2 + self._stop(PHASE_DECODE, inst)
+
+        # Handle interrupts by overriding the just fetched instruction
+        if self.interrupt_pending and self.inten:
+            inst = INTERRUPT_INST
+
+        inst_field_opcode, inst_field_d, inst_field_opb, inst_field_opa, inst_field_immed, mem_ref, mem_result, reg_result, is_swap, is_predicate, alu, cycles, disasm = decode_table[inst]
+
+        mem_op_addr = self._get_reg_b(inst_field_opb) + inst_field_immed
+        if mem_ref:
+            alu_opb = bus.read(mem_op_addr)
+        else:
+            alu_opb = mem_op_addr
+        alu_opa = self._get_reg_a(inst_field_opa)
+
+        if is_swap:
+            self._load_reg(inst_field_opa, alu_opb + (inst_field_opb == OPB_IMMED_PC))
+        if mem_ref and not mem_result:
+            bus.write(mem_op_addr, alu_opb)
+            if system.stop_requested:
+                self.mem_op_addr, self.alu_opa, self.alu_opb = mem_op_addr, alu_opa, alu_opb
+                return cycles - 2 + self._stop(PHASE_EXECUTE, inst)
+
+        alu_result, noskip = alu(alu_opa, alu_opb, self.inten)
+        skip_pc_update = False
+        if mem_result:
+            if is_swap:
+                if inst_field_opb in (OPB_IMMED_PC, OPB_IMMED_R0, OPB_IMMED_SP, OPB_IMMED):
+                    assert False, "SWAP between two registers is not supported"
+                skip_pc_update = inst_field_opa == OPA_PC
+            bus.write(mem_op_addr, alu_result)
+            if system.stop_requested:
+                self.mem_op_addr, self.alu_opa, self.alu_opb = mem_op_addr, alu_opa, alu_opb
+                self.noskip, self.skip_pc_update = noskip, skip_pc_update
+                return cycles - 1 + self._stop(PHASE_UPDATE_PC, inst)
+        elif reg_result:
+            self._load_reg(inst_field_opa, alu_result)
+            skip_pc_update = inst_field_opa == OPA_PC
+
+        if not skip_pc_update:
+            self.pc = (self.pc + (1 if noskip else 2)) & 0xffff
+        if is_swap and inst_field_d == 0:
+            self.inten = not self.inten
+        return cycles
+
+    def _stop(self, phase: int, inst: int) -> int:
+        # Called by 'step' (and translated blocks) right after a write that requested a stop, with the
+        # instruction in flight at 'phase' and the temporaries of the earlier phases set. Clocks the cycle
+        # System.run simulates after the write (see Terminator), so all modes stop in the same state.
+        self.phase = phase
+        self.inst = inst
+        self.dec = decode_table[inst] if PHASE_DECODE < phase <= PHASE_UPDATE_PC else None
+        self.clock()
         self.events = []
-        yield events
+        return 1
 
-    def simulate(self):
+    def _finish_instruction(self) -> int:
+        # We're in the middle of an instruction (or the reset sequence), most likely because
+        # we were restored from a state that was saved during 'run'. Finish it clock-by-clock.
+        cycles = 0
         while True:
-            if self.in_reset:
-                new_pc = self._read_mem(0)
-                yield from self.wait_clk()
-                self._write_mem(0, new_pc)
-                yield from self.wait_clk()
-                self._set_pc(new_pc)
-                yield from self.wait_clk()
-                self.in_reset = False
-            else:
-                inst = self._read_mem(self.pc)
-                self.events.append(SimEventInstFetch(self.pc, inst))
-                yield from self.wait_clk()
-                self._write_mem(self.pc, inst)
-                yield from self.wait_clk()
-
-                # Handle interrupts by overriding the just fetched instruction
-                if self.interrupt_pending and self.inten:
-                    inst = (INST_SWAP << OPCODE_OFS) | (0 << D_OFS) | (OPB_MEM_IMMED << OPB_OFS) | (OPA_PC << OPA_OFS) | (1 << IMMED_OFS)
-
-                inst_field_opcode = (inst >> OPCODE_OFS) & 0xf
-                inst_field_d = (inst >> D_OFS) & 0x1
-                inst_field_opb = (inst >> OPB_OFS) & 0x7
-                inst_field_opa = (inst >> OPA_OFS) & 3
-                raw_inst_field_immed = (inst >> IMMED_OFS) & IMMED_MASK
-                inst_field_immed = _make_signed(raw_inst_field_immed, IMMED_MASK.bit_length())
-                mem_ref = inst_field_opb in (OPB_MEM_IMMED_PC, OPB_MEM_IMMED_SP, OPB_MEM_IMMED_R0, OPB_MEM_IMMED)
-                mem_result = (inst_field_d == 1 or inst_field_opcode == INST_SWAP) and not inst_field_opcode in (INST_EQ,INST_LTU,INST_LTS,INST_LES,)
-                reg_result = (inst_field_d == 0 or inst_field_opcode == INST_SWAP) and not inst_field_opcode in (INST_EQ,INST_LTU,INST_LTS,INST_LES,)
-                alu_opa = None
-                alu_opb = None
-                mem_op_addr = self._get_reg_b(inst_field_opb) + inst_field_immed
-                if mem_ref:
-                    alu_opb = self._read_mem(mem_op_addr)
-                else:
-                    alu_opb = mem_op_addr
-                alu_opa = self._get_reg_a(inst_field_opa)
-                yield from self.wait_clk()
-
-                if inst_field_opcode == INST_SWAP:
-                    self._set_reg(inst_field_opa, alu_opb + (inst_field_opb == OPB_IMMED_PC))
-                    yield from self.wait_clk()
-                if mem_ref and not mem_result:
-                    self._write_mem(mem_op_addr, alu_opb)
-                yield from self.wait_clk()
-
-                # Execute (most) instructions here
-                # Binary ops
-                alu_result = None
-                noskip = True
-                skip_pc_update = False
-                if inst_field_opcode == INST_SWAP:
-                    alu_result = alu_opa + (inst_field_opa == OPA_PC)
-                elif inst_field_opcode == INST_OR:
-                    alu_result = alu_opa | alu_opb
-                elif inst_field_opcode == INST_AND:
-                    alu_result = alu_opa & alu_opb
-                elif inst_field_opcode == INST_XOR:
-                    alu_result = alu_opa ^ alu_opb
-                elif inst_field_opcode == INST_ADD:
-                    alu_result = (alu_opa + alu_opb) & 0xffff
-                elif inst_field_opcode == INST_SUB:
-                    alu_result = (alu_opa - alu_opb) & 0xffff
-                elif inst_field_opcode == INST_ISUB:
-                    alu_result = (alu_opb - alu_opa) & 0xffff
-                elif inst_field_opcode == INST_UNK:
-                    alu_result = alu_opa # this is an unused instruction code, but I don't want the simulator to blow up if it encounters it
-                # Unary ops:
-                elif inst_field_opcode == INST_MOV:
-                    if inst_field_d == 0:
-                        alu_result = alu_opb
-                    else:
-                        alu_result = alu_opa
-                elif inst_field_opcode == INST_ISTAT:
-                    alu_result = 2 if self.inten else 0
-                elif inst_field_opcode == INST_ROR:
-                    if inst_field_d == 0:
-                        alu_result = _ror(alu_opa)
-                    else:
-                        alu_result = _ror(alu_opb)
-                elif inst_field_opcode == INST_ROL:
-                    if inst_field_d == 0:
-                        alu_result = _rol(alu_opa)
-                    else:
-                        alu_result = _rol(alu_opb)
-                # Predicate ops (their inverse comes from the 'D' bit):
-                elif inst_field_opcode == INST_EQ:
-                    if inst_field_d == 0:
-                        noskip = alu_opa == alu_opb
-                    else:
-                        noskip = alu_opa != alu_opb
-                elif inst_field_opcode == INST_LTU:
-                    if inst_field_d == 0:
-                        noskip = alu_opa < alu_opb
-                    else:
-                        noskip = alu_opa >= alu_opb
-                elif inst_field_opcode == INST_LTS:
-                    if inst_field_d == 0:
-                        noskip = _make_signed(alu_opa, 16) < _make_signed(alu_opb, 16)
-                    else:
-                        noskip = _make_signed(alu_opa, 16) >= _make_signed(alu_opb, 16)
-                elif inst_field_opcode == INST_LES:
-                    if inst_field_d == 0:
-                        noskip = _make_signed(alu_opa, 16) <= _make_signed(alu_opb, 16)
-                    else:
-                        noskip = _make_signed(alu_opa, 16) > _make_signed(alu_opb, 16)
-                else:
-                    # We have one unused code, but I don't know yet what to do about it...
-                    assert False
-                if mem_result:
-                    if inst_field_opcode == INST_SWAP:
-                        if inst_field_opb in (OPB_IMMED_PC, OPB_IMMED_R0, OPB_IMMED_SP, OPB_IMMED):
-                            assert False, "SWAP between two registers is not supported"
-                        skip_pc_update = inst_field_opa == OPA_PC
-                    self._write_mem(mem_op_addr, alu_result)
-                elif reg_result:
-                    # The only case we have both of these set is SWAP/SWAPI and in
-                    # those cases we've already done the register update in a previous
-                    # clock cycle
-                    self._set_reg(inst_field_opa, alu_result)
-                    # If we update $pc here, we should not update pc in the next step.
-                    # NOTE: none of the predicates that can clear 'noskip' update $pc,
-                    #       so we're fine completely skipping that step
-                    skip_pc_update = inst_field_opa == OPA_PC
-                yield from self.wait_clk()
-                # Update PC
-                if not skip_pc_update:
-                    self._set_pc(self.pc + (1 if noskip else 2))
-                # Update inten
-                if inst_field_opcode == INST_SWAP and inst_field_d == 0:
-                    self.inten = not self.inten
-                self.events.append(SimEventCpuStatus(self.pc, self.sp, self.r0, self.r1, self.inten))
-                yield from self.wait_clk()
+            self.clock()
+            cycles += 1
+            if self.system.stop_requested:
+                self.clock()
+                cycles += 1
+                break
+            if self.phase == PHASE_FETCH:
+                break
+        self.events = []
+        return cycles
+
+    def get_state(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.state_attrs}
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        for name in self.state_attrs:
+            setattr(self, name, state[name])
+        self.dec = decode_table[self.inst] if PHASE_DECODE < self.phase <= PHASE_UPDATE_PC else None
+        self.events = []
+
     def terminate(self) -> Sequence[SimEventBase]:
         return (SimEventCpuStatus(self.pc, self.sp, self.r0, self.r1, self.inten),)
 
+class Watchpoint(object):
+    def __init__(self, addr: int, on_read: bool, on_write: bool, condition: Optional[Callable[[Optional[int]], bool]]):
+        self.addr = addr
+        self.on_read = on_read
+        self.on_write = on_write
+        self.condition = condition
+
+class RegTrigger(object):
+    def __init__(self, reg_name: str, condition: Optional[Callable[[int], bool]]):
+        self.reg_name = reg_name
+        self.attr = reg_name[1:]
+        self.condition = condition
+
+def _make_condition(value: Optional[int], condition: Optional[Callable[[Optional[int]], bool]]) -> Optional[Callable[[Optional[int]], bool]]:
+    if value is None:
+        return condition
+    assert condition is None, "specify either a value or a condition, not both"
+    return lambda data: data == value
+
+class Debugger(object):
+    # Breakpoints, watchpoints and register triggers for System.run_until.
+    #
+    # Breakpoints are a flag per address, checked once per instruction. Watchpoints replace the
+    # bus dispatch entries of the watched addresses with checking wrappers, so accesses to other
+    # addresses don't pay anything. Register triggers are checked after every instruction, but
+    # only if there are any.
+    def __init__(self, system: 'System'):
+        self.system = system
+        self.bus = system.bus
+        self.pc_map = bytearray(0x10000)
+        self.watchpoints: Dict[int, List[Watchpoint]] = {}
+        self.orig_handlers: Dict[int, Tuple[Callable, Callable]] = {}
+        self.reg_triggers: List[RegTrigger] = []
+        self.hit: Optional[SimEventBase] = None
+        # The address of the breakpoint we've last stopped at. We don't stop there again when resuming.
+        self.break_pc: Optional[int] = None
+
+    def add_breakpoint(self, addr: int) -> None:
+        self.pc_map[addr & 0xffff] = 1
+    def remove_breakpoint(self, addr: int) -> None:
+        self.pc_map[addr & 0xffff] = 0
+
+    def add_watchpoint(
+        self,
+        addr: int,
+        *,
+        on_read: bool = False,
+        on_write: bool = True,
+        value: Optional[int] = None,
+        condition: Optional[Callable[[Optional[int]], bool]] = None
+    ) -> Watchpoint:
+        # Stops on reads and/or writes of 'addr', optionally only if the data equals 'value' or satisfies 'condition'.
+        # Remember that every read is followed by a write-back of the same value.
+        addr &= 0xffff
+        watchpoint = Watchpoint(addr, on_read, on_write, _make_condition(value, condition))
+        if addr not in self.watchpoints:
+            self.watchpoints[addr] = []
+            self._install(addr)
+        self.watchpoints[addr].append(watchpoint)
+        return watchpoint
+    def remove_watchpoint(self, watchpoint: Watchpoint) -> None:
+        watchpoints = self.watchpoints[watchpoint.addr]
+        watchpoints.remove(watchpoint)
+        if len(watchpoints) == 0:
+            del self.watchpoints[watchpoint.addr]
+            self.bus.readers[watchpoint.addr], self.bus.writers[watchpoint.addr] = self.orig_handlers.pop(watchpoint.addr)
+
+    def add_reg_trigger(
+        self,
+        reg_name: str,
+        *,
+        value: Optional[int] = None,
+        condition: Optional[Callable[[int], bool]] = None
+    ) -> RegTrigger:
+        # Stops if register 'reg_name' ($pc, $sp, $r0 or $r1) changes, optionally only to 'value' or to something that satisfies 'condition'
+        assert reg_name in ("$pc", "$sp", "$r0", "$r1")
+        trigger = RegTrigger(reg_name, _make_condition(value, condition))
+        self.reg_triggers.append(trigger)
+        return trigger
+    def remove_reg_trigger(self, trigger: RegTrigger) -> None:
+        self.reg_triggers.remove(trigger)
+
+    def _install(self, addr: int) -> None:
+        read = self.bus.readers[addr]
+        write = self.bus.writers[addr]
+        self.orig_handlers[addr] = (read, write)
+        watchpoints = self.watchpoints[addr]
+        def watched_read(addr: int) -> Optional[int]:
+            data = read(addr)
+            for watchpoint in watchpoints:
+                if watchpoint.on_read and (watchpoint.condition is None or watchpoint.condition(data)):
+                    self._stop(SimEventWatchpoint(False, addr, data))
+            return data
+        def watched_write(addr: int, data: Optional[int]) -> None:
+            write(addr, data)
+            for watchpoint in watchpoints:
+                if watchpoint.on_write and (watchpoint.condition is None or watchpoint.condition(data)):
+                    self._stop(SimEventWatchpoint(True, addr, data))
+        self.bus.readers[addr] = watched_read
+        self.bus.writers[addr] = watched_write
+
+    def _stop(self, event: SimEventBase) -> None:
+        # The first reason to stop wins
+        if self.hit is None:
+            self.hit = event
+
+    def _get_regs(self) -> Tuple[int, ...]:
+        cpu = self.system.cpu
+        return tuple(getattr(cpu, trigger.attr) for trigger in self.reg_triggers)
+
+    def _check_regs(self, old_regs: Tuple[int, ...]) -> None:
+        cpu = self.system.cpu
+        for trigger, old_data in zip(self.reg_triggers, old_regs):
+            data = getattr(cpu, trigger.attr)
+            if data != old_data and (trigger.condition is None or trigger.condition(data)):
+                self._stop(SimEventRegTrigger(trigger.reg_name, old_data, data))
+
+class ForkError(Exception):
+    def __init__(self, message: str):
+        self.message = message
+    def __str__(self) -> str:
+        return self.message
+
 TERMINATE_ADDR = 0xffff
+NEVER = sys.maxsize
 class System(object):
-    def __init__(self):
-        self.clock_consumers = set()
-        self.generators: Set[Generator] = set()
-        self.mem = Memory(16384, self) # We have 16k of core memory
-        self.term = Terminator(self)
+    def __init__(self, trace: Optional[TraceSinkBase] = None, *, paged_memory: bool = False, skip_idle: bool = False):
+        # Clock consumers are simulated in the order of registration. The CPU comes first,
+        # so devices see bus activity in the same clock cycle it happens.
+        # Devices that don't need to see every clock cycle post wake-ups instead (see 'schedule').
+        # With 'paged_memory' set, forks (see 'fork') share memory pages until they get modified.
+        # With 'skip_idle' set, simulated time jumps ahead over idle loops (see idle.py). It's off by
+        # default, so cycle-exact runs don't depend on the detector.
+        self.clock_consumers = []
+        self.event_queue: List[List[Any]] = [] # heap of [cycle, sequence number, callback]
+        self.event_seq = 0
+        self.next_event = NEVER
+        self.stop_requested = False
+        self.terminated = False
+        self.clk_count = 0
+        self.mem = (PagedMemory if paged_memory else Memory)(16384, self) # We have 16k of core memory
         self.bus = Bus(self)
+        self.cpu = Processor(self.bus, self)
+        self.term = Terminator(self)
         self.bus.register(0, self.mem)
         self.bus.register(TERMINATE_ADDR, self.term)
-        self.cpu = Processor(self.bus, self)
+        self.io_ports = register_io_ports(self.bus)
+        self.devices: Dict[str, Any] = {} # Device models attached to the I/O ports (see 'add_device')
+        self.block_cache: Optional[BlockCache] = None
+        self.debugger = Debugger(self)
+        self.hle: Optional[HleTable] = None
+        self.idle = IdleDetector(self) if skip_idle else None
+        self.cpu.idle_hook = self._idle_wake_up if skip_idle else None
+        self.run_end = 0
+        self.set_trace(trace if trace is not None else TextTraceSink(TraceLevel.full))
+
+    def set_trace(self, trace: TraceSinkBase) -> None:
+        self.trace = trace
+        self.cpu.set_trace_level(trace.level)
+
+    def reset(self) -> None:
+        # Brings the system back to its power-on state with cleared memory, so the same
+        # instance can be re-used to run another program.
+        self._stop_idle()
+        self.mem.clear(self.mem.base_addr, self.mem.size)
+        self.cpu.reset()
+        self.cpu.interrupt_pending = False
+        self.term.reset()
+        for port in self.io_ports.values():
+            port.reset()
+        self.clear_events()
+        for device in self.devices.values():
+            device.reset()
+        self.stop_requested = False
+        self.terminated = False
+        self.clk_count = 0
+
+    def add_device(self, name: str, device: Any) -> None:
+        # Registers a device model (see tape.py), which has 'reset', 'get_state' and 'set_state'
+        # methods and is part of the state of the system from then on. Its 'fork' method creates
+        # the same device, in the same state, on another system (see System.fork). Devices that
+        # hold on to files and the like also have a 'close' method (see System.close).
+        assert name not in self.devices, f"there's already a device called {name}"
+        self.devices[name] = device
+
+    def close(self) -> None:
+        # Closes all devices that need closing. The system can't be simulated any further after this.
+        for device in self.devices.values():
+            close = getattr(device, "close", None)
+            if close is not None:
+                close()
+
+    def get_state(self) -> Dict[str, Any]:
+        # Returns the complete state of the system (even in the middle of an instruction) as a
+        # picklable dict. Trace sinks and caches are not part of the state, neither are pending
+        # wake-ups: devices that have any should post them again from their own 'set_state'.
+        return {
+            "clk_count": self.clk_count,
+            "stop_requested": self.stop_requested,
+            "terminated": self.terminated,
+            "cpu": self.cpu.get_state(),
+            "mem": self.mem.get_state(),
+            "term": self.term.get_state(),
+            "io_ports": {name: port.get_state() for name, port in self.io_ports.items()},
+            "devices": {name: device.get_state() for name, device in self.devices.items()},
+        }
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        self._stop_idle()
+        self.clear_events()
+        self.clk_count = state["clk_count"]
+        self.stop_requested = state["stop_requested"]
+        self.terminated = state["terminated"]
+        self.cpu.set_state(state["cpu"])
+        self.mem.set_state(state["mem"])
+        self.term.set_state(state["term"])
+        for name, port_state in state["io_ports"].items():
+            self.io_ports[name].set_state(port_state)
+        for name, device_state in state["devices"].items():
+            self.devices[name].set_state(device_state)
+
+    def fork(self, trace: Optional[TraceSinkBase] = None) -> 'System':
+        # Returns a new, independent System in the same state as this one. Devices (see 'add_device')
+        # are forked too; they and the terminator post their own wake-ups again. The pending wake-ups of
+        # the system and the CPU are carried over. Anything else on the event queue can't be, and raises
+        # a ForkError. Breakpoints and the like (see 'debugger') are not copied. Without a 'trace', the
+        # fork doesn't trace.
+        paged_memory = isinstance(self.mem, PagedMemory)
+        skip_idle = self.idle is not None
+        child = System(trace if trace is not None else NullTraceSink(), paged_memory=paged_memory, skip_idle=skip_idle)
+        child.clk_count = self.clk_count
+        child.clear_events()
+        child.stop_requested = self.stop_requested
+        child.terminated = self.terminated
+        child.cpu.set_state(self.cpu.get_state())
+        child.mem.copy_from(self.mem)
+        child.term.set_state(self.term.get_state())
+        for name, port in self.io_ports.items():
+            child.io_ports[name].set_state(port.get_state())
+        for device in self.devices.values():
+            device.fork(child)
+        owners = {id(self): child, id(self.cpu): child.cpu}
+        reposted = set(id(device) for device in self.devices.values())
+        reposted.add(id(self.term))
+        for clk, _, callback in sorted(self.event_queue, key=lambda entry: entry[:2]):
+            if callback is None:
+                continue
+            owner = getattr(callback, "__self__", None)
+            if id(owner) in reposted:
+                continue
+            if id(owner) not in owners:
+                raise ForkError(f"Can't fork with {callback} pending at cycle {clk}")
+            child.schedule(clk - child.clk_count, getattr(owners[id(owner)], callback.__name__))
+        return child
+
+    def save_state(self, file_name: str) -> None:
+        with open(file_name, "wb") as f:
+            pickle.dump(self.get_state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_state(self, file_name: str) -> None:
+        with open(file_name, "rb") as f:
+            self.set_state(pickle.load(f))
+
+    def schedule(self, delay: int, callback: Callable[[], Sequence[SimEventBase]]) -> List[Any]:
+        # Calls 'callback' at the end of clock cycle 'clk_count + delay'. The events it returns are
+        # traced and acted upon the same way the events of clock consumers are. Can be called from
+        # bus accesses as well: a delay of 0 then means the end of the current cycle. In the
+        # instruction-level modes (simulate_fast, run_until) callbacks are only called on instruction
+        # boundaries, and 'clk_count' is that of the start of the current instruction.
+        # Returns a handle that can be passed to 'cancel'.
+        entry = [self.clk_count + delay, self.event_seq, callback]
+        self.event_seq += 1
+        heappush(self.event_queue, entry)
+        self.next_event = self.event_queue[0][0]
+        return entry
+
+    def cancel(self, entry: List[Any]) -> None:
+        entry[2] = None
+
+    def clear_events(self) -> None:
+        self.event_queue = []
+        self.next_event = NEVER
+
+    def _pop_events(self, end: int) -> List[SimEventBase]:
+        # Calls all callbacks that are due before cycle 'end' and returns the events they generated
+        events = []
+        queue = self.event_queue
+        while queue and queue[0][0] < end:
+            callback = heappop(queue)[2]
+            if callback is not None:
+                events += callback()
+        self.next_event = queue[0][0] if queue else NEVER
+        return events
+
+    def run_events(self) -> None:
+        # Calls all callbacks that are due before 'clk_count', for the instruction-level modes
+        for event in self._pop_events(self.clk_count):
+            if event.level <= self.trace.level:
+                self.trace.emit(self.clk_count, event)
+            event.act(self)
+
+    def add_hle(self, routine: HleRoutine) -> None:
+        # Registers a high-level emulated routine (see hle.py); used by 'simulate_fast'
+        if self.hle is None:
+            self.hle = HleTable(self)
+        self.hle.register(routine)
+
+    def _idle_wake_up(self) -> Sequence[SimEventBase]:
+        # Scheduled by the CPU after jumps backwards in clock-by-clock mode. We're at the end of the last
+        # cycle of the jump.
+        cycles = self.idle.jumped(self.clk_count + 1, self.run_end)
+        return (SimEventIdle(cycles), ) if cycles else ()
+
+    def _stop_idle(self) -> None:
+        if self.idle is not None:
+            self.idle.stop()
 
     def register_for_clock(self, client):
         if client not in self.clock_consumers:
-            self.clock_consumers.add(client)
+            self.clock_consumers.append(client)
 
     def load_asm(self, asm: str) -> None:
         base_addr, words = assemble(asm)
@@ -477,34 +1225,178 @@ class System(object):
     def load(self, base_addr: int, words: Sequence[int]) -> None:
         self.mem.load(base_addr, words)
 
+    def run(self, cycles: int) -> None:
+        # Simulates (at most) 'cycles' clock cycles, clock-by-clock. Every clock consumer is
+        # clocked in the order of registration, then the events of the cycle are traced and acted upon.
+        # Stops early if the simulation terminates. Can be called repeatedly to continue the simulation.
+        # Idle loops are skipped over (see SimEventIdle), without generating events for the skipped cycles.
+        clocks = tuple(consumer.clock for consumer in self.clock_consumers)
+        trace = self.trace
+        trace_level = trace.level
+        end = self.clk_count + cycles
+        self.run_end = end
+        clk = self.clk_count
+        while clk < end:
+            for clk in range(clk, end):
+                self.clk_count = clk
+                events = None
+                for clock in clocks:
+                    clock_events = clock()
+                    if clock_events:
+                        if events is None:
+                            events = list(clock_events)
+                        else:
+                            events += clock_events
+                if clk >= self.next_event:
+                    # These go first, the way the Terminator's used to when it was a clock consumer
+                    due_events = self._pop_events(clk+1)
+                    if due_events:
+                        if events is None:
+                            events = due_events
+                        else:
+                            events[:0] = due_events
+                if events is None:
+                    continue
+                #print(f"======= CLK {clk} =========")
+                for event in events:
+                    if event.level <= trace_level:
+                        trace.emit(clk, event)
+                self.clk_count = clk+1
+                for event in events:
+                    event.act(self)
+                if self.terminated:
+                    self._stop_idle()
+                    return
+                if self.clk_count != clk+1:
+                    # We've skipped ahead (see SimEventIdle)
+                    clk = self.clk_count
+                    break
+            else:
+                break
+        self._stop_idle()
+        self.clk_count = end
+
+    def step(self) -> None:
+        # Simulates a single clock cycle
+        self.run(1)
+
     def simulate(self, clock_count: int) -> None:
         self.terminated = False
-        self.generators.clear()
-        for consumer in self.clock_consumers:
-            self.generators.add(consumer.simulate())
-        for clk in range(clock_count+1):
-            events = []
-            for generator in self.generators:
-                events += generator.send(None)
-            #print(f"======= CLK {clk} =========")
-            for event in events:
-                print("    " + str(event))
-            for event in events:
-                event.act(self)
-            if self.terminated: break
+        self.run(clock_count+1)
+
+    def simulate_fast(self, clock_count: int, *, translate: bool = False) -> None:
+        # Functional counterpart of 'simulate': executes whole instructions at a time
+        # and doesn't generate events. The architectural state, memory content and the
+        # number of clock cycles ('clk_count') at termination are the same as what 'simulate'
+        # produces. A timeout is only checked on instruction boundaries though.
+        #
+        # With 'translate' set, straight-line code is executed through translated blocks
+        # (see translate.py). Routines registered with 'add_hle' are run in place of the code they emulate.
+        self.terminated = False
+        self.stop_requested = False
+        cpu = self.cpu
+        if translate:
+            if self.block_cache is None:
+                self.block_cache = BlockCache(self)
+            step = self.block_cache.step
+        else:
+            step = lambda clock_budget: cpu.step()
+        if self.hle is not None:
+            step = self.hle.wrap(step)
+        idle = self.idle
+        clk_count = self.clk_count
+        end = clk_count + clock_count
+        while clk_count <= end:
+            self.clk_count = clk_count
+            pc = cpu.pc
+            if idle is None or idle.head is None:
+                next_event = self.next_event
+                clk_count += step((end if end < next_event else next_event) - clk_count)
+            else:
+                # Translated blocks don't go through the bus methods the detector watches
+                clk_count += cpu.step()
+            if cpu.pc <= pc and idle is not None and not self.stop_requested:
+                if idle.backoff:
+                    idle.backoff -= 1
+                else:
+                    clk_count += idle.jumped(clk_count, end)
+            if clk_count > self.next_event and not self.stop_requested:
+                self.clk_count = clk_count
+                self.run_events()
+            if self.stop_requested:
+                if SimEventTerminate.level <= self.trace.level:
+                    self.trace.emit(clk_count, SimEventTerminate(self.term.exit_code))
+                self.terminate()
+                break
+        self._stop_idle()
+        self.clk_count = clk_count
+
+    def run_until(self, clock_count: int) -> Optional[SimEventBase]:
+        # Executes instructions (the same way 'simulate_fast' does) until a breakpoint, watchpoint or
+        # register trigger set up in 'debugger' fires, the simulation terminates or 'clock_count' clock
+        # cycles elapse. Returns the event that stopped the simulation (None for a timeout).
+        # Breakpoints stop before the instruction at their address; all other conditions after
+        # the instruction that triggered them. Call again to continue.
+        self.terminated = False
+        self.stop_requested = False
+        cpu = self.cpu
+        debugger = self.debugger
+        pc_map = debugger.pc_map
+        debugger.hit = None
+        break_pc = debugger.break_pc
+        debugger.break_pc = None
+        start = self.clk_count
+        clk_count = start
+        hit = None
+        while clk_count - start <= clock_count:
+            if pc_map[cpu.pc] and not cpu.in_reset and cpu.phase == PHASE_FETCH:
+                if cpu.pc != break_pc:
+                    debugger.break_pc = cpu.pc
+                    hit = SimEventBreakpoint(cpu.pc)
+                    break
+            break_pc = None
+            self.clk_count = clk_count
+            if debugger.reg_triggers:
+                old_regs = debugger._get_regs()
+                clk_count += cpu.step()
+                debugger._check_regs(old_regs)
+            else:
+                clk_count += cpu.step()
+            if clk_count > self.next_event and not self.stop_requested:
+                self.clk_count = clk_count
+                self.run_events()
+            if self.stop_requested:
+                hit = SimEventTerminate(self.term.exit_code)
+                break
+            if debugger.hit is not None:
+                hit = debugger.hit
+                break
+        self.clk_count = clk_count
+        if hit is not None and hit.level <= self.trace.level:
+            self.trace.emit(clk_count, hit)
+        if self.stop_requested:
+            self.terminate()
+        return hit
 
     def terminate(self):
-        events = []
-        events += self.cpu.terminate()
-        events += self.bus.terminate()
-        print("********************************")
-        for event in events:
-            print("    " + str(event))
+        if self.trace.level > TraceLevel.none:
+            events = []
+            events += self.cpu.terminate()
+            events += self.bus.terminate()
+            self.trace.emit_summary(self.clk_count, events)
         self.terminated = True
 
 
 if __name__ == "__main__":
-    sim = System()
+    trace_level = TraceLevel.full
+    trace = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--trace="):
+            trace_level = TraceLevel[arg[len("--trace="):]]
+        if arg.startswith("--bintrace="):
+            from bintrace import BinaryTraceSink
+            trace = BinaryTraceSink(arg[len("--bintrace="):])
+    sim = System(trace if trace is not None else TextTraceSink(trace_level), skip_idle=True)
     sim.load(0, (0x1000,)) # reset vector
     '''
     sim.load_asm(
@@ -714,10 +1606,15 @@ if __name__ == "__main__":
             mov $pc, $pc
         """
     )
-    sim.simulate(5000)
+    if "--translate" in sys.argv or "--fast" in sys.argv:
+        sim.simulate_fast(5000, translate="--translate" in sys.argv)
+        print(f"    SIMULATED {sim.clk_count} CLOCK CYCLES")
+    else:
+        sim.simulate(5000)
     if not sim.terminated:
         print("    TIMEOUT IN SIMULATION")
         sim.terminate()
+    sim.trace.close()
     if sim.mem.compare(
         {
             0x0000: (0x1000, 0x0003, 0x0004, 0x0005, 0x0006, 0x0007, 0x108c),
@@ -0,0 +1,326 @@
+# Tape transport model (see isa/micro_architecture.md)
+#
+# A tape image is a flat file of cells, one byte each: the state of the (up to 8) bit lanes
+# for half a bit-time, the shortest interval on an MFM-coded tape. Blocks, sync sequences and
+# the gaps between them (see mfm.py) are simply what's recorded on the tape; an hour of tape
+# at 4800 baud is some 35 million cells, so images are accessed through mmap and never read
+# as a whole.
+#
+# The drive hooks into the tape ports registered by iomap: writes to the control port press
+# and release the transport buttons, writes to the record port set the lanes being recorded,
+# and the playback port shows the lanes under the head. Nothing is simulated per clock cycle:
+# the position of the tape is a linear function of time between speed changes, and everything
+# else (motor start and stop, reaching either end of the tape, playback edges) is a wake-up
+# posted on the system's event queue (see System.schedule). Long stretches of unchanged
+# cells, like block gaps, cost a single wake-up.
+#
+# The motor is modeled crudely: it takes 'start_cycles' for the tape to get going, during
+# which it doesn't move, and the tape coasts at full speed for 'stop_cycles' after the motor
+# is turned off. Changing direction means stopping first. The heads are lifted while winding.
+#
+# Playback is cycle-accurate in all simulation modes. Port writes are only seen at cycle
+# precision by System.simulate; the instruction-level modes report them at the start of the
+# instruction (or translated block) doing the write.
+#
+# The contents of the image are not part of the system state: restoring an earlier state
+# (see System.set_state) doesn't un-record anything, and forks (see System.fork) play and
+# record the same image.
+
+from typing import *
+import mmap
+
+from iomap import IoPort
+
+# Transport buttons (bits of the control port)
+TAPE_PLAY         = 1 << 0
+TAPE_RECORD       = 1 << 1 # Only records while PLAY is pressed too
+TAPE_REWIND       = 1 << 2
+TAPE_FAST_FORWARD = 1 << 3
+
+# Defaults for a ~2MHz CPU clock and 4800 baud
+CYCLES_PER_CELL = 208
+START_CYCLES = 100000
+STOP_CYCLES = 50000
+WIND_SPEED = 20
+
+EDGE_SCAN_CHUNK = 65536
+
+def create_blank_tape(file_name: str, cells: int) -> None:
+    # Creates an image of 'cells' cells, all lanes 0. The file is sparse where the OS allows.
+    with open(file_name, "wb") as f:
+        f.truncate(cells)
+
+class TapeDrive(object):
+    def __init__(
+        self,
+        system: 'System',
+        file_name: str,
+        *,
+        writable: bool = False,
+        cycles_per_cell: int = CYCLES_PER_CELL,
+        start_cycles: int = START_CYCLES,
+        stop_cycles: int = STOP_CYCLES,
+        wind_speed: int = WIND_SPEED,
+    ):
+        assert start_cycles > 0 and stop_cycles > 0
+        self.system = system
+        self.file_name = file_name
+        self.cycles_per_cell = cycles_per_cell
+        self.start_cycles = start_cycles
+        self.stop_cycles = stop_cycles
+        self.wind_speed = wind_speed
+        self.file = open(file_name, "r+b" if writable else "rb")
+        self.image = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.writable = writable
+        self.size = len(self.image)
+        # Tape position, in clock cycles worth of tape at play speed
+        self.length = self.size * cycles_per_cell
+        self.record_port: IoPort = system.io_ports["tape_record"]
+        self.playback_port: IoPort = system.io_ports["tape_playback"]
+        self.control_port: IoPort = system.io_ports["tape_control"]
+        self.record_port.listeners.append(self._record_written)
+        self.control_port.listeners.append(self._control_written)
+        self.motion_entry: Optional[List[Any]] = None
+        self.limit_entry: Optional[List[Any]] = None
+        self.edge_entry: Optional[List[Any]] = None
+        self.reset()
+        system.add_device("tape", self)
+
+    def close(self) -> None:
+        self._flush(self.system.clk_count + 1)
+        self.image.close()
+        self.file.close()
+
+    ########################################
+    # State
+    ########################################
+    def reset(self) -> None:
+        # Rewinds the tape (instantly) and releases all buttons
+        self._cancel_all()
+        self.anchor_clk = 0 # 'pos' is 'anchor_pos' at 'anchor_clk' and changes by 'speed' every cycle
+        self.anchor_pos = 0
+        self.speed = 0
+        self.target = 0 # The speed the buttons ask for
+        self.motion: Optional[Tuple[int, int]] = None # Pending speed change: (clk, speed)
+        self.recording = False
+        self.rec_cell = 0 # First cell not yet recorded
+        self.rec_value = 0
+        self.edge_cell = 0
+        self.limit_clk = 0
+
+    def get_state(self) -> Dict[str, Any]:
+        return {
+            "anchor_clk": self.anchor_clk,
+            "anchor_pos": self.anchor_pos,
+            "speed": self.speed,
+            "target": self.target,
+            "motion": self.motion,
+            "recording": self.recording,
+            "rec_cell": self.rec_cell,
+            "rec_value": self.rec_value,
+        }
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        # The system's event queue is cleared by now, so everything gets posted again
+        self.motion_entry = self.limit_entry = self.edge_entry = None
+        self.anchor_clk = state["anchor_clk"]
+        self.anchor_pos = state["anchor_pos"]
+        self.speed = state["speed"]
+        self.target = state["target"]
+        self.motion = None
+        self.recording = state["recording"]
+        self.rec_cell = state["rec_cell"]
+        self.rec_value = state["rec_value"]
+        if state["motion"] is not None:
+            self._post_motion(*state["motion"])
+        self._post_limit()
+        if self._playing():
+            self._post_edge(self.get_cell(self.system.clk_count + 1))
+
+    def fork(self, system: 'System') -> 'TapeDrive':
+        # The fork plays (and records to) the same image
+        drive = TapeDrive(
+            system,
+            self.file_name,
+            writable=self.writable,
+            cycles_per_cell=self.cycles_per_cell,
+            start_cycles=self.start_cycles,
+            stop_cycles=self.stop_cycles,
+            wind_speed=self.wind_speed,
+        )
+        drive.set_state(self.get_state())
+        return drive
+
+    ########################################
+    # Position
+    ########################################
+    def get_pos(self, clk: int) -> int:
+        # Position of the tape at the start of clock cycle 'clk'
+        pos = self.anchor_pos + (clk - self.anchor_clk) * self.speed
+        return min(max(pos, 0), self.length)
+
+    def get_cell(self, clk: int) -> int:
+        # The cell under the head at the start of clock cycle 'clk'
+        return self.get_pos(clk) // self.cycles_per_cell
+
+    def _playing(self) -> bool:
+        return self.speed == 1 and not self.recording
+
+    def _set_speed(self, clk: int, speed: int) -> None:
+        # Changes the speed of the tape, starting with clock cycle 'clk'
+        self._flush(clk)
+        self.anchor_pos = self.get_pos(clk)
+        self.anchor_clk = clk
+        self.speed = speed
+        self._cancel(self.limit_entry)
+        self._cancel(self.edge_entry)
+        self.limit_entry = self.edge_entry = None
+        self._post_limit()
+        if self._playing():
+            cell = self.get_cell(clk)
+            if cell < self.size:
+                self.playback_port.set_input(self.image[cell])
+            self._post_edge(cell)
+
+    ########################################
+    # Transport
+    ########################################
+    def _control_written(self, value: int) -> None:
+        clk = self.system.clk_count + 1
+        recording = bool(value & TAPE_PLAY and value & TAPE_RECORD) and self.writable
+        if recording != self.recording:
+            self._flush(clk)
+            self.recording = recording
+            if self.speed == 1:
+                self._set_speed(clk, 1)
+        if value & TAPE_REWIND:
+            target = -self.wind_speed
+        elif value & TAPE_FAST_FORWARD:
+            target = self.wind_speed
+        elif value & TAPE_PLAY:
+            target = 1
+        else:
+            target = 0
+        if target != self.target:
+            self.target = target
+            self._plan(clk)
+
+    def _plan(self, clk: int) -> None:
+        # Works out the next speed change on the way to 'target'
+        target = self.target
+        pos = self.get_pos(clk)
+        if (target > 0 and pos == self.length) or (target < 0 and pos == 0):
+            target = 0
+        if self.speed == target:
+            self._cancel_motion()
+        elif self.speed != 0:
+            # Stop first; an ongoing stop is left alone
+            if self.motion is None or self.motion[1] != 0:
+                self._cancel_motion()
+                self._post_motion(clk + self.stop_cycles, 0)
+        elif target == 0:
+            self._cancel_motion()
+        elif self.motion is not None:
+            # Already starting up, just in a different direction
+            clk = self.motion[0]
+            self._cancel_motion()
+            self._post_motion(clk, target)
+        else:
+            self._post_motion(clk + self.start_cycles, target)
+
+    def _post_motion(self, clk: int, speed: int) -> None:
+        self.motion = (clk, speed)
+        self.motion_entry = self._post(clk, self._motion_wake_up)
+
+    def _cancel_motion(self) -> None:
+        self._cancel(self.motion_entry)
+        self.motion_entry = None
+        self.motion = None
+
+    def _motion_wake_up(self) -> Sequence['SimEventBase']:
+        clk, speed = self.motion
+        self.motion_entry = None
+        self.motion = None
+        self._set_speed(clk, speed)
+        self._plan(clk)
+        return ()
+
+    def _post_limit(self) -> None:
+        # Stops the tape when it reaches either end
+        if self.speed > 0:
+            clk = self.anchor_clk + (self.length - self.anchor_pos + self.speed - 1) // self.speed
+        elif self.speed < 0:
+            clk = self.anchor_clk + (self.anchor_pos - self.speed - 1) // -self.speed
+        else:
+            return
+        self.limit_clk = clk
+        self.limit_entry = self._post(clk, self._limit_wake_up)
+
+    def _limit_wake_up(self) -> Sequence['SimEventBase']:
+        clk = self.limit_clk
+        self.limit_entry = None
+        self._cancel_motion()
+        self._set_speed(clk, 0)
+        return ()
+
+    ########################################
+    # Playback
+    ########################################
+    def _next_edge(self, cell: int) -> Optional[int]:
+        # First cell after 'cell' with a different value
+        image = self.image
+        value = bytes((image[cell],))
+        cell += 1
+        while cell < self.size:
+            chunk = image[cell:cell+EDGE_SCAN_CHUNK]
+            run = len(chunk) - len(chunk.lstrip(value))
+            if run < len(chunk):
+                return cell + run
+            cell += len(chunk)
+        return None
+
+    def _post_edge(self, cell: int) -> None:
+        if cell >= self.size:
+            return
+        edge = self._next_edge(cell)
+        if edge is None:
+            return
+        self.edge_cell = edge
+        self.edge_entry = self._post(self.anchor_clk + edge * self.cycles_per_cell - self.anchor_pos, self._edge_wake_up)
+
+    def _edge_wake_up(self) -> Sequence['SimEventBase']:
+        self.edge_entry = None
+        self.playback_port.set_input(self.image[self.edge_cell])
+        self._post_edge(self.edge_cell)
+        return ()
+
+    ########################################
+    # Recording
+    ########################################
+    def _record_written(self, value: int) -> None:
+        self._flush(self.system.clk_count + 1)
+        self.rec_value = value & 0xff
+
+    def _flush(self, clk: int) -> None:
+        # Records everything that passed the head before clock cycle 'clk'
+        cell = min(self.get_cell(clk), self.size)
+        if self.recording and self.speed == 1 and cell > self.rec_cell:
+            self.image[self.rec_cell:cell] = bytes((self.rec_value,)) * (cell - self.rec_cell)
+        self.rec_cell = cell
+
+    ########################################
+    # Wake-ups
+    ########################################
+    def _post(self, clk: int, callback: Callable[[], Sequence['SimEventBase']]) -> List[Any]:
+        # Posts 'callback' for the end of the cycle before 'clk', so its effects are visible from 'clk' on
+        return self.system.schedule(max(clk - 1 - self.system.clk_count, 0), callback)
+
+    def _cancel(self, entry: Optional[List[Any]]) -> None:
+        if entry is not None:
+            self.system.cancel(entry)
+
+    def _cancel_all(self) -> None:
+        self._cancel(self.motion_entry)
+        self._cancel(self.limit_entry)
+        self._cancel(self.edge_entry)
+        self.motion_entry = self.limit_entry = self.edge_entry = None
@@ -0,0 +1,170 @@
+# Tests for the assembler (see asm.py)
+#
+#    python -m unittest test_asm
+
+from typing import *
+import tempfile
+import unittest
+from unittest import mock
+
+import asm
+from asm import AsmCache, AsmError, Expression, assemble
+
+def value(text: str, **symbols: int) -> int:
+    return Expression(text).evaluate(symbols)
+
+def words(source: str) -> List[int]:
+    return assemble(".section TEXT 0x100\n" + source, cache=None)[1]
+
+class ExpressionTest(unittest.TestCase):
+    def test_precedence(self):
+        self.assertEqual(value("1 + 2 * 3"), 7)
+        self.assertEqual(value("(1 + 2) * 3"), 9)
+        self.assertEqual(value("1 << 2 + 1"), 8)
+        self.assertEqual(value("1 | 2 ^ 3 & 6"), 1 | (2 ^ (3 & 6)))
+        self.assertEqual(value("0xff & 0x0f << 4"), 0xf0)
+        self.assertEqual(value("-2 * -3"), 6)
+        self.assertEqual(value("~0 & 0xffff"), 0xffff)
+        self.assertEqual(value("10 - 4 - 3"), 3)
+        self.assertEqual(value("A * 2 + B", A=3, B=4), 10)
+
+    def test_literals(self):
+        self.assertEqual(value("0b1000_0000_0000_0001"), 0x8001)
+        self.assertEqual(value("0x1_000"), 0x1000)
+        self.assertEqual(value("0o17"), 15)
+        self.assertEqual(value("1_000"), 1000)
+        with self.assertRaisesRegex(AsmError, "is not a valid number"):
+            value("0b102")
+
+    def test_division(self):
+        # Truncates towards 0, like C
+        self.assertEqual(value("7/2"), 3)
+        self.assertEqual(value("-7/2"), -3)
+        self.assertEqual(value("7/-2"), -3)
+        self.assertEqual(value("-7/-2"), 3)
+        with self.assertRaisesRegex(AsmError, "Can't evaluate constant expression"):
+            value("1/0")
+
+    def test_errors(self):
+        with self.assertRaisesRegex(AsmError, "missing '\\)'"):
+            value("(1 + 2")
+        with self.assertRaisesRegex(AsmError, "unknown symbol A"):
+            value("A + 1")
+
+class SymbolTest(unittest.TestCase):
+    def test_forward_reference(self):
+        self.assertEqual(words(".def A=B+1\n.def B=2\n.word A, B"), [3, 2])
+
+    def test_circular_definition(self):
+        with self.assertRaises(AsmError) as cm:
+            words(".def A=B+1\n.def B=A*2\n.word A")
+        self.assertIn("Circular symbol definition: A -> B -> A", str(cm.exception))
+        self.assertEqual(cm.exception.line_no, 2)
+
+    def test_long_chain(self):
+        # Resolution doesn't recurse, so this doesn't overflow the stack
+        source = "\n".join(f".def S{idx}=S{idx+1}+1" for idx in range(5000)) + "\n.def S5000=0\n.word S0"
+        self.assertEqual(words(source), [5000])
+
+class StringTest(unittest.TestCase):
+    def test_encoding(self):
+        # Two characters per word, the first in the low byte, zero terminated
+        self.assertEqual(words('.string "abc"'), [0x6261, 0x0063])
+        self.assertEqual(words('.string "ab"'), [0x6261, 0x0000])
+        self.assertEqual(words('.string ""'), [0x0000])
+        self.assertEqual(words('.string "a;b\\n"'), [0x3b61, 0x0a62, 0x0000])
+
+    def test_errors(self):
+        with self.assertRaisesRegex(AsmError, "single quoted string"):
+            words(".string abc")
+
+class ErrorPositionTest(unittest.TestCase):
+    def error(self, line: str) -> AsmError:
+        with self.assertRaises(AsmError) as cm:
+            assemble(".section TEXT 0x100\n" + line, cache=None)
+        self.assertEqual(cm.exception.line_no, 2)
+        return cm.exception
+
+    def test_column(self):
+        # Errors point at the offending token, even when found by the expression evaluator
+        self.assertEqual(self.error("    mov $r0, [$r0 + 1 2]").column, 23)
+        self.assertEqual(self.error("    mov $r5, 1").column, 9)
+        self.assertEqual(self.error("x:  mov $r0, [$sp 1]").column, 19)
+        self.assertEqual(self.error("    mov $r0, [$sp + 1").column, 22)
+        self.assertEqual(self.error("    .word 1, 2, 3/0").column, 18)
+        self.assertEqual(self.error("    mov $r0, 40").column, 14)
+        self.assertEqual(self.error("    bogus $r0").column, 5)
+        self.assertEqual(self.error("    .word 1, 0x10000").column, 14)
+        self.assertIn("line 2, column 23", str(self.error("    mov $r0, [$r0 + 1 2]")))
+
+    def test_symbol_resolution(self):
+        # Errors in a definition point at the definition, not where the symbol is used
+        self.assertEqual(self.error(".def A=Z+1\n.word A").column, 8)
+        self.assertEqual(self.error(".def A=4/(2-2)\n.word A").column, 9)
+        self.assertEqual(self.error(".def A=(1+2\n    mov $r0, A").column, 12)
+
+    def test_symbol_names(self):
+        # .def and labels take a single identifier
+        self.assertEqual(self.error(".def A B = 3").column, 8)
+        self.assertEqual(self.error(".def 3 = 4").column, 6)
+        self.assertEqual(self.error(".def $r0 = 4").column, 6)
+        self.assertEqual(self.error(".def A =").column, 8)
+        self.assertEqual(self.error("3: mov $r0, 1").column, 1)
+        self.assertIn("not a valid label name", str(self.error("$r0: mov $r0, 1")))
+
+    def test_dotted_names(self):
+        # Symbol names may contain dots, in definitions and expressions alike
+        self.assertEqual(words(".def A.B=3\n.def C=A.B*2\n.word A.B + 1, C"), [4, 6])
+
+class CacheTest(unittest.TestCase):
+    source = """
+        .section A 0x100
+        start:
+            mov $r0, 1
+            .word next
+        .section B 0x200
+        next:
+            mov $r1, {value}
+            mov [-1], $r0
+        .section C 0x300
+            .word start, 0x1234
+    """
+    def test_program(self):
+        cache = AsmCache()
+        source = self.source.format(value=2)
+        self.assertEqual(assemble(source, cache=cache), assemble(source, cache=None))
+        self.assertEqual(assemble(source, cache=cache), assemble(source, cache=None))
+        self.assertEqual(cache.hits, 1)
+
+    def test_section_invalidation(self):
+        cache = AsmCache()
+        assemble(self.source.format(value=2), cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 4)) # The program and three sections
+        # Only section B is re-encoded; A and C come from the cache
+        edited = self.source.format(value=3)
+        self.assertEqual(assemble(edited, cache=cache), assemble(edited, cache=None))
+        self.assertEqual((cache.hits, cache.misses), (2, 6))
+
+    def test_symbol_change(self):
+        # Moving a label invalidates the sections referring to it
+        cache = AsmCache()
+        assemble(self.source.format(value=2), cache=cache)
+        moved = self.source.format(value=2).replace("next:", "    .word 0\nnext:")
+        self.assertEqual(assemble(moved, cache=cache), assemble(moved, cache=None))
+        self.assertEqual((cache.hits, cache.misses), (1, 7)) # The program, A and B again; C stays the same
+
+    def test_assembler_change(self):
+        # Entries on disk made by another version of the assembler are not used
+        source = self.source.format(value=2)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            assemble(source, cache=AsmCache(cache_dir))
+            cache = AsmCache(cache_dir)
+            self.assertEqual(assemble(source, cache=cache), assemble(source, cache=None))
+            self.assertEqual(cache.hits, 1)
+            with mock.patch.object(asm, "ASM_CACHE_VERSION", asm._source_hash(__file__)):
+                cache = AsmCache(cache_dir)
+                self.assertEqual(assemble(source, cache=cache), assemble(source, cache=None))
+                self.assertEqual(cache.hits, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+# Tests for the boot ROM overlay (see bootrom.py)
+#
+#    python -m unittest test_bootrom
+
+from typing import *
+import unittest
+
+from asm import assemble
+from bootrom import BootRom
+from sim import System, SimEventInstFetch
+from trace import CallbackTraceSink, NullTraceSink, TraceLevel
+
+ROM_BASE = 0x2000
+ROM_SRC = f"""
+    .section ROM {ROM_BASE}
+    mov $r1, 5
+    mov [0x10], $r1
+    mov $pc, $pc
+"""
+
+def cold_system(trace=None) -> Tuple[System, BootRom]:
+    # Nothing is loaded into core memory, not even the reset vector
+    system = System(trace if trace is not None else NullTraceSink())
+    base_addr, words = assemble(ROM_SRC)
+    return system, BootRom(system, base_addr, words)
+
+class ColdBootTest(unittest.TestCase):
+    def check_booted(self, system: System, rom: BootRom) -> None:
+        self.assertTrue(rom.enabled)
+        self.assertEqual(system.cpu.r1, 5)
+        self.assertEqual(system.mem.read_slice(0x10, 0x11), [5])
+        # Neither the vector read, nor the fetches touched core memory
+        self.assertEqual(system.mem.read_slice(0, 1), [None])
+        self.assertEqual(system.mem.read_slice(ROM_BASE, ROM_BASE + 3), [None] * 3)
+
+    def test_clocked(self):
+        fetches = []
+        def collect(cycle, event):
+            if isinstance(event, SimEventInstFetch):
+                fetches.append((event.addr, event.data))
+        system, rom = cold_system(CallbackTraceSink(collect, TraceLevel.instruction))
+        system.simulate(100)
+        self.assertEqual(fetches[0], (ROM_BASE, rom.words[0]))
+        self.check_booted(system, rom)
+
+    def test_fast(self):
+        system, rom = cold_system()
+        self.assertEqual(system.cpu.step(), 3) # The reset sequence
+        self.assertEqual(system.cpu.pc, ROM_BASE)
+        system.simulate_fast(100)
+        self.check_booted(system, rom)
+
+    def test_translate(self):
+        system, rom = cold_system()
+        system.simulate_fast(100, translate=True)
+        self.check_booted(system, rom)
+
+    def test_swap_out(self):
+        # Once swapped out, the reset vector comes from core memory again, until the next reset
+        system, rom = cold_system()
+        system.bus.write(0xffff, 1)
+        self.assertFalse(rom.enabled)
+        self.assertIsNone(system.cpu.boot_rom)
+        system.reset()
+        self.assertTrue(rom.enabled)
+        self.assertIs(system.cpu.boot_rom, rom)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+# Tests for the high-level emulated loops (see hle.py)
+#
+# Every routine is run with verification on (so every HLE step is checked against full simulation
+# in a fork), and the outcome is compared to that of a run without HLE.
+#
+#    python -m unittest test_hle
+
+from typing import *
+import gc
+import os
+import tempfile
+import unittest
+import warnings
+
+from decode import decode_table
+from hle import HleMismatch, HleRoutine, HleTable, delay_loop, serial_receive_loop, tape_edge_wait
+from sim import System
+from tape import TapeDrive
+from trace import NullTraceSink
+
+class InputPlayer(object):
+    # Test-bench device: sets an input port to 'value' from cycle 'clk' on, for all (clk, value) in 'changes'
+    def __init__(self, system: System, port_name: str, changes: Sequence[Tuple[int, int]]):
+        self.system = system
+        self.port_name = port_name
+        self.port = system.io_ports[port_name]
+        self.changes = tuple(changes)
+        self.entry = None
+        self.set_state(0)
+        system.add_device(port_name + "_player", self)
+    def reset(self) -> None:
+        if self.entry is not None:
+            self.system.cancel(self.entry)
+        self.set_state(0)
+    def get_state(self) -> int:
+        return self.idx
+    def set_state(self, state: int) -> None:
+        self.idx = state
+        self.entry = None
+        if self.idx < len(self.changes):
+            clk = self.changes[self.idx][0]
+            self.entry = self.system.schedule(max(clk - 1 - self.system.clk_count, 0), self._wake_up)
+    def fork(self, system: System) -> 'InputPlayer':
+        player = InputPlayer(system, self.port_name, self.changes)
+        player.set_state(self.idx)
+        return player
+    def _wake_up(self) -> Sequence[Any]:
+        self.port.set_input(self.changes[self.idx][1])
+        self.set_state(self.idx + 1)
+        return ()
+
+def run(program: str, routines: Sequence[HleRoutine], setup: Callable[[System], None], clock_count: int = 10**6) -> System:
+    system = System(NullTraceSink())
+    system.load(0, (0x1000,))
+    system.load_asm(program)
+    setup(system)
+    if routines:
+        system.hle = HleTable(system, verify=True)
+        for routine in routines:
+            system.add_hle(routine)
+    system.simulate_fast(clock_count)
+    return system
+
+class HleTestBase(unittest.TestCase):
+    def check_same(self, system: System, reference: System) -> None:
+        self.assertTrue(system.terminated)
+        self.assertEqual(system.clk_count, reference.clk_count)
+        state = system.get_state()
+        reference_state = reference.get_state()
+        self.assertEqual(state["cpu"], reference_state["cpu"])
+        self.assertEqual(state["mem"], reference_state["mem"])
+        self.assertEqual(state["io_ports"], reference_state["io_ports"])
+
+class DelayLoopTest(HleTestBase):
+    program = """
+        .section TEXT 0x1000
+        mov $r1, 0
+        sub $r1, 1
+        if_neq $r1, 0
+        mov $pc, $pc-2
+        mov [-1], $r1
+    """
+    def test_delay_loop(self):
+        routine = delay_loop(0x1001)
+        system = run(self.program, (routine,), lambda system: None, 10**7)
+        self.check_same(system, run(self.program, (), lambda system: None, 10**7))
+        self.assertGreater(routine.hits, 0)
+
+    def test_broken_routine(self):
+        routine = delay_loop(0x1001)
+        handler = routine.handler
+        routine.handler = lambda system, clock_budget: (handler(system, clock_budget) or 0) + 1
+        with self.assertRaises(HleMismatch):
+            run(self.program, (routine,), lambda system: None, 10**7)
+
+class SerialReceiveTest(HleTestBase):
+    delay = 31
+    program = f"""
+        .section TEXT 0x1000
+        mov $sp, 0x10
+        mov $r0, 8
+        mov $r1, 0
+        mov [$sp], $r1
+        mov $r1, {delay}
+        mov [$sp+1], $r1
+        ; serial_receive_loop at 0x1006
+        mov $r1, [-8]
+        and $r1, 1
+        or [$sp], $r1
+        ror [$sp]
+        mov $r1, [$sp+1]
+        sub $r1, 1
+        if_neq $r1, 0
+        mov $pc, $pc-2
+        sub $r0, 1
+        if_neq $r0, 0
+        mov $pc, $pc-10
+        mov [-1], $r0
+    """
+    def check_byte(self, byte: int, bit_offset: int) -> int:
+        routine = serial_receive_loop(0x1006)
+        cycles = [decode_table[word].cycles for word in routine.code]
+        bit_cycles = sum(cycles[0:5]) + self.delay * sum(cycles[5:8]) - cycles[7] + sum(cycles[8:11])
+        # Bit 0 is there from the start, the rest change half-way between samples
+        changes = [(0, byte & 1)] + [(bit_offset + bit_cycles // 2 + (bit - 1) * bit_cycles, (byte >> bit) & 1) for bit in range(1, 8)]
+        setup = lambda system: InputPlayer(system, "serial_rxt", changes)
+        system = run(self.program, (routine, delay_loop(0x100b)), setup)
+        reference = run(self.program, (), setup)
+        self.check_same(system, reference)
+        self.assertGreater(routine.hits, 0)
+        return system.mem.peek(0x10)
+
+    def test_receive(self):
+        for byte in (0x00, 0xff, 0xa5, 0x3c, 0x81):
+            self.assertEqual(self.check_byte(byte, 0), byte << 8)
+
+    def test_misaligned(self):
+        # Bits changing right before a sample (or the HLE budget) must be handled the same way
+        for bit_offset in range(0, 60, 7):
+            self.check_byte(0x5a, bit_offset)
+
+class TapeEdgeWaitTest(HleTestBase):
+    program = """
+        .section TEXT 0x1000
+        mov $r1, 1
+        mov [-14], $r1
+        mov $r0, 7
+        mov $r1, [-15]
+        ; tape_edge_wait at 0x1004
+        if_eq $r1, [-15]
+        mov $pc, $pc-1
+        sub $r0, 1
+        if_neq $r0, 0
+        mov $pc, $pc-5
+        mov [-1], $r0
+    """
+    def setUp(self):
+        fd, self.file_name = tempfile.mkstemp(suffix=".tape")
+        with os.fdopen(fd, "wb") as f:
+            f.write(bytes(200) + b"\x01" * 3 + bytes(2) + b"\x03" * 40 + bytes(5) + b"\x01" * 7 + bytes(300) + b"\x02" * 10)
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def test_edge_wait(self):
+        setup = lambda system: TapeDrive(system, self.file_name, cycles_per_cell=50, start_cycles=1000)
+        routine = tape_edge_wait(0x1004)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", ResourceWarning)
+            system = run(self.program, (routine,), setup)
+            reference = run(self.program, (), setup)
+            self.check_same(system, reference)
+            self.assertEqual(system.get_state()["devices"], reference.get_state()["devices"])
+            self.assertGreater(routine.hits, 0)
+            # The loop ends right after the seventh edge
+            self.assertEqual(system.io_ports["tape_playback"].value, 2)
+            system.close()
+            reference.close()
+            gc.collect()
+        # The forks made for verification are closed too
+        self.assertEqual([warning for warning in caught if issubclass(warning.category, ResourceWarning)], [])
+
+if __name__ == "__main__":
+    unittest.main()
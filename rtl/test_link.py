@@ -0,0 +1,77 @@
+# Tests for the linker (see link.py)
+#
+#    python -m unittest test_link
+
+from typing import *
+import unittest
+
+from asm import AsmError, assemble, assemble_object
+from link import Linker, link
+
+MAIN = """
+    .section TEXT
+    .export start
+    start:
+        mov $r0, COUNT
+        mov $pc, [$pc + 1]
+        .word print
+    .section DATA
+        .word COUNT, start
+"""
+
+PRINT = """
+    .def COUNT=3
+    .export print, COUNT
+    .section TEXT
+    print:
+        mov $r1, COUNT
+        mov [-1], $r1
+"""
+
+# What linking the two gives, with TEXT at 0x1000: the TEXT sections of both, then DATA
+LINKED = """
+    .section TEXT 0x1000
+        mov $r0, 3
+        mov $pc, [$pc + 1]
+        .word 0x1003
+        mov $r1, 3
+        mov [-1], $r1
+        .word 3, 0x1000
+"""
+
+def objects(*sources: Tuple[str, str]) -> list:
+    return [assemble_object(text, name, cache=None) for name, text in sources]
+
+class LinkTest(unittest.TestCase):
+    def test_two_modules(self):
+        linker = Linker(objects(("main", MAIN), ("print", PRINT)), {"TEXT": 0x1000})
+        self.assertEqual(linker.link(), assemble(LINKED, cache=None))
+        self.assertIn("0x1003 print (print)", linker.map())
+
+    def test_out_of_range_immediate(self):
+        # 'far' is only known at link time, and ends up too far for an immediate
+        source = """
+            .section TEXT
+                mov $r0, far
+        """
+        other = """
+            .export far
+            .section TEXT
+                .word 0
+            far:
+        """
+        with self.assertRaises(AsmError) as cm:
+            link(objects(("near", source), ("other", other)), {"TEXT": 0x100})
+        self.assertIn("Immediate value 258 is out of range (section TEXT of near)", str(cm.exception))
+        self.assertEqual(cm.exception.line_no, 3)
+
+    def test_undefined_symbol(self):
+        with self.assertRaisesRegex(AsmError, "Undefined symbol COUNT in main"):
+            link(objects(("main", MAIN)))
+
+    def test_duplicate_export(self):
+        with self.assertRaisesRegex(AsmError, "exported by both"):
+            link(objects(("a", PRINT), ("b", PRINT)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+# Tests for the simulator core (see sim.py)
+#
+#    python -m unittest test_sim
+
+from typing import *
+import unittest
+
+from sim import System
+from trace import NullTraceSink
+
+PROGRAM = """
+    .section TEXT 0x1000
+    mov $r0, 5
+    sub $r0, 1
+    if_neq $r0, 0
+    mov $pc, $pc-2
+    mov $r1, 7
+    mov [0x10], $r1
+    mov [-1], $r0
+"""
+
+def new_system(program: str = PROGRAM) -> System:
+    system = System(NullTraceSink())
+    system.load(0, (0x1000,))
+    system.load_asm(program)
+    return system
+
+class ModeTest(unittest.TestCase):
+    # The instruction-level modes stop in the same state as 'simulate', even though the
+    # terminator write happens in the middle of an instruction
+    programs = (
+        PROGRAM, # Writes the result
+        PROGRAM.replace("mov [-1], $r0", "mov $r0, [-1]"), # Writes the operand back
+    )
+    def check_modes(self, program: str) -> None:
+        reference = new_system(program)
+        reference.simulate(5000)
+        self.assertTrue(reference.terminated)
+        runs = {
+            "fast": lambda system: system.simulate_fast(5000),
+            "translate": lambda system: system.simulate_fast(5000, translate=True),
+            "run_until": lambda system: system.run_until(5000),
+        }
+        for name, run in runs.items():
+            system = new_system(program)
+            run(system)
+            self.assertTrue(system.terminated, name)
+            self.assertEqual(system.get_state(), reference.get_state(), name)
+            self.assertEqual(system.mem.read_slice(0, 0x4000), reference.mem.read_slice(0, 0x4000), name)
+
+    def test_termination(self):
+        for program in self.programs:
+            self.check_modes(program)
+
+    def test_resume_before_write(self):
+        # Finishes the instruction in flight clock-by-clock (see Processor._finish_instruction)
+        reference = new_system()
+        reference.simulate(5000)
+        system = new_system()
+        system.run(reference.clk_count - 2)
+        self.assertFalse(system.stop_requested)
+        system.simulate_fast(5000)
+        self.assertEqual(system.get_state(), reference.get_state())
+
+class CheckpointTest(unittest.TestCase):
+    def test_terminate_after_restore(self):
+        reference = new_system()
+        reference.simulate(5000)
+        self.assertTrue(reference.terminated)
+        # Stop in the cycle after the terminator write, before the termination is acted upon
+        system = new_system()
+        system.run(reference.clk_count - 1)
+        self.assertTrue(system.stop_requested)
+        self.assertFalse(system.terminated)
+        restored = System(NullTraceSink())
+        restored.set_state(system.get_state())
+        for resumed in (restored, system.fork()):
+            resumed.simulate(5000)
+            self.assertTrue(resumed.terminated)
+            self.assertEqual(resumed.get_state(), reference.get_state())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+# Time-travel debugging
+#
+# TimeTravel runs a System through System.run_until, taking a snapshot (System.get_state)
+# every 'interval' clock cycles. Any earlier cycle is reached by restoring the closest
+# snapshot before it and replaying from there: whole instructions through Processor.step,
+# and the last few cycles clock-by-clock, so we can stop in the middle of an instruction too.
+#
+# The number of snapshots is capped by 'max_snapshots'. Once that's reached, every other
+# snapshot is dropped and the interval doubles, so memory use stays bounded no matter how
+# long the run is, at the cost of longer replays for older cycles.
+#
+# Replay is only deterministic if everything that influences the system is part of its state.
+# Inputs poked into the system from the outside (I/O port inputs, interrupts) are not recorded.
+
+from typing import *
+
+from decode import SWAP_INST_CYCLES
+from trace import NullTraceSink
+from sim import System, SimEventBase, SimEventBreakpoint, SimEventTerminate
+
+class TimeTravel(object):
+    def __init__(self, system: System, interval: int = 10000, max_snapshots: int = 64):
+        assert max_snapshots >= 2
+        self.system = system
+        self.interval = interval
+        self.max_snapshots = max_snapshots
+        # (clk_count, state) pairs, in increasing clk_count order
+        self.snapshots: List[Tuple[int, Dict[str, Any]]] = []
+        self._snapshot()
+
+    def _snapshot(self) -> None:
+        clk_count = self.system.clk_count
+        if len(self.snapshots) > 0 and self.snapshots[-1][0] == clk_count:
+            self.snapshots.pop()
+        self.snapshots.append((clk_count, self.system.get_state()))
+        if len(self.snapshots) > self.max_snapshots:
+            self.snapshots = self.snapshots[::2]
+            self.interval *= 2
+
+    ########################################
+    # Forward
+    ########################################
+    def run_until(self, clock_count: int) -> Optional[SimEventBase]:
+        # Same as System.run_until, but takes snapshots as we go
+        system = self.system
+        # If we've been rewound, everything after this point is going to be re-recorded
+        while len(self.snapshots) > 1 and self.snapshots[-1][0] > system.clk_count:
+            self.snapshots.pop()
+        end = system.clk_count + clock_count
+        while True:
+            next_snapshot = self.snapshots[-1][0] + self.interval
+            budget = min(end, next_snapshot) - system.clk_count
+            event = system.run_until(max(budget, 0))
+            if event is not None or system.clk_count > end:
+                return event
+            if system.clk_count >= next_snapshot:
+                self._snapshot()
+
+    ########################################
+    # Backward
+    ########################################
+    def goto(self, cycle: int) -> None:
+        # Brings the system to the state it was in after 'cycle' clock cycles. Can't go back
+        # further than the first snapshot.
+        snapshot_clk, state = self._find_snapshot(cycle)
+        self.system.set_state(state)
+        self.system.debugger.break_pc = None
+        self._replay(cycle)
+
+    def reverse_step(self) -> bool:
+        # Goes back to the beginning of the previous instruction (or the current one, if we're
+        # in the middle of it). Returns False if there's nothing to go back to.
+        target = self.system.clk_count
+        boundaries = self._boundaries(target)
+        if len(boundaries) == 0:
+            return False
+        self.goto(boundaries[-1])
+        return True
+
+    def reverse_continue(self) -> Optional[SimEventBase]:
+        # Goes back to the last point before the current cycle where a breakpoint,
+        # watchpoint or register trigger (see System.debugger) would have stopped System.run_until.
+        # Returns that event, or None (in which case we end up at the first snapshot).
+        system = self.system
+        target = system.clk_count
+        idx = self._find_snapshot_idx(target - 1)
+        with self._quiet():
+            while idx >= 0:
+                segment_end = self.snapshots[idx+1][0] if idx+1 < len(self.snapshots) else target
+                segment_end = min(segment_end, target)
+                system.set_state(self.snapshots[idx][1])
+                system.debugger.break_pc = None
+                last_hit = None
+                while system.clk_count < segment_end:
+                    event = system.run_until(segment_end - system.clk_count - 1)
+                    if event is None or isinstance(event, SimEventTerminate):
+                        break
+                    if system.clk_count < target:
+                        last_hit = (system.clk_count, event)
+                if last_hit is not None:
+                    break
+                idx -= 1
+        if last_hit is None:
+            self.goto(self.snapshots[0][0])
+            return None
+        hit_clk, event = last_hit
+        self.goto(hit_clk)
+        if isinstance(event, SimEventBreakpoint):
+            # Don't stop here again when continuing forward
+            system.debugger.break_pc = event.addr
+        return event
+
+    ########################################
+    # Replay
+    ########################################
+    def _find_snapshot_idx(self, cycle: int) -> int:
+        # Index of the last snapshot not after 'cycle'
+        for idx in range(len(self.snapshots)-1, -1, -1):
+            if self.snapshots[idx][0] <= cycle:
+                return idx
+        return 0
+
+    def _find_snapshot(self, cycle: int) -> Tuple[int, Dict[str, Any]]:
+        return self.snapshots[self._find_snapshot_idx(cycle)]
+
+    def _quiet(self) -> '_QuietTrace':
+        return _QuietTrace(self.system)
+
+    def _replay(self, cycle: int) -> None:
+        system = self.system
+        cpu = system.cpu
+        with self._quiet():
+            system.stop_requested = False
+            # Whole instructions while we're sure not to overshoot, then clock-by-clock
+            while system.clk_count + SWAP_INST_CYCLES <= cycle:
+                system.clk_count += cpu.step()
+                if system.clk_count > system.next_event and not system.stop_requested:
+                    system.run_events()
+                if system.stop_requested:
+                    system.terminated = True
+                    return
+            if system.clk_count < cycle:
+                system.run(cycle - system.clk_count)
+
+    def _boundaries(self, target: int) -> List[int]:
+        # Instruction boundaries between the snapshot before 'target' and 'target' (exclusive)
+        system = self.system
+        snapshot_clk, state = self._find_snapshot(target - 1)
+        if snapshot_clk >= target:
+            return []
+        boundaries = []
+        with self._quiet():
+            system.set_state(state)
+            system.stop_requested = False
+            while system.clk_count < target:
+                boundaries.append(system.clk_count)
+                system.clk_count += system.cpu.step()
+                if system.clk_count > system.next_event and not system.stop_requested:
+                    system.run_events()
+                if system.stop_requested:
+                    break
+        return boundaries
+
+class _QuietTrace(object):
+    # Context manager that turns tracing off for replays
+    def __init__(self, system: System):
+        self.system = system
+    def __enter__(self) -> None:
+        self.trace = self.system.trace
+        self.system.set_trace(NullTraceSink())
+    def __exit__(self, *args) -> None:
+        self.system.set_trace(self.trace)
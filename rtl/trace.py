@@ -0,0 +1,64 @@
+# Trace sinks for the simulator
+#
+# The simulator hands all events at or below the sink's level to the sink.
+# Event sources check the level before creating events, so events of disabled
+# levels are never even created, let alone formatted.
+
+from typing import *
+from enum import IntEnum
+from abc import abstractmethod
+import sys
+
+class TraceLevel(IntEnum):
+    none        = 0 # Nothing at all
+    instruction = 1 # Instruction fetches and termination
+    register    = 2 # ... plus register updates and CPU status
+    bus         = 3 # ... plus all bus reads and writes
+    full        = 4 # ... plus memory dumps
+
+class TraceKind(IntEnum):
+    # What an event is about; sinks that don't want to format events can dispatch on this
+    other       = 0
+    fetch       = 1
+    read        = 2
+    write       = 3
+    register    = 4
+    status      = 5
+    terminate   = 6
+
+class TraceSinkBase(object):
+    def __init__(self, level: TraceLevel):
+        self.level = level
+    @abstractmethod
+    def emit(self, cycle: int, event: 'SimEventBase') -> None:
+        pass
+    def emit_summary(self, cycle: int, events: Sequence['SimEventBase']) -> None:
+        # Called once at the end of the simulation with the final state of the system
+        for event in events:
+            if event.level <= self.level:
+                self.emit(cycle, event)
+    def close(self) -> None:
+        pass
+
+class NullTraceSink(TraceSinkBase):
+    def __init__(self):
+        super().__init__(TraceLevel.none)
+    def emit(self, cycle: int, event: 'SimEventBase') -> None:
+        pass
+
+class TextTraceSink(TraceSinkBase):
+    def __init__(self, level: TraceLevel = TraceLevel.full, stream: Optional[TextIO] = None):
+        super().__init__(level)
+        self.stream = stream
+    def emit(self, cycle: int, event: 'SimEventBase') -> None:
+        print("    " + str(event), file=self.stream if self.stream is not None else sys.stdout)
+    def emit_summary(self, cycle: int, events: Sequence['SimEventBase']) -> None:
+        print("********************************", file=self.stream if self.stream is not None else sys.stdout)
+        super().emit_summary(cycle, events)
+
+class CallbackTraceSink(TraceSinkBase):
+    def __init__(self, callback: Callable[[int, 'SimEventBase'], None], level: TraceLevel = TraceLevel.full):
+        super().__init__(level)
+        self.callback = callback
+    def emit(self, cycle: int, event: 'SimEventBase') -> None:
+        self.callback(cycle, event)
@@ -0,0 +1,303 @@
+# A basic-block translator for the simulator
+#
+# Straight-line runs of instructions are turned into Python functions, which are
+# cached by their start address. A block ends at the first instruction that decides
+# where execution continues (predicates and writes to $pc); SWAP/SWAPI and a few
+# odd-ball encodings are never translated, those are left for Processor.step.
+#
+# Core memory is destructively read, so the CPU writes every fetched instruction
+# back. Since the net effect of that is nothing, translated code doesn't bother with
+# the fetch cycles at all. For the same reason, a write to a location covered by a
+# block only invalidates the block if it changes the value the block was translated
+# from.
+#
+# Within a block, writes to I/O or to translated code end the block after the
+# instruction that did them, so devices get a chance to react and stale code is
+# never executed. If the write requested a stop, the block bails out right after it,
+# leaving the rest to Processor._stop, the same way Processor.step does.
+
+from constants import *
+from typing import *
+
+from decode import decode_table, DecodedInst, PHASE_FETCH, PHASE_EXECUTE, PHASE_UPDATE_PC, _signed16
+
+# Flags in BlockCache.exit_map
+EXIT_IO = 1
+EXIT_CODE = 2
+
+MAX_BLOCK_LEN = 64
+
+class Block(object):
+    def __init__(self, start_addr: int, words: Sequence[int], cycles: int, last_start: int, source: Optional[str], func: Optional[Callable[[], int]]):
+        self.start_addr = start_addr
+        self.words = words
+        # Number of clock cycles the whole block takes and the offset of the start of the last instruction within that
+        self.cycles = cycles
+        self.last_start = last_start
+        self.source = source
+        self.func = func # None if the first instruction can't be translated
+
+def _reg_name(opa: int) -> str:
+    return ("pc", "sp", "r0", "r1")[opa]
+
+class BlockCache(object):
+    def __init__(self, system: 'System'):
+        self.cpu = system.cpu
+        self.bus = system.bus
+        self.mem = system.mem
+        self.system = system
+        self.blocks: Dict[int, Block] = {}
+        # For each address, the start addresses of the blocks that were translated from it
+        self.block_map: List[Optional[List[int]]] = [None] * 0x10000
+        self.exit_map = bytearray(0x10000)
+        for addr in range(0x10000):
+            if not self._is_ram(addr):
+                self.exit_map[addr] = EXIT_IO
+        self.mem.code_cache = self
+
+    def _is_ram(self, addr: int) -> bool:
+        return self.mem.base_addr <= addr < self.mem.base_addr + self.mem.size
+
+    ########################################
+    # Invalidation
+    ########################################
+    def notify_write(self, addr: int, data: Optional[int]) -> None:
+        # Called by Memory on every write. Most writes either don't hit code or
+        # write back the very same value that was read from there (instruction fetches).
+        if self.exit_map[addr] & EXIT_CODE:
+            starts = self.block_map[addr]
+            for start in tuple(starts):
+                block = self.blocks[start]
+                if block.words[addr - start] != data:
+                    self._invalidate(block)
+
+    def notify_load(self, start_addr: int, count: int) -> None:
+        if count > len(self.blocks):
+            # Large loads (or state restores) are cheaper to handle block-by-block
+            end_addr = start_addr + count
+            for block in tuple(self.blocks.values()):
+                if block.start_addr < end_addr and block.start_addr + len(block.words) > start_addr:
+                    self._invalidate(block)
+            return
+        for addr in range(start_addr, start_addr + count):
+            if self.exit_map[addr] & EXIT_CODE:
+                for start in tuple(self.block_map[addr]):
+                    self._invalidate(self.blocks[start])
+
+    def _invalidate(self, block: Block) -> None:
+        del self.blocks[block.start_addr]
+        for addr in range(block.start_addr, block.start_addr + len(block.words)):
+            starts = self.block_map[addr]
+            starts.remove(block.start_addr)
+            if len(starts) == 0:
+                self.block_map[addr] = None
+                self.exit_map[addr] &= ~EXIT_CODE
+
+    def _register(self, block: Block) -> None:
+        self.blocks[block.start_addr] = block
+        for addr in range(block.start_addr, block.start_addr + len(block.words)):
+            if self.block_map[addr] is None:
+                self.block_map[addr] = []
+            self.block_map[addr].append(block.start_addr)
+            self.exit_map[addr] |= EXIT_CODE
+
+    ########################################
+    # Translation
+    ########################################
+    @staticmethod
+    def _can_translate(dec: DecodedInst) -> bool:
+        # SWAP toggles interrupts and writes registers in odd places and
+        # results written to a non-memory operand are bogus to begin with.
+        if dec.is_swap:
+            return False
+        if dec.mem_result and not dec.mem_ref:
+            return False
+        return True
+
+    @staticmethod
+    def _ends_block(dec: DecodedInst) -> bool:
+        return dec.is_predicate or (dec.reg_result and dec.opa == OPA_PC)
+
+    def translate(self, start_addr: int) -> Block:
+        words = []
+        lines = []
+        cycles = 0
+        last_start = 0
+        next_pc = None
+        addr = start_addr
+        while len(words) < MAX_BLOCK_LEN and self._is_ram(addr):
+            word = self.mem.peek(addr)
+            if word is None:
+                break
+            dec = decode_table[word]
+            if not self._can_translate(dec):
+                break
+            words.append(word)
+            last_start = cycles
+            next_pc = self._translate_inst(lines, addr, word, dec, cycles)
+            cycles += dec.cycles
+            addr += 1
+            if self._ends_block(dec):
+                break
+        if len(words) == 0:
+            # We can't do anything with this one, Processor.step will have to deal with it.
+            # We still register it so we don't keep trying
+            word = self.mem.peek(start_addr)
+            block = Block(start_addr, (word, ), 0, 0, None, None)
+            self._register(block)
+            return block
+        if next_pc is None:
+            # We've run out of the block-size limit or hit an un-translatable instruction
+            next_pc = str(addr & 0xffff)
+        lines.append(f"cpu.pc = {next_pc}")
+        lines.append(f"cpu.sp = sp; cpu.r0 = r0; cpu.r1 = r1")
+        lines.append(f"return {cycles}")
+        source = (
+            "def make_block(cpu, read, write, exit_map, system, _signed16):\n" +
+            "    def block():\n" +
+            "        sp = cpu.sp; r0 = cpu.r0; r1 = cpu.r1\n" +
+            "".join(f"        {line}\n" for line in lines) +
+            "    return block\n"
+        )
+        namespace = {}
+        exec(compile(source, f"<block 0x{start_addr:04x}>", "exec"), namespace)
+        func = namespace["make_block"](self.cpu, self.bus.read, self.bus.write, self.exit_map, self.system, _signed16)
+        block = Block(start_addr, tuple(words), cycles, last_start, source, func)
+        self._register(block)
+        return block
+
+    @staticmethod
+    def _translate_inst(lines: List[str], pc: int, word: int, dec: DecodedInst, cycles: int) -> Optional[str]:
+        # Appends the code for a single instruction and returns the expression for the next $pc,
+        # if the instruction ends the block.
+        def sync(pc_expr: str) -> str:
+            return f"cpu.pc = {pc_expr}; cpu.sp = sp; cpu.r0 = r0; cpu.r1 = r1"
+        def stop(opa_value: str, opb_value: str) -> str:
+            # Sets the temporaries Processor._stop expects
+            return f"cpu.mem_op_addr = {mem_op_addr}; cpu.alu_opa = {opa_value}; cpu.alu_opb = {opb_value}; cpu.noskip = True; cpu.skip_pc_update = False"
+
+        lines.append(f"# 0x{pc:04x}: {dec.disasm}")
+        # Operand B address (or value)
+        opb_base = dec.opb & OPB_BASE_MASK
+        if opb_base == OPB_MEM_IMMED & OPB_BASE_MASK:
+            opb_const = dec.immed
+        elif opb_base == OPB_MEM_IMMED_PC & OPB_BASE_MASK:
+            opb_const = pc + dec.immed
+        else:
+            opb_const = None
+            base_reg = "sp" if opb_base == OPB_MEM_IMMED_SP & OPB_BASE_MASK else "r0"
+            opb_expr = f"({base_reg} + {dec.immed})" if dec.immed != 0 else base_reg
+        mem_op_addr = str(opb_const) if opb_const is not None else opb_expr
+        if dec.mem_ref:
+            if opb_const is not None:
+                lines.append(f"a = {opb_const & 0xffff}")
+            else:
+                lines.append(f"a = {opb_expr} & 0xffff")
+            lines.append(f"b = read(a)")
+            b = "b"
+        else:
+            b = f"({opb_const})" if opb_const is not None else opb_expr
+        # Operand A
+        a_reg = str(pc) if dec.opa == OPA_PC else _reg_name(dec.opa)
+
+        if dec.mem_ref and not dec.mem_result:
+            # Write-back of the destructively read operand
+            lines.append(f"x = exit_map[a]")
+            lines.append(f"write(a, b)")
+            lines.append(f"if x & {EXIT_IO}:")
+            lines.append(f"    if system.stop_requested:")
+            lines.append(f"        {sync(str(pc))}")
+            lines.append(f"        {stop(a_reg, b)}")
+            lines.append(f"        return {cycles + dec.cycles - 2} + cpu._stop({PHASE_EXECUTE}, {word})")
+            lines.append(f"    brk = True")
+            lines.append(f"else:")
+            lines.append(f"    brk = False")
+            may_exit = True
+        else:
+            may_exit = False
+
+        opcode = dec.opcode
+        result = None
+        noskip = None
+        if opcode == INST_OR:
+            result = f"{a_reg} | {b}"
+        elif opcode == INST_AND:
+            result = f"{a_reg} & {b}"
+        elif opcode == INST_XOR:
+            result = f"{a_reg} ^ {b}"
+        elif opcode == INST_ADD:
+            result = f"({a_reg} + {b}) & 0xffff"
+        elif opcode == INST_SUB:
+            result = f"({a_reg} - {b}) & 0xffff"
+        elif opcode == INST_ISUB:
+            result = f"({b} - {a_reg}) & 0xffff"
+        elif opcode == INST_UNK:
+            result = a_reg
+        elif opcode == INST_MOV:
+            result = b if dec.d == 0 else a_reg
+        elif opcode == INST_ISTAT:
+            result = "(2 if cpu.inten else 0)"
+        elif opcode in (INST_ROR, INST_ROL):
+            x = a_reg if dec.d == 0 else b
+            if opcode == INST_ROR:
+                result = f"((({x}) >> 1) & 0x7fff) | ((({x}) & 1) << 15)"
+            else:
+                result = f"((({x}) << 1) & 0xfffe) | ((({x}) >> 15) & 1)"
+        elif opcode == INST_EQ:
+            noskip = f"{a_reg} {'==' if dec.d == 0 else '!='} {b}"
+        elif opcode == INST_LTU:
+            noskip = f"{a_reg} {'<' if dec.d == 0 else '>='} {b}"
+        elif opcode == INST_LTS:
+            noskip = f"_signed16({a_reg}) {'<' if dec.d == 0 else '>='} _signed16({b})"
+        elif opcode == INST_LES:
+            noskip = f"_signed16({a_reg}) {'<=' if dec.d == 0 else '>'} _signed16({b})"
+        else:
+            assert False
+
+        next_pc = None
+        if dec.is_predicate:
+            next_pc = f"({pc + 1} if {noskip} else {pc + 2}) & 0xffff"
+        elif dec.mem_result:
+            # NOTE: we need to sample exit_map before the write: the write might invalidate the block
+            lines.append(f"x = exit_map[a]")
+            lines.append(f"write(a, {result})")
+            lines.append(f"if x:")
+            lines.append(f"    if system.stop_requested:")
+            lines.append(f"        {sync(str(pc))}")
+            lines.append(f"        {stop(a_reg, b)}")
+            lines.append(f"        return {cycles + dec.cycles - 1} + cpu._stop({PHASE_UPDATE_PC}, {word})")
+            lines.append(f"    brk = True")
+            lines.append(f"else:")
+            lines.append(f"    brk = False")
+            may_exit = True
+        else:
+            assert dec.reg_result
+            if dec.opa == OPA_PC:
+                next_pc = f"({result}) & 0xffff"
+            else:
+                lines.append(f"{_reg_name(dec.opa)} = ({result}) & 0xffff")
+        if next_pc is None and may_exit:
+            lines.append(f"if brk:")
+            lines.append(f"    {sync(str((pc + 1) & 0xffff))}")
+            lines.append(f"    return {cycles + dec.cycles}")
+        return next_pc
+
+    ########################################
+    # Execution
+    ########################################
+    def step(self, clock_budget: int) -> int:
+        # Executes a translated block at the current $pc, if possible, or a single
+        # instruction through Processor.step otherwise. The last instruction of a
+        # block must start within 'clock_budget' cycles for the block to be used.
+        # Returns the number of clock cycles elapsed.
+        cpu = self.cpu
+        if cpu.in_reset or cpu.phase != PHASE_FETCH or (cpu.interrupt_pending and cpu.inten) or cpu.boot_rom is not None:
+            return cpu.step()
+        block = self.blocks.get(cpu.pc)
+        if block is None:
+            if not self._is_ram(cpu.pc):
+                return cpu.step()
+            block = self.translate(cpu.pc)
+        if block.func is None or block.last_start > clock_budget:
+            return cpu.step()
+        return block.func()
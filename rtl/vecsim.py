@@ -0,0 +1,316 @@
+# A vectorized simulator for many independent machines
+#
+# The registers and core memories of N machines are stored in NumPy arrays and all
+# machines execute one instruction (or their reset sequence) in lock-step on every
+# call to 'step'. The semantics are those of Processor.step (and thus of
+# Processor.clock), including destructive reads with write-back, unknown memory
+# content, predicate skips, SWAP/SWAPI and interrupts.
+#
+# Every machine has 'mem_size' words of core memory from address 0, a terminator at
+# 0xffff and the I/O ports of iomap.py. Machines stop when they write the terminator
+# (with the same partial cycle counts as Processor.step) or when they do something the
+# scalar simulator would blow up on (executing unknown memory content, writing a location
+# that hasn't been cleared, accessing unmapped addresses, etc.). The latter machines are
+# marked as 'faulted'; their state is frozen at the point of the fault.
+
+from constants import *
+from typing import *
+
+import numpy as np
+
+from decode import decode_table
+from decode import _alu_swap, _alu_swap_pc, _alu_or, _alu_and, _alu_xor, _alu_add, _alu_sub, _alu_isub, _alu_pass_a, _alu_pass_b, _alu_istat
+from decode import _alu_ror_a, _alu_ror_b, _alu_rol_a, _alu_rol_b, _alu_eq, _alu_neq, _alu_ltu, _alu_geu, _alu_lts, _alu_ges, _alu_les, _alu_gts
+from iomap import io_ports
+from sim import MEM_CLEARED, MEM_PRESENT, MEM_UNKNOWN, RESET_CYCLES, INTERRUPT_INST, TERMINATE_ADDR
+
+# Machine status
+VM_RUNNING = 0
+VM_TERMINATED = 1
+VM_FAULTED = 2
+
+PORT_BASE = 0xfff0
+
+def _signed16(data: np.ndarray) -> np.ndarray:
+    data = data & 0xffff
+    return np.where(data & 0x8000, data - 0x10000, data)
+
+def _ror(data: np.ndarray) -> np.ndarray:
+    return ((data >> 1) & 0x7fff) | ((data & 1) << 15)
+
+def _rol(data: np.ndarray) -> np.ndarray:
+    return ((data << 1) & 0xfffe) | ((data >> 15) & 1)
+
+# Vectorized counterparts of the ALU handlers in decode.py. Each takes the A and B operands and the interrupt
+# enable state and returns the result (or None for predicates) and the 'noskip' flag (or None if it's always set).
+_vec_alu_handlers = {
+    _alu_swap:    lambda a, b, inten: (a, None),
+    _alu_swap_pc: lambda a, b, inten: (a + 1, None),
+    _alu_or:      lambda a, b, inten: (a | b, None),
+    _alu_and:     lambda a, b, inten: (a & b, None),
+    _alu_xor:     lambda a, b, inten: (a ^ b, None),
+    _alu_add:     lambda a, b, inten: ((a + b) & 0xffff, None),
+    _alu_sub:     lambda a, b, inten: ((a - b) & 0xffff, None),
+    _alu_isub:    lambda a, b, inten: ((b - a) & 0xffff, None),
+    _alu_pass_a:  lambda a, b, inten: (a, None),
+    _alu_pass_b:  lambda a, b, inten: (b, None),
+    _alu_istat:   lambda a, b, inten: (np.where(inten, 2, 0), None),
+    _alu_ror_a:   lambda a, b, inten: (_ror(a), None),
+    _alu_ror_b:   lambda a, b, inten: (_ror(b), None),
+    _alu_rol_a:   lambda a, b, inten: (_rol(a), None),
+    _alu_rol_b:   lambda a, b, inten: (_rol(b), None),
+    _alu_eq:      lambda a, b, inten: (None, a == b),
+    _alu_neq:     lambda a, b, inten: (None, a != b),
+    _alu_ltu:     lambda a, b, inten: (None, a < b),
+    _alu_geu:     lambda a, b, inten: (None, a >= b),
+    _alu_lts:     lambda a, b, inten: (None, _signed16(a) < _signed16(b)),
+    _alu_ges:     lambda a, b, inten: (None, _signed16(a) >= _signed16(b)),
+    _alu_les:     lambda a, b, inten: (None, _signed16(a) <= _signed16(b)),
+    _alu_gts:     lambda a, b, inten: (None, _signed16(a) > _signed16(b)),
+}
+# Handlers that can't deal with an unknown (None) B operand. For EQ/NEQ an unknown operand simply doesn't match.
+_uses_opb = {_alu_or, _alu_and, _alu_xor, _alu_add, _alu_sub, _alu_isub, _alu_pass_b, _alu_ror_b, _alu_rol_b, _alu_ltu, _alu_geu, _alu_lts, _alu_ges, _alu_les, _alu_gts}
+
+# The decode table, split into columns
+_alu_funcs = list(_vec_alu_handlers.keys())
+_alu_ids = {func: idx for idx, func in enumerate(_alu_funcs)}
+_dec_opb = np.array([dec.opb for dec in decode_table], dtype=np.int64)
+_dec_opa = np.array([dec.opa for dec in decode_table], dtype=np.int64)
+_dec_d = np.array([dec.d for dec in decode_table], dtype=np.int64)
+_dec_immed = np.array([dec.immed for dec in decode_table], dtype=np.int64)
+_dec_mem_ref = np.array([dec.mem_ref for dec in decode_table], dtype=bool)
+_dec_mem_result = np.array([dec.mem_result for dec in decode_table], dtype=bool)
+_dec_reg_result = np.array([dec.reg_result for dec in decode_table], dtype=bool)
+_dec_is_swap = np.array([dec.is_swap for dec in decode_table], dtype=bool)
+_dec_alu = np.array([_alu_ids[dec.alu] for dec in decode_table], dtype=np.int64)
+_dec_cycles = np.array([dec.cycles for dec in decode_table], dtype=np.int64)
+_dec_uses_opb = np.array([dec.alu in _uses_opb for dec in decode_table], dtype=bool)
+
+class VecSystem(object):
+    def __init__(self, count: int, mem_size: int = 16384):
+        assert 0 < mem_size <= TERMINATE_ADDR
+        self.count = count
+        self.mem_size = mem_size
+        self.data = np.zeros((count, mem_size), dtype=np.uint16)
+        self.state = np.zeros((count, mem_size), dtype=np.uint8)
+        # I/O ports from PORT_BASE to the terminator, for the addresses not covered by memory
+        self.ports = np.zeros((count, TERMINATE_ADDR - PORT_BASE), dtype=np.int64)
+        self.port_mapped = np.zeros(TERMINATE_ADDR - PORT_BASE, dtype=bool)
+        self.port_output = np.zeros(TERMINATE_ADDR - PORT_BASE, dtype=bool)
+        for addr, name, is_output in io_ports:
+            if addr >= mem_size:
+                self.port_mapped[addr - PORT_BASE] = True
+                self.port_output[addr - PORT_BASE] = is_output
+        self.regs = np.zeros((4, count), dtype=np.int64) # indexed by OPA_xxx
+        self.inten = np.zeros(count, dtype=bool)
+        self.interrupt_pending = np.zeros(count, dtype=bool)
+        self.in_reset = np.ones(count, dtype=bool)
+        self.status = np.full(count, VM_RUNNING, dtype=np.uint8)
+        self.exit_code = np.zeros(count, dtype=np.int64)
+        self.exit_code_valid = np.zeros(count, dtype=bool)
+        self.clk_count = np.zeros(count, dtype=np.int64)
+
+    @property
+    def pc(self) -> np.ndarray:
+        return self.regs[OPA_PC]
+    @property
+    def sp(self) -> np.ndarray:
+        return self.regs[OPA_SP]
+    @property
+    def r0(self) -> np.ndarray:
+        return self.regs[OPA_R0]
+    @property
+    def r1(self) -> np.ndarray:
+        return self.regs[OPA_R1]
+
+    ########################################
+    # Memory content
+    ########################################
+    def load(self, start_addr: int, content: Sequence[int], machines: Any = slice(None)) -> None:
+        # Loads the same content into all (or the selected) machines
+        content = np.asarray(content, dtype=np.int64)
+        self.load_each(start_addr, np.broadcast_to(content, (self.count, len(content)))[machines], machines)
+
+    def load_each(self, start_addr: int, content: np.ndarray, machines: Any = slice(None)) -> None:
+        # Loads a different content into each machine; 'content' is a (machines, words) array
+        count = content.shape[1]
+        assert 0 <= start_addr and start_addr + count <= self.mem_size
+        self.data[machines, start_addr:start_addr+count] = content & 0xffff
+        self.state[machines, start_addr:start_addr+count] = MEM_PRESENT
+
+    def snapshot_dict(self, machine: int) -> Dict[int, Optional[int]]:
+        # Same as Memory.snapshot_dict, for a single machine
+        state = self.state[machine]
+        data = self.data[machine]
+        return {
+            int(addr): (int(data[addr]) if state[addr] == MEM_PRESENT else None)
+            for addr in np.flatnonzero(state != MEM_CLEARED)
+        }
+
+    ########################################
+    # Bus
+    ########################################
+    def _fault(self, idx: np.ndarray) -> None:
+        self.status[idx] = VM_FAULTED
+
+    def _read(self, idx: np.ndarray, addr: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Returns the data read, whether it's known and whether the access was to an unmapped address
+        value = np.zeros(len(idx), dtype=np.int64)
+        valid = np.ones(len(idx), dtype=bool)
+        ram = addr < self.mem_size
+        ram_idx = idx[ram]
+        ram_addr = addr[ram]
+        value[ram] = self.data[ram_idx, ram_addr]
+        valid[ram] = self.state[ram_idx, ram_addr] == MEM_PRESENT
+        self.state[ram_idx, ram_addr] = MEM_CLEARED
+        port = ~ram & (addr >= PORT_BASE) & (addr < TERMINATE_ADDR)
+        port[port] = self.port_mapped[addr[port] - PORT_BASE]
+        value[port] = self.ports[idx[port], addr[port] - PORT_BASE]
+        unmapped = ~ram & ~port & (addr != TERMINATE_ADDR)
+        return value, valid, unmapped
+
+    def _write(self, idx: np.ndarray, addr: np.ndarray, value: np.ndarray, valid: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Returns whether the write stopped or faulted the machine
+        ram = addr < self.mem_size
+        faulted = np.zeros(len(idx), dtype=bool)
+        faulted[ram] = self.state[idx[ram], addr[ram]] != MEM_CLEARED
+        ram &= ~faulted
+        ram_idx = idx[ram]
+        ram_addr = addr[ram]
+        self.data[ram_idx, ram_addr] = np.where(valid[ram], value[ram] & 0xffff, 0)
+        self.state[ram_idx, ram_addr] = np.where(valid[ram], MEM_PRESENT, MEM_UNKNOWN)
+        port = ~ram & ~faulted & (addr >= PORT_BASE) & (addr < TERMINATE_ADDR)
+        port[port] = self.port_mapped[addr[port] - PORT_BASE]
+        latch = port & valid
+        latch[latch] = self.port_output[addr[latch] - PORT_BASE]
+        self.ports[idx[latch], addr[latch] - PORT_BASE] = value[latch] & 0xffff
+        stopped = addr == TERMINATE_ADDR
+        self.exit_code[idx[stopped]] = value[stopped]
+        self.exit_code_valid[idx[stopped]] = valid[stopped]
+        self.status[idx[stopped]] = VM_TERMINATED
+        faulted |= ~ram & ~port & ~stopped
+        self._fault(idx[faulted])
+        return stopped, faulted
+
+    ########################################
+    # Execution
+    ########################################
+    def step(self, clock_count: Optional[int] = None) -> int:
+        # Executes the reset sequence or a single instruction on all running machines (that haven't run for
+        # more than 'clock_count' cycles). Returns the number of machines that did something.
+        active = self.status == VM_RUNNING
+        if clock_count is not None:
+            active &= self.clk_count <= clock_count
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            return 0
+        in_reset = self.in_reset[idx]
+        if in_reset.any():
+            self._step_reset(idx[in_reset])
+        if not in_reset.all():
+            self._step_inst(idx[~in_reset])
+        return len(idx)
+
+    def run(self, clock_count: int) -> None:
+        # The equivalent of System.simulate_fast for all machines
+        while self.step(clock_count) > 0:
+            pass
+
+    def _step_reset(self, idx: np.ndarray) -> None:
+        addr = np.zeros(len(idx), dtype=np.int64)
+        new_pc, valid, _ = self._read(idx, addr)
+        self._write(idx, addr, new_pc, valid)
+        self._fault(idx[~valid])
+        idx = idx[valid]
+        self.regs[OPA_PC, idx] = new_pc[valid] & 0xffff
+        self.in_reset[idx] = False
+        self.clk_count[idx] += RESET_CYCLES
+
+    def _step_inst(self, idx: np.ndarray) -> None:
+        regs = self.regs
+
+        # Fetch and write-back
+        pc = regs[OPA_PC, idx]
+        inst, valid, unmapped = self._read(idx, pc)
+        self._fault(idx[unmapped])
+        keep = ~unmapped
+        idx, pc, inst, valid = idx[keep], pc[keep], inst[keep], valid[keep]
+        stopped, faulted = self._write(idx, pc, inst, valid)
+        self.clk_count[idx[stopped]] += 2
+        self._fault(idx[~valid])
+        keep = ~stopped & ~faulted & valid
+        idx, inst = idx[keep], inst[keep]
+
+        # Handle interrupts by overriding the just fetched instruction
+        inst = np.where(self.interrupt_pending[idx] & self.inten[idx], INTERRUPT_INST, inst)
+
+        opb = _dec_opb[inst]
+        opa = _dec_opa[inst]
+        mem_ref = _dec_mem_ref[inst]
+        mem_result = _dec_mem_result[inst]
+        is_swap = _dec_is_swap[inst]
+        cycles = _dec_cycles[inst]
+
+        # Operands. The lower two bits of OPB select the base register: $pc, $sp, $r0 (in the same order as OPA) or nothing.
+        base = np.where((opb & OPB_BASE_MASK) == 3, 0, regs[np.minimum(opb & OPB_BASE_MASK, 2), idx])
+        mem_op_addr = base + _dec_immed[inst]
+        alu_opa = regs[opa, idx]
+        alu_opb = mem_op_addr.copy()
+        opb_valid = np.ones(len(idx), dtype=bool)
+        unmapped = np.zeros(len(idx), dtype=bool)
+        alu_opb[mem_ref], opb_valid[mem_ref], unmapped[mem_ref] = self._read(idx[mem_ref], mem_op_addr[mem_ref] & 0xffff)
+        self._fault(idx[unmapped])
+
+        # SWAP loads the register in a separate cycle, before anything else
+        swap = is_swap & ~unmapped
+        self._fault(idx[swap & ~opb_valid])
+        swap &= opb_valid
+        regs[opa[swap], idx[swap]] = (alu_opb[swap] + (opb[swap] == OPB_IMMED_PC)) & 0xffff
+
+        # Write-back of the operand
+        write_back = mem_ref & ~mem_result & ~unmapped
+        stopped = np.zeros(len(idx), dtype=bool)
+        faulted = unmapped | (is_swap & ~opb_valid)
+        stopped[write_back], faulted[write_back] = self._write(idx[write_back], mem_op_addr[write_back] & 0xffff, alu_opb[write_back], opb_valid[write_back])
+        self.clk_count[idx[stopped]] += cycles[stopped] - 2
+
+        # Execute
+        alu = _dec_alu[inst]
+        bad_opb = _dec_uses_opb[inst] & ~opb_valid
+        self._fault(idx[bad_opb & ~stopped & ~faulted])
+        faulted |= bad_opb
+        keep = ~stopped & ~faulted
+        idx, inst, opb, opa, mem_result, is_swap, cycles, alu, alu_opa, alu_opb, opb_valid, mem_op_addr = (
+            x[keep] for x in (idx, inst, opb, opa, mem_result, is_swap, cycles, alu, alu_opa, alu_opb, opb_valid, mem_op_addr)
+        )
+        result = np.zeros(len(idx), dtype=np.int64)
+        noskip = np.ones(len(idx), dtype=bool)
+        inten = self.inten[idx]
+        for alu_id in np.unique(alu):
+            lanes = alu == alu_id
+            lane_result, lane_noskip = _vec_alu_handlers[_alu_funcs[alu_id]](alu_opa[lanes], alu_opb[lanes], inten[lanes])
+            if lane_result is not None:
+                result[lanes] = lane_result
+            if lane_noskip is not None:
+                # Unknown operands never compare equal
+                noskip[lanes] = np.where(opb_valid[lanes], lane_noskip, _alu_funcs[alu_id] is _alu_neq)
+
+        # Store the result
+        reg_result = _dec_reg_result[inst] & ~mem_result
+        bad_swap = is_swap & (opb >= OPB_IMMED_PC) # SWAP between two registers is not supported
+        self._fault(idx[bad_swap])
+        mem_result &= ~bad_swap
+        stopped = np.zeros(len(idx), dtype=bool)
+        faulted = bad_swap.copy()
+        stopped[mem_result], faulted[mem_result] = self._write(idx[mem_result], mem_op_addr[mem_result] & 0xffff, result[mem_result], np.ones(np.count_nonzero(mem_result), dtype=bool))
+        self.clk_count[idx[stopped]] += cycles[stopped] - 1
+        regs[opa[reg_result], idx[reg_result]] = result[reg_result] & 0xffff
+
+        # Update $pc and inten
+        keep = ~stopped & ~faulted
+        skip_pc_update = (opa == OPA_PC) & ((mem_result & is_swap) | reg_result)
+        update = keep & ~skip_pc_update
+        regs[OPA_PC, idx[update]] = (regs[OPA_PC, idx[update]] + np.where(noskip[update], 1, 2)) & 0xffff
+        toggle = keep & is_swap & (_dec_d[inst] == 0)
+        self.inten[idx[toggle]] = ~self.inten[idx[toggle]]
+        self.clk_count[idx[keep]] += cycles[keep]